@@ -145,6 +145,27 @@ ONCHAIN_PRIVATE_KEY = os.getenv("CHOEN_ONCHAIN_PRIVATE_KEY", None) #"<better_kee
 ONCHAIN_URL = os.getenv("CHOEN_ONCHAIN_URL", "https://sepolia.infura.io/v3/5d8ab00cfcc744768f1f3726a23a230d")
 ONCHAIN_CHAIN_ID = int(os.getenv("CHOEN_ONCHAIN_CHAIN_ID", "11155111")) # the default value is specific for the Sepolia test blockchain worldwide
 
+# how a REI is translated into an NFA: "thompson" (with epsilon transitions), "glushkov" (position automaton, without epsilon transitions)
+NFA_TRANSLATOR = os.getenv("CHOEN_NFA_TRANSLATOR", "thompson")
+# whether the states that cannot be reached or cannot reach a final state are removed from the translated NFA
+NFA_TRIM = os.getenv("CHOEN_NFA_TRIM", "true").lower() in [ "true", "1", "yes" ]
+# "thompson": number of processes translating the large items of Union and Par nodes in parallel (0: sequential translation)
+NFA_WORKERS = int(os.getenv("CHOEN_NFA_WORKERS", "0"))
+# "thompson": max number of automata of REI nodes cached across translations, reused when an edited choreography is translated again (0: no cache)
+NFA_CACHE_SIZE = int(os.getenv("CHOEN_NFA_CACHE_SIZE", "0"))
+
+# how the off-chain engine tracks the current states: "nfa" (sets of NFA states), "bitmask" (sets of NFA states encoded as int bitmasks),
+# "dfa" (states of the determinized automaton), "lazy_dfa" (states of an automaton determinized on the fly),
+# "interleaving" (the parallel branches run side by side, without building their product automaton)
+ENGINE_OFFCHAIN_MODE = os.getenv("CHOEN_ENGINE_OFFCHAIN_MODE", "nfa")
+# "lazy_dfa": max number of sets of NFA states cached by the on-the-fly DFA
+ENGINE_LAZY_DFA_MAX_STATES = int(os.getenv("CHOEN_ENGINE_LAZY_DFA_MAX_STATES", "1024"))
+# whether the epsilon transitions are removed from the automaton before enforcing it (not used by the "interleaving" mode)
+ENGINE_REMOVE_EPSILONS = os.getenv("CHOEN_ENGINE_REMOVE_EPSILONS", "false").lower() in [ "true", "1", "yes" ]
+# "nfa" and "bitmask": directory where the automata of the running instances are stored in the binary format of the serialization module,
+# and mapped in memory when the instances are loaded ("": the automata are pickled with the instances)
+ENGINE_AUTOMATA_DIR = os.getenv("CHOEN_ENGINE_AUTOMATA_DIR", "")
+
 
 
 REST_FRAMEWORK = {
@@ -16,6 +16,33 @@ NS = {
 
 ElementType=ET.Element
 
+# automata of the REI nodes translated by Choreography.to_nfa, shared by all the choreographies (see nfa.TranslationCache)
+_translation_cache = None
+
+def translation_cache():
+    global _translation_cache
+    from nfa import TranslationCache
+
+    if _translation_cache is None and settings.NFA_CACHE_SIZE > 0:
+        _translation_cache = TranslationCache(settings.NFA_CACHE_SIZE)
+
+    return _translation_cache
+
+# processes translating the large REI nodes for Choreography.to_nfa (see settings.NFA_WORKERS), started on
+# first use and shared by all the translations; they are spawned, since forking a process holding database
+# connections and threads is not safe
+_translation_executor = None
+
+def translation_executor():
+    global _translation_executor
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    if _translation_executor is None and settings.NFA_WORKERS > 0:
+        _translation_executor = ProcessPoolExecutor(max_workers=settings.NFA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+    return _translation_executor
+
 class Choreography(models.Model):
 
     name = models.TextField(max_length=100, null=True, blank=True)
@@ -385,8 +412,53 @@ class Choreography(models.Model):
         print("REI:", exp)
         return exp
 
-    def to_nfa(self):
-        from nfa import ReiToNFA
+    """
+    Translate the choreography into an NFA with the passed translator (default: settings.NFA_TRANSLATOR),
+    trimming it if trim is set (default: settings.NFA_TRIM, see nfa.NFA.trim). With settings.NFA_WORKERS
+    processes, the Thompson translation builds the large items of Union and Par nodes in parallel (see
+    translation_executor); the REIs too small to have such items are translated in place.
+    If settings.NFA_CACHE_SIZE is positive, the Thompson translation reuses the automata of the REI
+    nodes already translated (see translation_cache), so that translating an edited choreography
+    only rebuilds the nodes affected by the edit.
+    """
+    def to_nfa(self, translator : str = None, trim : bool = None):
+        from nfa import ReiToNFA, ReiToGlushkovNFA, rei_size, PARALLEL_MIN_SIZE
+
+        translators = {
+            "thompson": ReiToNFA,
+            "glushkov": ReiToGlushkovNFA,
+        }
+
+        if translator is None:
+            translator = settings.NFA_TRANSLATOR
+
+        if translator not in translators:
+            raise ValueError(f"REI to NFA translator not supported: {translator}. Available translators: {', '.join(translators.keys())}")
+
+        if trim is None:
+            trim = settings.NFA_TRIM
+
         rei = self.to_rei()
-        automaton = ReiToNFA(rei)
+        cache = translation_cache() if translator == "thompson" else None
+
+        if cache is not None:
+            hits, misses = cache.hits, cache.misses
+
+        if translator == "thompson" and settings.NFA_WORKERS > 0 and rei_size(rei) >= PARALLEL_MIN_SIZE:
+            automaton = ReiToNFA(rei, executor=translation_executor(), cache=cache)
+        elif cache is not None:
+            automaton = ReiToNFA(rei, cache=cache)
+        else:
+            automaton = translators[translator](rei)
+
+        if cache is not None:
+            print(f"NFA cache: reused {cache.hits - hits} automata, translated {cache.misses - misses} REI nodes")
+            if not trim:
+                # the automaton is shared with the cache
+                automaton = automaton.copy()
+
+        if trim:
+            automaton, num_states, num_transitions = automaton.trim()
+            print(f"NFA trim: removed {num_states} states, {num_transitions} transitions")
+
         return automaton
@@ -1,7 +1,8 @@
 from audioop import add
-from django.test import TestCase
+from django.test import TestCase, override_settings
 import solcx
 import os
+import pickle
 from django.conf import settings
 from enforcer_generator import EnforcerGenerator
 from enforcer_deployer import EnforcerDeployer
@@ -11,11 +12,21 @@ from enforcer import Enforcer
 from nfa import NFA
 import rei
 import nfa
+import dfa
+from engine.models import EngineOffChain, EngineOffChainBitmask, EngineOffChainDFA, EngineOffChainLazyDFA, EngineOffChainInterleaving
+import interleaving
+import symbols
+import serialization
 import contracts
+import generator
 from contracts import SmartContract
 import json
 from web3 import Web3
 import requests
+import tempfile
+import io
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 
 class TestChoreographyBasicCase(TestCase):
 
@@ -419,6 +430,42 @@ class TestChoreographyToRei(TestCase):
 
         assert str(r) == "^Pizza_Place?pizza_order (Pizza_Place?Message_0rkgt7n (Customer?Message_10fwh9y$ & (('' | Customer?Message_1e83pou$) & ('' | Customer?Message_0futku6 Pizza_Place?Message_1nqt44e$))) | Delivery_Boy?Message_1mi4idx Customer?pizza$)", f"Received: {r}"
 
+    def test_hash_consing(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested_dangling")
+
+        # translating the same diagram twice yields the same nodes
+        r, _ = rei.ChoToRei(c, rei.render_receive)
+        assert rei.ChoToRei(c, rei.render_receive)[0] is r
+
+        a = rei.Conc(rei.Start(), "foo", rei.Union("fie", rei.Star(rei.Par("zog", "zip"))), rei.End())
+        b = rei.Conc(rei.Start(), rei.Conc("foo", rei.Union("fie", rei.Star(rei.Par("zog", "zip")))), rei.End())
+        assert a is b and hash(a) == hash(b)
+        assert a.items[2] is rei.Union("fie", rei.Star(rei.Par("zog", "zip")))
+        assert len(set([ a, b, rei.Union("fie", "foo"), rei.Union("fie", "foo") ])) == 2
+
+        # nodes of different types are told apart
+        assert rei.Union("foo", "fie") is not rei.Par("foo", "fie")
+        assert rei.Symbol("") != rei.Epsilon()
+        assert rei.Symbol("^") != rei.Start()
+
+        # the forms of the nodes are computed once
+        assert str(a) == "^foo (fie | ((zog & zip))*)$"
+        assert str(a) is str(a)
+        assert a.latex is a.latex
+
+        with self.assertRaises(AttributeError):
+            a.items = ()
+        with self.assertRaises(AttributeError):
+            rei.Symbol("foo").symbol = "fie"
+
+        assert pickle.loads(pickle.dumps(r)) is r
+        assert pickle.loads(pickle.dumps(rei.Epsilon())) is rei.Epsilon()
+
+        # rendering is linear in the number of items
+        long = rei.Conc(*[ f"m{i}" for i in range(20000) ])
+        assert str(long).count(" ") == 19999
+
 
 class TestNFA(TestCase):
 
@@ -571,6 +618,68 @@ class TestNFA(TestCase):
             assert t.target == s5
 
 
+    def test_transition_indexes(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2)
+        a.add_state(s3, is_final=True)
+
+        a.add_transition(s1, s3, "a")
+        a.add_transition(s2, s3, "a")
+        a.add_transition(s2, s3, "b")
+        a.add_transition(s1, s2) # epsilon transition
+        a.add_transition(s1, s3, "a") # duplicated transition
+
+        assert a.transitions_to(s3) == set([ nfa.Transition(s1, s3, "a"), nfa.Transition(s2, s3, "a"), nfa.Transition(s2, s3, "b") ])
+        assert a.transitions_to(s3, "a") == set([ nfa.Transition(s1, s3, "a"), nfa.Transition(s2, s3, "a") ])
+        assert a.transitions_to(s3, "a", s2) == set([ nfa.Transition(s2, s3, "a") ])
+        assert a.transitions_to(s3, "c") == set()
+        assert a.transitions_to(s1) == set()
+        assert a.transitions_to(s2) == set([ nfa.Transition(s1, s2, nfa.EPSILON) ])
+
+        assert a.transitions_labeled("a") == a.transitions_to(s3, "a")
+        assert a.transitions_labeled(nfa.EPSILON) == a.transitions_to(s2)
+        assert a.transitions_labeled("c") == set()
+
+        for t in a.transitions:
+            assert t in a.transitions_to(t.target, t.label, t.source)
+            assert t in a.transitions_labeled(t.label)
+
+        # automata pickled without the indexes get them rebuilt
+        state = a.__getstate__()
+        del state["_transitions_to"]
+        del state["_transitions_labeled"]
+
+        b = nfa.NFA.__new__(nfa.NFA)
+        b.__setstate__(state)
+        assert b.transitions_to(s3, "a") == a.transitions_to(s3, "a")
+        assert b.transitions_labeled("b") == a.transitions_labeled("b")
+
+        # the list of the transitions is built once, and kept up to date with the indexes
+        transitions = a.transitions
+        assert a.transitions is transitions
+        a.add_transition(s3, s1, "c")
+        a.add_transition(s3, s1, "c")
+        assert a.transitions is transitions and len(transitions) == 5
+        assert a.transitions_to(s1) == set([ nfa.Transition(s3, s1, "c") ])
+
+        # merged automata keep their indexes
+        s4 = nfa.State("s4")
+        c = nfa.NFA()
+        c.add_state(s4)
+        c.add_transition(s4, s3, "a")
+        a._merge(c)
+        assert a._transitions_to is not None
+        assert a.transitions_to(s3, "a") == set([ nfa.Transition(s1, s3, "a"), nfa.Transition(s2, s3, "a"), nfa.Transition(s4, s3, "a") ])
+        assert a.transitions_labeled("a") == a.transitions_to(s3, "a")
+        assert len(a.transitions) == 6
+        assert a.copy().transitions_labeled("c") == set([ nfa.Transition(s3, s1, "c") ])
+
     def test_epsilon_closure(self):
         s1 = nfa.State("s1")
         s2 = nfa.State("s2")
@@ -612,6 +721,54 @@ class TestNFA(TestCase):
         assert len(c) == 2, f"Received: {c}"
         assert c == set([ s1.id, s5.id ])
 
+    def test_epsilon_closure_table(self):
+        states = [ nfa.State(f"s{i}") for i in range(6) ]
+
+        a = nfa.NFA()
+        for s in states:
+            a.add_state(s)
+
+        # s0 -> s1 -> s2 -> s0 is an epsilon cycle, which can reach s3 -> s4
+        a.add_transition(states[0], states[1])
+        a.add_transition(states[1], states[2])
+        a.add_transition(states[2], states[0])
+        a.add_transition(states[2], states[3])
+        a.add_transition(states[3], states[4])
+        a.add_transition(states[4], states[5], "a")
+
+        a.set_initial(states[0])
+
+        ids = [ s.id for s in states ]
+
+        for s in states[:3]:
+            c = a.e_closure(s)
+            assert c == set(ids[:5]), f"Received: {c}"
+
+        c = a.e_closure(states[3])
+        assert c == set(ids[3:5]), f"Received: {c}"
+
+        c = a.e_closure(set([ ids[4], ids[5] ]))
+        assert c == set(ids[4:]), f"Received: {c}"
+
+        # the returned closure is a fresh set, that can be freely modified by the caller
+        c.add("foo")
+        assert "foo" not in a.e_closure(states[5])
+
+        # mutating the automaton invalidates the table
+        a.add_transition(states[5], states[0])
+        c = a.e_closure(states[5])
+        assert c == set(ids), f"Received: {c}"
+
+        # long epsilon chains do not hit the recursion limit
+        b = nfa.NFA()
+        chain = [ nfa.State(f"c{i}") for i in range(2000) ]
+        for s in chain:
+            b.add_state(s)
+        for s, t in zip(chain, chain[1:]):
+            b.add_transition(s, t)
+
+        assert len(b.e_closure(chain[0])) == len(chain)
+
     def test_automaton_linear(self):
         s1 = nfa.State("s1")
         s2 = nfa.State("s2")
@@ -823,6 +980,437 @@ class TestNFA(TestCase):
         assert s9.id in states, f"Received: {accepted}, {states}, {remaining}"
         assert remaining == ""
 
+    def test_automaton_set_simulation(self):
+
+        # every symbol can be read along two different paths, so a backtracking
+        # reader would explore 2^n paths before rejecting the input
+        n = 40
+
+        a = nfa.NFA()
+        for i in range(n + 1):
+            a.add_state(nfa.State(f"s{i}"), is_final=(i == n))
+
+        for i in range(n):
+            for branch in [ "l", "r" ]:
+                a.add_state(nfa.State(f"{branch}{i}"))
+                a.add_transition(f"s{i}", f"{branch}{i}", "x")
+                a.add_transition(f"{branch}{i}", f"s{i+1}")
+
+        a.set_initial("s0")
+
+        accepted, states, remaining = a.read_string(" ".join([ "x" ] * n))
+        assert accepted == True, f"Received: {accepted}, {states}, {remaining}"
+        assert states == { f"l{n-1}", f"r{n-1}", f"s{n}" }, f"Received: {states}"
+        assert remaining == ""
+
+        accepted, states, remaining = a.read_string(" ".join([ "x" ] * n + [ "y", "x" ]))
+        assert accepted == False
+        assert f"s{n}" in states, f"Received: {states}"
+        assert remaining == "y x", f"Received: {remaining}"
+
+        # the longest consumed prefix is returned, even if it does not reach a final state
+        accepted, states, remaining = a.read_string("x x y")
+        assert accepted == False
+        assert states == { "l1", "r1", "s2" }, f"Received: {states}"
+        assert remaining == "y"
+
+        # reading can start from any state of the automaton
+        accepted, states, remaining = a.read_string(" ".join([ "x" ] * (n - 1)), "s1")
+        assert accepted == True
+        assert remaining == ""
+
+    def test_check_traces(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2, is_final=True)
+        a.set_initial(s1)
+
+        # automaton recognizing (a b*) (a a b*)*
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s2, s2, "b")
+        a.add_transition(s2, s1, "a")
+
+        traces = [ "a b b", "a a", "a b c b", "", "'a' 'b'", [ "a", "a", "a" ], [ "c" ] ]
+        results = a.check_traces(traces)
+
+        assert results == [ (True, None), (False, 2), (False, 2), (False, 0), (True, None), (True, None), (False, 0) ], f"Received: {results}"
+
+        # results agree with read_string, one trace at a time
+        for trace, (accepted, pos) in zip(traces, results):
+            if isinstance(trace, list):
+                trace = " ".join(trace)
+
+            expected, _, remaining = a.read_string(trace)
+            assert accepted == expected, f"Received: {trace}, {accepted}"
+            if not accepted:
+                assert pos == len(nfa.InputScanner.tokenize(trace)) - len(nfa.InputScanner.tokenize(remaining)), f"Received: {trace}, {pos}, {remaining}"
+
+        results = a.check_traces([ "b", "a a" ], curr_state=s2)
+        assert results == [ (True, None), (True, None) ], f"Received: {results}"
+
+        assert a.check_traces([]) == []
+
+    def test_step(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+        s4 = nfa.State("s4")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2)
+        a.add_state(s3)
+        a.add_state(s4, is_final=True)
+        a.set_initial(s1)
+
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s1, s3, "a")
+        a.add_transition(s2, s2, "b")
+        a.add_transition(s3, s4, "c")
+        a.add_transition(s2, s4)
+
+        reached, died, added = a.step({ "s1" }, "a")
+        assert reached == { "s2", "s3", "s4" }, f"Received: {reached}"
+        assert died == set()
+        assert added == { "s2", "s3", "s4" }
+
+        reached, died, added = a.step(reached, "b")
+        assert reached == { "s2", "s4" }, f"Received: {reached}"
+        assert died == { "s3", "s4" }, f"Received: {died}"
+        assert added == set()
+
+        reached, died, added = a.step({ "s2", "s3", "s4" }, "foo")
+        assert reached == set() and died == { "s2", "s3", "s4" } and added == set()
+
+        # results are cached per set of state indexes and label code, until the automaton changes
+        compact = a.freeze()
+        indexes = frozenset(map(compact.index, [ "s2", "s3", "s4" ]))
+        assert compact.step_states(indexes, compact.code("b")) is compact.step_states(frozenset(indexes), compact.code("b"))
+        assert compact.step_states(indexes, compact.code("b"))[0] == frozenset(map(compact.index, [ "s2", "s4" ]))
+
+        a.add_transition(s3, s3, "b")
+        reached, died, added = a.step({ "s2", "s3", "s4" }, "b")
+        assert reached == { "s2", "s3", "s4" } and died == { "s4" }, f"Received: {reached}, {died}"
+
+        b = pickle.loads(pickle.dumps(a))
+        assert b.step({ "s2", "s3", "s4" }, "b") == (reached, died, added)
+
+    def test_enabled_labels(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2)
+        a.add_state(s3, is_final=True)
+        a.set_initial(s1)
+
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s1, s3)
+        a.add_transition(s2, s2, "b")
+        a.add_transition(s2, s3, "c")
+        a.add_transition(s3, s1, "d")
+
+        # the labels departing from the epsilon-closure are enabled
+        assert a.enabled_labels({ "s1" }) == { "a", "d" }
+        assert a.enabled_labels([ "s2", "s3" ]) == { "b", "c", "d" }
+        assert a.enabled_labels(set()) == set()
+
+        for states in [ { "s1" }, { "s2" }, { "s3" }, { "s1", "s2" } ]:
+            for label in [ "a", "b", "c", "d", "e" ]:
+                reached, _, _ = a.step(states, label)
+                assert (label in a.enabled_labels(states)) == (len(reached) > 0), f"Received: {states}, {label}"
+
+        # the enabled label codes are cached, until the automaton changes
+        compact = a.freeze()
+        indexes = frozenset([ compact.index("s1") ])
+        assert compact.enabled_codes(indexes) is compact.enabled_codes(indexes)
+        assert compact.enabled_codes(indexes) == { compact.code("a"), compact.code("d") }
+        a.add_transition(s1, s1, "e")
+        assert a.enabled_labels({ "s1" }) == { "a", "d", "e" }
+
+    def test_write_dot(self):
+
+        r = rei.Conc(rei.Start(), "a", rei.Par(rei.Conc("b", "c"), rei.Star(rei.Symbol("d"))), "e", rei.End())
+        a = nfa.ReiToNFA(r)
+
+        out = io.StringIO()
+        nfa.write_dot(a, out)
+        text = out.getvalue()
+        assert text.startswith("digraph curr_graph {\n") and text.endswith("}\n")
+        assert text.count(" -> ") == len(a.transitions)
+        assert text.count('[label=""') == len(a.states)
+        # the states of the product automaton of the Par node are clustered
+        assert 'subgraph "cluster_2."' in text
+        assert '"2.0.0.i__2.1.0.i" [label=""]' in text
+        assert "label=<&#949;>" in text and 'label="A"' in text
+
+        assert nfa.par_cluster("2.0.1.f__2.1.0.i") == "2."
+        assert nfa.par_cluster("0.10.i__0.11.f") == "0."
+        assert nfa.par_cluster("0.i__1.f") is None
+        assert nfa.par_cluster("2.0.1.f") is None
+
+        # the states around the initial one, the other ones collapsed
+        states = nfa.neighbourhood(a, [ "0.e" ], 2)
+        assert states == set([ "0.e", "1.i", "1.f" ]), f"Received: {states}"
+
+        out = io.StringIO()
+        nfa.write_dot(a, out, states, current=[ "0.e" ])
+        text = out.getvalue()
+        assert text.count('[label=""') == 3
+        assert '"0.e" [label="" shape=circle style=filled fillcolor=red width=0.15]' in text
+        assert '"...2." [label="8 states" shape=box style=dashed]' in text
+        assert '"1.f" -> "...2." [label=<&#949;>]' in text
+        assert text.count(" -> ") == 3
+
+        # no clusters
+        out = io.StringIO()
+        nfa.write_dot(a, out, cluster=None)
+        assert "subgraph" not in out.getvalue()
+
+    def test_trim(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+        s4 = nfa.State("s4")
+        s5 = nfa.State("s5")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2, is_final=True)
+        a.add_state(s3)
+        a.add_state(s4)
+        a.add_state(s5, is_final=True)
+        a.set_initial(s1)
+
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s2, s2, "b")
+        # s3 cannot reach a final state
+        a.add_transition(s1, s3, "a")
+        a.add_transition(s3, s3, "c")
+        # s4 and s5 cannot be reached
+        a.add_transition(s4, s5, "d")
+        a.add_transition(s5, s2)
+
+        b, num_states, num_transitions = a.trim()
+        assert set(s.id for s in b.states) == { "s1", "s2" }
+        assert set(map(str, b.transitions)) == { str(nfa.Transition(s1, s2, "a")), str(nfa.Transition(s2, s2, "b")) }
+        assert b.initial.id == "s1" and set(s.id for s in b.final) == { "s2" }
+        assert num_states == 3 and num_transitions == 4, f"Received: {num_states}, {num_transitions}"
+
+        for string in [ "", "a", "a b b", "a c", "d" ]:
+            assert b.read_string(string)[0] == a.read_string(string)[0], f"Received: {string}"
+
+        # trimming again removes nothing
+        _, num_states, num_transitions = b.trim()
+        assert num_states == 0 and num_transitions == 0
+
+        # the initial state is kept, even if the language is empty
+        a.set_final()
+        b, num_states, num_transitions = a.trim()
+        assert [ s.id for s in b.states ] == [ "s1" ] and b.transitions == []
+        assert num_states == 4 and num_transitions == 6
+
+    def test_reentrant_read(self):
+
+        r = rei.Conc("foo", rei.Star(rei.Union("fie", rei.Par("zig", "zag"))), "fez")
+        a = nfa.ReiToNFA(r)
+
+        strings = [ "foo fez", "foo fie zig zag fez", "foo zag zig fie fez", "foo zig fez", "fie", "" ] * 50
+        expected = [ a.read_string(string) for string in strings ]
+
+        # one automaton shared by many threads
+        b = nfa.ReiToNFA(r)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(b.read_string, strings))
+
+        assert results == expected
+        assert b.iscan is None
+
+        # the cursor can be passed explicitly, to resume reading from the reached states
+        accepted, states, remaining = a.read_from(nfa.InputScanner("foo fie zig"))
+        assert not accepted and remaining == ""
+
+        accepted, states, remaining = a.read_from(nfa.InputScanner("zag fez"), states)
+        assert accepted and remaining == ""
+
+        accepted, states, remaining = a.read_from(nfa.InputScanner("zag fez"), states)
+        assert not accepted and remaining == "zag fez"
+
+        # the scanner is left at its position
+        scanner = nfa.InputScanner("foo fez")
+        assert a.do_read(scanner=scanner)[0]
+        assert scanner.bof
+
+        with self.assertRaises(Exception):
+            a.read_from(nfa.InputScanner("foo"), [ "unknown" ])
+
+
+    def test_remove_epsilons(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+        s4 = nfa.State("s4")
+        s5 = nfa.State("s5")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2)
+        a.add_state(s3)
+        a.add_state(s4, is_final=True)
+        a.add_state(s5) # unreachable
+        a.set_initial(s1)
+
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s2, s3)
+        a.add_transition(s3, s4)
+        a.add_transition(s3, s1, "b")
+        a.add_transition(s5, s4, "c")
+
+        assert a.has_epsilons
+
+        b = a.remove_epsilons()
+
+        assert not b.has_epsilons
+        assert all(t.label for t in b.transitions)
+        assert set(s.id for s in b.states) == { "s1", "s2" }, f"Received: {list(map(str, b.states))}"
+        assert b.initial.id == "s1"
+        assert set(s.id for s in b.final) == { "s2" }
+        assert b.transitions_from("s2", "b", "s1")
+
+        # the original automaton is left untouched
+        assert len(a.states) == 5 and a.has_epsilons
+
+        for string in [ "", "a", "a b", "a b a", "a a", "c" ]:
+            expected, _, _ = a.read_string(string)
+            accepted, _, _ = b.read_string(string)
+            assert accepted == expected, f"Received: {string}"
+
+        # automata translated from REI
+        r = rei.Conc("foo", rei.Star(rei.Union("fie", rei.Conc("zig", "zag"))), rei.Par("bar", "baz"))
+        a = nfa.ReiToNFA(r)
+        b = a.remove_epsilons()
+
+        assert not b.has_epsilons
+        assert len(b.states) < len(a.states), f"Received: {b}, {a}"
+
+        for string in [ "foo bar baz", "foo fie zig zag fie baz bar", "foo zig bar baz", "foo fie fie", "" ]:
+            expected, _, _ = a.read_string(string)
+            accepted, _, _ = b.read_string(string)
+            assert accepted == expected, f"Received: {string}"
+
+        assert len(nfa.NFA().remove_epsilons().states) == 0
+
+    def test_symbol_table(self):
+
+        t = symbols.SymbolTable([ "foo", "fie", "foo" ])
+
+        assert len(t) == 2
+        assert t.code("foo") == 1 and t.code("fie") == 2
+        assert t.code("") == t.code(None) == symbols.SymbolTable.EPSILON_CODE
+        assert t.code("zig") is None
+        assert t.intern("zig") == 3 and t.label(3) == "zig"
+        assert list(t) == [ (1, "foo"), (2, "fie"), (3, "zig") ]
+
+        assert [ symbols.SymbolTable.short_name(c) for c in [ 1, 2, 26, 27, 28, 52, 53, 702, 703 ] ] == [ "A", "B", "Z", "AA", "AB", "AZ", "BA", "ZZ", "AAA" ]
+
+        # many labels, shared by the automaton and its compact representation
+        a = nfa.NFA()
+        for i in range(200):
+            a.add_state(nfa.State(f"s{i}"))
+        a.add_state(nfa.State("s200"), is_final=True)
+        a.set_initial("s0")
+        for i in range(200):
+            a.add_transition(f"s{i}", f"s{i+1}", f"Actor{i}?message")
+            a.add_transition(f"s{i}", f"s{i+1}")
+
+        assert len(a.symbols) == 200
+        assert a.freeze().symbols is a.symbols
+        assert a.freeze().code("Actor150?message") == a.symbols.code("Actor150?message") == 151
+
+        dictionary = a.event_dictionary
+        assert len(dictionary) == 200
+        assert len(set(dictionary.keys())) == 200
+        assert dictionary["A"] == "Actor0?message"
+
+        g = a.to_dot()
+        assert "label=GR" in g.source, f"Received: {g.source[:200]}"
+
+        # automata pickled before the symbol table was introduced
+        b = nfa.NFA()
+        b.add_state(nfa.State("s1"))
+        b.add_state(nfa.State("s2"), is_final=True)
+        b.set_initial("s1")
+        b.add_transition("s1", "s2", "foo")
+
+        state = b.__getstate__()
+        del state["_symbols"]
+        state["_event_dictionary"] = { "foo": "A" }
+        state["_event_dictionary_lookup"] = { "A": "foo" }
+
+        c = nfa.NFA.__new__(nfa.NFA)
+        c.__setstate__(state)
+        assert c.symbols.code("foo") == 1
+        assert c.event_dictionary == { "A": "foo" }
+        assert not hasattr(c, "_event_dictionary")
+        assert c.read_string("foo")[0]
+
+    def test_freeze(self):
+
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+        s4 = nfa.State("s4")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2)
+        a.add_state(s3)
+        a.add_state(s4, is_final=True)
+
+        a.add_transition(s1, s2, "b")
+        a.add_transition(s1, s3, "a")
+        a.add_transition(s2, s4) # epsilon transition
+        a.add_transition(s3, s4, "b")
+
+        a.set_initial(s1)
+
+        c = a.freeze()
+        assert a.frozen
+        assert a.freeze() is c
+        assert c.num_states == 4, f"Received: {c}"
+        assert c.num_transitions == 4, f"Received: {c}"
+        assert c.num_labels == 3, f"Received: {c}"
+
+        assert c.id(c.initial) == s1.id
+        assert c.is_final(c.index(s4))
+        assert not c.is_final(c.index(s1))
+        assert c.index("foo") is None
+        assert c.code("foo") is None
+
+        assert list(c.targets(c.index(s1), c.code("a"))) == [ c.index(s3) ]
+        assert set(c.transitions_from(c.index(s1))) == a.transitions_from(s1)
+
+        reached = a.read_symbol("b", s1.id)
+        assert reached == set([ s2.id, s4.id ]), f"Received: {reached}"
+
+        # any change to the automaton discards the compact representation
+        a.add_transition(s4, s1, "c")
+        assert not a.frozen
+
+        reached = a.read_symbol("c", s2.id)
+        assert reached == set([ s1.id ]), f"Received: {reached}"
+        assert a.freeze() is not c
+
 
 class TestInputScanner(TestCase):
 
@@ -878,6 +1466,59 @@ class TestInputScanner(TestCase):
             # it should throw an exception for scanning the input after EOF
             token = iscan.scan_input()
 
+    def test_scan_bounded_undo(self):
+
+        input_str = " ".join(f"e{i}" for i in range(100))
+        iscan = nfa.InputScanner(input_str)
+        iscan.UNDO_DEPTH = 4
+
+        with iscan:
+            for i in range(50):
+                assert iscan.scan_input() == f"e{i}"
+                assert len(iscan._positions) <= 2 * iscan.UNDO_DEPTH
+
+            # the last readings can be undone, the older ones are forgotten
+            for i in range(iscan.UNDO_DEPTH):
+                iscan.undo_reading()
+            assert iscan.scan_input() == f"e{50 - iscan.UNDO_DEPTH}"
+
+            with iscan:
+                while not iscan.eof:
+                    iscan.scan_input()
+            assert iscan.scan_input() == f"e{51 - iscan.UNDO_DEPTH}"
+
+            with self.assertRaises(Exception) as context:
+                for i in range(2 * iscan.UNDO_DEPTH):
+                    iscan.undo_reading()
+
+        # the frozen position is restored even if the positions up to it were discarded
+        assert iscan.pos == 0
+        assert iscan.scan_input() == "e0"
+        iscan.undo_reading()
+        assert iscan.bof
+
+    def test_tokenize_events(self):
+
+        text = "foo 'fie fez' zig  'zàg'"
+        expected = [ "foo", "fie fez", "zig", "zàg" ]
+
+        assert nfa.InputScanner.tokenize(text) == expected
+        assert list(nfa.tokenize_events(text, chunk_size=3)) == expected
+        assert list(nfa.tokenize_events("  " + text + "  ")) == expected
+        assert list(nfa.tokenize_events("")) == []
+
+        # file objects and streams of chunks, events may span several chunks
+        assert list(nfa.tokenize_events(io.StringIO(text), chunk_size=2)) == expected
+        assert list(nfa.tokenize_events(io.BytesIO(text.encode("utf-8")), chunk_size=1)) == expected
+        assert list(nfa.tokenize_events([ b"foo 'fie", b" fez' zig  'z\xc3", b"\xa0g'" ])) == expected
+
+        # events are yielded as soon as they are read
+        events = nfa.tokenize_events(iter([ "foo fie ", "'fez" ]))
+        assert next(events) == "foo"
+        assert next(events) == "fie"
+        with self.assertRaises(Exception) as context:
+            next(events)
+
 
 
 class TestReiToNFA(TestCase):
@@ -1099,7 +1740,838 @@ class TestReiToNFA(TestCase):
         assert accepted == False, f"Received: {accepted}, {state}, {remaining}"
         assert not a.is_final(state)
         assert remaining == "zip zog foo fie fez"
-        
+
+    def test_parallel_translation(self):
+
+        r = rei.Conc(rei.Start(), rei.Union(
+            rei.Par(rei.Star(rei.Conc("a0", "b0")), rei.Union("c0", "d0", "e0")),
+            rei.Conc("f", rei.Par(rei.Star(rei.Conc("a1", "b1")), "c1")),
+            "g",
+        ), rei.End())
+        a = nfa.ReiToNFA(r)
+
+        class CountingExecutor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                CountingExecutor.submitted += 1
+                return super().submit(*args, **kwargs)
+
+        # the items with fewer symbols than min_size are translated in place
+        with CountingExecutor(max_workers=2) as executor:
+            b = nfa.ReiToNFA(r, executor=executor, min_size=3)
+        assert CountingExecutor.submitted == 2, f"Received: {CountingExecutor.submitted}"
+        assert b.fingerprint() == a.fingerprint()
+
+        with CountingExecutor(max_workers=2) as executor:
+            b = nfa.ReiToNFA(r, executor=executor)
+        assert CountingExecutor.submitted == 2
+        assert b.fingerprint() == a.fingerprint()
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            b = nfa.ReiToNFA(r, executor=executor, min_size=1)
+        assert b.fingerprint() == a.fingerprint()
+        assert b.check_traces([ "a0 b0 d0", "f c1 a1 b1", "g", "f" ]) == a.check_traces([ "a0 b0 d0", "f c1 a1 b1", "g", "f" ])
+
+        # the workers import the translation modules from scratch, without setting up Django
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+            b = nfa.ReiToNFA(r, executor=executor, min_size=1)
+        assert b.fingerprint() == a.fingerprint()
+
+        assert nfa.rei_size(r) == 12
+
+    def test_translation_cache(self):
+
+        def build(last : str):
+            return rei.Conc(rei.Start(), rei.Union(
+                rei.Par(rei.Star(rei.Conc("a0", "b0")), rei.Union("c0", "d0", "e0")),
+                rei.Conc("f", rei.Par(rei.Star(rei.Conc("a1", "b1")), "c1")),
+                last,
+            ), rei.End())
+
+        cache = nfa.TranslationCache()
+        a = nfa.ReiToNFA(build("g"), cache=cache)
+        assert a.fingerprint() == nfa.ReiToNFA(build("g")).fingerprint()
+        assert (cache.hits, cache.misses, len(cache)) == (0, 22, 22), f"Received: {cache}"
+
+        # the same structure (built anew) is found in the cache
+        assert nfa.ReiToNFA(build("g"), cache=cache) is a
+        assert (cache.hits, cache.misses) == (1, 22), f"Received: {cache}"
+
+        # only the changed node and the path to the root are translated
+        b = nfa.ReiToNFA(build("h"), cache=cache)
+        assert b.fingerprint() == nfa.ReiToNFA(build("h")).fingerprint()
+        assert (cache.hits, cache.misses) == (1 + 4, 22 + 3), f"Received: {cache}"
+        assert [ accepted for accepted, _ in b.check_traces([ "a0 b0 d0", "f c1 a1 b1", "h", "g" ]) ] == [ True, True, True, False ]
+        assert [ accepted for accepted, _ in a.check_traces([ "h", "g" ]) ] == [ False, True ]
+
+        # the cached automata are not changed by the nodes using them (Star)
+        cache = nfa.TranslationCache()
+        nfa.ReiToNFA(rei.Union(rei.Star(rei.Conc("a", "b")), "c"), cache=cache)
+        r = rei.Union(rei.Union(rei.Conc("a", "b")), "c")
+        assert nfa.ReiToNFA(r, cache=cache).fingerprint() == nfa.ReiToNFA(r).fingerprint()
+        assert cache.hits == 2, f"Received: {cache}"
+
+        # the least recently used automata are discarded
+        cache = nfa.TranslationCache(max_size=4)
+        nfa.ReiToNFA(build("g"), cache=cache)
+        assert len(cache) == 4
+        assert cache.get(build("g"), "") is not None
+        assert cache.get(rei.Symbol("a0"), "1.0.0.0.0.") is None
+
+        # the nodes shifted by an insertion are reused, with their states renamed
+        items = [ rei.Union(f"a{i}", rei.Conc(f"b{i}", f"c{i}")) for i in range(49) ]
+        cache = nfa.TranslationCache()
+        nfa.ReiToNFA(rei.Conc(*items), cache=cache)
+        cache.hits = cache.misses = 0
+        r = rei.Conc("x", *items)
+        a = nfa.ReiToNFA(r, cache=cache)
+        assert (cache.hits, cache.misses) == (49, 2), f"Received: {cache}"
+        b = nfa.ReiToNFA(r)
+        assert a.fingerprint() == b.fingerprint()
+        assert set(s.id for s in a.states) == set(s.id for s in b.states)
+        assert set(str(t) for t in a.transitions) == set(str(t) for t in b.transitions)
+
+        # the renamed automata are not shared with the cache
+        p = rei.Par(rei.Star(rei.Conc("p", "q")), "r")
+        cache = nfa.TranslationCache()
+        c = nfa.ReiToNFA(p, cache=cache)
+        d = nfa.ReiToNFA(p, prefix="1.", cache=cache)
+        assert d is not c and all(s.id.startswith("1.") for s in d.states)
+        assert [ accepted for accepted, _ in d.check_traces([ "p q r", "r p q p q", "p r" ]) ] == [ True, True, False ]
+
+    def test_par_product(self):
+
+        # only the product states reachable from the initial one are created
+        r = rei.Par(rei.Union("foo", "fie"), rei.Conc("zog", "zip"))
+        a = nfa.ReiToNFA(r)
+
+        # Union: 5 states, Conc: 4 states, all combinations reachable
+        assert len(a.states) == 5 * 4, f"Received: {len(a.states)}"
+
+        accepted, state, remaining = a.read_string("zog fie zip")
+        assert accepted == True, f"Received: {accepted}, {state}, {remaining}"
+
+        # loops inside the components are kept in the product
+        r = rei.Par(*[ rei.Star(rei.Conc(f"x{i}", f"y{i}")) for i in range(4) ])
+        a = nfa.ReiToNFA(r)
+
+        assert len(a.states) == 4 ** 4, f"Received: {len(a.states)}"
+
+        accepted, state, remaining = a.read_string("x0 x1 y0 x3 y1 x0 y3 y0")
+        assert accepted == True, f"Received: {accepted}, {state}, {remaining}"
+
+        accepted, state, remaining = a.read_string("x0 x1 y0 x3 y1 x0 y3")
+        assert accepted == False, f"Received: {accepted}, {state}, {remaining}"
+        assert remaining == ""
+
+        # nested Par (the composite ids contain the separator of the outer product)
+        r = rei.Par(rei.Par("foo", "fie"), rei.Conc("zog", "zip"))
+        a = nfa.ReiToNFA(r)
+
+        for s in [ "foo fie zog zip", "zog fie zip foo", "fie zog foo zip" ]:
+            accepted, state, remaining = a.read_string(s)
+            assert accepted == True, f"Received: {s}, {accepted}, {state}, {remaining}"
+
+        accepted, state, remaining = a.read_string("zip foo")
+        assert accepted == False
+        assert remaining == "zip foo"
+
+
+class TestFingerprint(TestCase):
+
+    def setUp(self):
+
+        c:Choreography = Choreography()
+        c.name = "diagram_gateways_nested"
+        c.resource = os.path.join(settings.MEDIA_ROOT, "diagram_gateways_nested.bpmn")
+        c.save()
+
+    def test_deterministic_ids(self):
+
+        r = rei.Conc(rei.Start(), "foo", rei.Star(rei.Union("fie", rei.Par("zig", "zag"))), rei.End())
+        a = nfa.ReiToNFA(r)
+        b = nfa.ReiToNFA(r)
+
+        assert set(s.id for s in a.states) == set(s.id for s in b.states)
+        assert set(map(str, a.transitions)) == set(map(str, b.transitions))
+        assert a.initial.id == "0.e"
+        assert "1.i" in set(s.id for s in a.states)
+
+        # ids derive from the positions in the REI, so equal items at different positions do not clash
+        a = nfa.ReiToNFA(rei.Union("foo", "foo"))
+        assert set(s.id for s in a.states) == { "u", "0.i", "0.f", "1.i", "1.f" }
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        assert c.to_nfa().fingerprint() == c.to_nfa().fingerprint()
+        assert c.to_nfa("glushkov").fingerprint() == c.to_nfa("glushkov").fingerprint()
+
+        i = interleaving.InterleavingNFA(c.to_rei())
+        ids = [ s.id for s in i.states ]
+        assert len(ids) == len(set(ids)), f"Received: {ids}"
+        assert i.fingerprint() == interleaving.InterleavingNFA(c.to_rei()).fingerprint()
+
+    def test_fingerprint(self):
+
+        r = rei.Conc("foo", rei.Union("fie", "zig"))
+        a = nfa.ReiToNFA(r)
+        f = a.fingerprint()
+
+        assert len(f) == 64
+        assert f == nfa.ReiToNFA(r).fingerprint()
+        assert f != nfa.ReiToNFA(rei.Conc("foo", rei.Union("fie", "zag"))).fingerprint()
+        assert f != a.remove_epsilons().fingerprint()
+
+        # changes to the automaton change its fingerprint
+        a.add_final("1.u")
+        assert a.fingerprint() != f
+
+        # the minimal DFA only depends on the language
+        g = nfa.ReiToGlushkovNFA(r)
+        assert g.fingerprint() != f
+        assert g.to_dfa().minimize().fingerprint() == nfa.ReiToNFA(r).to_dfa().minimize().fingerprint()
+        assert nfa.ReiToNFA(rei.Union(rei.Conc("foo", "fie"), rei.Conc("foo", "zig"))).to_dfa().minimize().fingerprint() == g.to_dfa().minimize().fingerprint()
+
+
+class TestSerialization(TestCase):
+
+    def setUp(self):
+
+        c:Choreography = Choreography()
+        c.name = "diagram_gateways_nested"
+        c.resource = os.path.join(settings.MEDIA_ROOT, "diagram_gateways_nested.bpmn")
+        c.save()
+
+    def test_round_trip(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        data = serialization.dumps(a)
+        assert data[:4] == serialization.MAGIC
+        assert not serialization.is_deterministic(data)
+
+        compact = serialization.loads(data)
+        assert compact.num_states == a.freeze().num_states
+        assert compact.num_transitions == a.freeze().num_transitions
+        assert compact.id(compact.initial) == a.initial.id
+        assert isinstance(compact._edge_targets, memoryview)
+
+        b = compact.to_nfa()
+        assert b.fingerprint() == a.fingerprint()
+        assert b.freeze() is compact
+        assert b.symbols.code(b.transitions[0].label) == a.symbols.code(b.transitions[0].label)
+
+        traces = [ [ label for _, label in a.symbols ], [ "foo" ] ]
+        assert b.check_traces(traces) == a.check_traces(traces)
+
+        # DFAs are stored as deterministic NFAs
+        d = a.to_dfa()
+        data = serialization.dumps(d)
+        assert serialization.is_deterministic(data)
+        assert serialization.loads(data).to_nfa().fingerprint() == d.to_nfa().fingerprint()
+
+        with self.assertRaises(ValueError):
+            serialization.dumps(interleaving.InterleavingNFA(c.to_rei()))
+
+    def test_load(self):
+
+        a = nfa.ReiToNFA(rei.Conc("foo", rei.Star(rei.Union("fié", rei.Par("zig", "zag")))))
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "automaton.nfa")
+            serialization.dump(a, path)
+
+            compact = serialization.load(path)
+            assert compact.to_nfa().fingerprint() == a.fingerprint()
+            assert compact.label(compact.code("fié")) == "fié"
+            assert compact.step(compact.closure(compact.initial), compact.code("foo"))
+
+    def test_errors(self):
+
+        data = serialization.dumps(nfa.ReiToNFA(rei.Conc("foo", "fie")))
+
+        with self.assertRaises(ValueError):
+            serialization.loads(b"XXXX" + data[4:])
+
+        with self.assertRaises(ValueError):
+            serialization.loads(data[:4] + bytes([ serialization.VERSION + 1, 0 ]) + data[6:])
+
+        with self.assertRaises(ValueError):
+            serialization.loads(data[:-1])
+
+        with self.assertRaises(ValueError):
+            serialization.loads(data[:10])
+
+
+class TestReiToGlushkovNFA(TestCase):
+
+    def test_positions(self):
+
+        r = rei.Conc(rei.Start(), "foo", rei.Star(rei.Union("fie", rei.Conc("zig", "zag"))), "foo", rei.End())
+        a = nfa.ReiToGlushkovNFA(r)
+
+        # one state per symbol occurrence, plus the initial one
+        assert [ s.id for s in a.states ] == [ f"g{i}" for i in range(6) ], f"Received: {list(map(str, a.states))}"
+        assert a.initial.id == "g0"
+        assert not a.has_epsilons
+        assert set(s.id for s in a.final) == { "g5" }
+
+        # all the transitions entering a position share its symbol
+        for s in a.states:
+            assert len(set(t.label for t in a.transitions_to(s))) <= 1
+
+        for string, expected in [ ("foo foo", True), ("foo fie zig zag fie foo", True), ("foo zig foo", False), ("", False) ]:
+            accepted, _, _ = a.read_string(string)
+            assert accepted == expected, f"Received: {string}"
+
+        # the translation is deterministic
+        b = nfa.ReiToGlushkovNFA(r)
+        assert set(map(str, a.transitions)) == set(map(str, b.transitions))
+
+    def test_epsilon(self):
+
+        r = rei.Union(rei.Epsilon(), rei.Conc(rei.Start(), "foo", rei.End()))
+        a = nfa.ReiToGlushkovNFA(r)
+
+        assert len(a.states) == 2
+        assert a.is_final(a.initial)
+        assert a.read_string("")[0]
+        assert a.read_string("foo")[0]
+
+    def test_star(self):
+
+        r = rei.Star(rei.Conc(rei.Star(rei.Symbol("foo")), "fie"))
+        a = nfa.ReiToGlushkovNFA(r)
+
+        for string, expected in [ ("", True), ("fie", True), ("foo foo fie fie", True), ("foo", False), ("fie foo", False) ]:
+            accepted, _, _ = a.read_string(string)
+            assert accepted == expected, f"Received: {string}"
+
+    def test_par(self):
+
+        r = rei.Conc("foo", rei.Par(rei.Conc("zig", "zag"), rei.Star(rei.Symbol("bar")), rei.Par("x", "y")), "fie")
+        a = nfa.ReiToGlushkovNFA(r)
+        b = nfa.ReiToNFA(r)
+
+        assert not a.has_epsilons
+
+        for string in [ "foo zig zag x y fie", "foo bar zig x bar zag y fie", "foo y zig x zag fie", "foo zig x y fie", "foo zag zig x y fie", "foo fie" ]:
+            expected, _, _ = b.read_string(string)
+            accepted, _, _ = a.read_string(string)
+            assert accepted == expected, f"Received: {string}"
+
+
+class TestInterleavingNFA(TestCase):
+
+    def accepts(self, a, string):
+        configuration = a.initial_configuration
+        for label in string.split(" ") if string else []:
+            configuration = a.step(configuration, label)
+
+        return a.is_accepting(configuration)
+
+    def test_par(self):
+
+        r = rei.Conc("foo", rei.Par(rei.Conc("zig", "zag"), rei.Union("bar", "baz"), "zog"), "fie")
+        a = interleaving.InterleavingNFA(r)
+        b = nfa.ReiToNFA(r)
+
+        assert len(a.boxes) == 1
+        assert a.alphabet == { "foo", "zig", "zag", "bar", "baz", "zog", "fie" }
+
+        for string in [ "", "foo", "foo zig zag bar zog fie", "foo zog baz zig zag fie", "foo zig bar zag zog fie",
+                        "foo zig zag bar baz zog fie", "foo zag zig bar zog fie", "foo zig zag bar zog" ]:
+            accepted, _, _ = b.read_string(string)
+            assert self.accepts(a, string) == accepted, f"Received: {string}"
+
+        # the current states of every branch are kept apart
+        configuration = a.step(a.step(a.initial_configuration, "foo"), "zig")
+        assert len(a.step(configuration, "fie")) == 0
+        assert len(a.step(configuration, "zig")) == 0
+
+        # the states are clustered by component
+        assert a.component_prefix("1.0.0.i") == "1.0."
+        assert a.component_prefix("1.2.f") == "1.2."
+        assert a.component_prefix("0.i") is None
+        assert len(a._components) == len(a.states) - len(a.skeleton.states)
+
+        # the labels are interned without building the product automaton
+        a.to_nfa = None
+        assert set(a.event_dictionary.values()) == a.alphabet
+        assert [ label for _, label in a.symbols ][:2] == [ "foo", "fie" ], f"Received: {list(a.symbols)}"
+
+    def test_par_loop(self):
+
+        # the box can be entered again, while a previous entry is still final
+        r = rei.Star(rei.Par("foo", "fie"))
+        a = interleaving.InterleavingNFA(r)
+
+        for string, expected in [ ("", True), ("foo fie", True), ("fie foo foo fie", True), ("foo fie foo", False), ("foo foo", False) ]:
+            assert self.accepts(a, string) == expected, f"Received: {string}"
+
+    def test_par_shared_labels(self):
+
+        # a label shared by two branches cannot be dispatched: the product is built instead
+        r = rei.Par(rei.Conc("foo", "fie"), "foo", rei.Par("zig", "zag"))
+        a = interleaving.InterleavingNFA(r)
+
+        assert len(a.boxes) == 0
+        for string, expected in [ ("foo foo fie zig zag", True), ("foo fie foo zag zig", True), ("foo fie zig zag", False) ]:
+            assert self.accepts(a, string) == expected, f"Received: {string}"
+
+        # nested independent Par
+        r = rei.Par(rei.Conc("foo", "fie"), rei.Par("zig", "zag"))
+        a = interleaving.InterleavingNFA(r)
+
+        assert len(a.boxes) == 1
+        assert self.accepts(a, "zag foo zig fie")
+        assert not self.accepts(a, "zag foo zig")
+
+    def test_wide_par(self):
+
+        # the product automaton of these branches would have 6^8 states
+        n = 8
+        r = rei.Par(*[ rei.Conc(f"a{i}", f"b{i}", f"c{i}") for i in range(n) ])
+        a = interleaving.InterleavingNFA(r)
+
+        assert len(a.states) < 100, f"Received: {len(a.states)}"
+
+        string = " ".join([ f"a{i}" for i in range(n) ] + [ f"b{i} c{i}" for i in reversed(range(n)) ])
+        assert self.accepts(a, string)
+        assert not self.accepts(a, string.replace(" c0", ""))
+
+
+class TestDFA(TestCase):
+
+    def test_subset_construction(self):
+
+        r = rei.Conc(rei.Star(rei.Union(
+                        rei.Conc("foo", "fie"), 
+                        rei.Conc("foo", "fie", "fez"))), 
+                    "zog")
+
+        a = nfa.ReiToNFA(r)
+        d = a.to_dfa()
+
+        assert isinstance(d, dfa.DFA)
+        assert d.nfa_states(d.initial) == a.e_closure(a.initial)
+
+        for text in [ "", "zog", "foo fie zog", "foo fie fez zog", "foo fie foo fie fez zog", "foo zog", "foo fie fez", "zog zog" ]:
+            accepted, state, remaining = a.read_string(text)
+            d_accepted, d_state = d.read(text.split())
+
+            assert accepted == d_accepted, f"Input: {text}. Received: {accepted}, {d_accepted}"
+
+        # after "foo fie" the NFA may be at the end of either branch of the union
+        _, d_state = d.read([ "foo", "fie" ])
+        assert set(d.labels(d_state)) == set([ "foo", "fez", "zog" ]), f"Received: {list(d.labels(d_state))}"
+
+        assert d.step(d.initial, "fie") is None
+
+        # the same automaton always yields the same DFA
+        assert d.transitions == a.to_dfa().transitions
+
+    def test_empty_automaton(self):
+
+        with self.assertRaises(Exception) as context:
+            nfa.NFA().to_dfa()
+
+    def test_minimize(self):
+
+        r = rei.Star(rei.Union(rei.Conc("foo", "fie"), rei.Conc("foo", "fie"), rei.Conc("foo", "fez")))
+        a = nfa.ReiToNFA(r)
+
+        d = a.to_dfa()
+        m = d.minimize()
+
+        # initial/final state, and the state after reading "foo"
+        assert m.num_states == 2, f"Received: {m}"
+        assert m.num_states < d.num_states
+        assert m.is_final(m.initial)
+
+        for text in [ "", "foo", "foo fie", "foo fez foo fie", "foo foo", "fie" ]:
+            accepted, _ = d.read(text.split())
+            m_accepted, _ = m.read(text.split())
+            assert accepted == m_accepted, f"Input: {text}. Received: {accepted}, {m_accepted}"
+
+        # every state of the minimal DFA maps back to the original NFA states
+        all_ids = set(map(lambda s: s.id, a.states))
+        merged = set()
+        for s in m.states:
+            assert m.nfa_states(s).issubset(all_ids)
+            merged.update(m.nfa_states(s))
+        assert m.nfa_states(m.initial).issuperset(a.e_closure(a.initial))
+
+        # the minimal automaton as an NFA
+        b = a.minimize()
+        assert len(b.states) == 2 and len(b.transitions) == 3, f"Received: {b}"
+        accepted, states, remaining = b.read_string("foo fez foo fie")
+        assert accepted and remaining == ""
+
+        accepted, states, remaining = b.read_string("foo zog")
+        assert not accepted and remaining == "zog"
+
+    def test_minimize_dead_states(self):
+        s1 = nfa.State("s1")
+        s2 = nfa.State("s2")
+        s3 = nfa.State("s3")
+
+        a = nfa.NFA()
+        a.add_state(s1)
+        a.add_state(s2, is_final=True)
+        a.add_state(s3)
+        a.set_initial(s1)
+
+        # s3 cannot reach any final state
+        a.add_transition(s1, s2, "a")
+        a.add_transition(s1, s3, "b")
+
+        m = a.to_dfa().minimize()
+        assert m.num_states == 2, f"Received: {m}"
+        assert m.step(m.initial, "b") is None
+
+        # empty language
+        a.set_final()
+        m = a.to_dfa().minimize()
+        assert m.num_states == 1 and m.num_transitions == 0, f"Received: {m}"
+        assert not m.is_final(m.initial)
+
+    def test_lazy_dfa(self):
+
+        r = rei.Star(rei.Union(rei.Conc("foo", "fie"), rei.Conc("foo", "fez"), "zog"))
+        a = nfa.ReiToNFA(r)
+
+        d = dfa.LazyDFA(a, max_states=2)
+        assert d.nfa_states(d.initial) == a.e_closure(a.initial)
+        assert d.is_final(d.initial)
+
+        s1 = d.step(d.initial, "foo")
+        assert d.nfa_states(s1) == a.e_closure(set().union(*[ a.read_symbol("foo", s) for s in a.e_closure(a.initial) ]))
+        assert not d.is_final(s1)
+        assert d.stats["misses"] == 1 and d.stats["hits"] == 0, f"Received: {d.stats}"
+
+        # the same step is now memoized
+        assert d.step(d.initial, "foo") is s1
+        assert d.stats["misses"] == 1 and d.stats["hits"] == 1, f"Received: {d.stats}"
+
+        # not enabled labels lead to the empty set
+        assert d.step(s1, "zog") == frozenset()
+
+        s2 = d.step(s1, "fez")
+        assert d.is_final(s2)
+        assert d.stats["states"] <= 2, f"Received: {d.stats}"
+        assert d.stats["evictions"] > 0, f"Received: {d.stats}"
+
+        # evicted transitions are computed again, with the same result
+        misses = d.stats["misses"]
+        assert d.step(d.initial, "foo") == s1
+        assert d.stats["misses"] == misses + 1, f"Received: {d.stats}"
+
+        with self.assertRaises(ValueError) as context:
+            dfa.LazyDFA(a, max_states=0)
+
+
+class TestEngineOffChain(TestCase):
+
+    def setUp(self):
+
+        choreographies = [
+            ("diagram", "diagram.bpmn", ),
+            ("diagram_gateways_nested", "diagram_gateways_nested.bpmn", ),
+        ]
+
+        for name, filename in choreographies:
+            c:Choreography = Choreography()
+            c.name = name
+            c.resource = os.path.join(settings.MEDIA_ROOT, filename)
+            c.save()
+
+    def run_events(self, engine, events):
+        engine.set_debug(False)
+
+        res = []
+        for event in events.split(" "):
+            out = engine.process_input(event)
+            res.append((out, engine.get_curr_states(), engine.ended()))
+
+            while True:
+                out = engine.process_check()
+                if not out:
+                    break
+                res.append((out, engine.get_curr_states(), engine.ended()))
+
+        return res
+
+    def test_modes(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        events = "Delivery_Boy?Message_08qtv9f Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Customer?Message_1fakyw2 Pizza_Place!foo"
+
+        expected = self.run_events(EngineOffChain(a), events)
+        assert expected[-1][2], f"Received: {expected}"
+
+        for mode in [ "nfa", "bitmask", "dfa", "lazy_dfa" ]:
+            e = EngineOffChain.create(a, mode)
+            assert e.get_curr_states() == a.e_closure(a.initial)
+
+            received = self.run_events(e, events)
+            assert received == expected, f"Mode: {mode}. Received: {received}"
+
+        assert isinstance(EngineOffChain.create(a, "dfa"), EngineOffChainDFA)
+        assert isinstance(EngineOffChain.create(a, "lazy_dfa"), EngineOffChainLazyDFA)
+        assert EngineOffChain(a).get_cache_stats() is None
+
+        e = EngineOffChainLazyDFA(a, max_states=1)
+        self.run_events(e, events)
+        assert e.ended()
+        assert e.get_cache_stats()["evictions"] > 0, f"Received: {e.get_cache_stats()}"
+
+        # reading an event is a single lookup of the cache
+        e = EngineOffChainLazyDFA(a)
+        self.run_events(e, "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx")
+        stats = e.get_cache_stats()
+        assert stats["hits"] + stats["misses"] == 2, f"Received: {stats}"
+
+        with self.assertRaises(ValueError) as context:
+            EngineOffChain.create(a, "foo")
+
+    def test_nd_factor(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        for mode in [ "nfa", "bitmask", "dfa" ]:
+            e = EngineOffChain.create(a, mode)
+            e.set_debug(False)
+            assert e.get_nd_factor() is None
+
+            num_states_pre = len(e.get_curr_states())
+            e.process_input("Pizza_Place?pizza_order")
+            assert e.get_nd_factor() == (len(e.get_curr_states()) - num_states_pre) / num_states_pre, f"Mode: {mode}. Received: {e.get_nd_factor()}"
+
+            # events that are not read do not have a factor
+            e.process_input("Pizza_Place!foo")
+            assert e.get_nd_factor() is None
+
+            e.process_input("Delivery_Boy?Message_08qtv9f")
+            assert e.get_nd_factor() is None
+
+            e.process_input("Delivery_Boy?Message_1mi4idx")
+            e.process_input("Customer?pizza")
+            e.process_input("Delivery_Boy?Message_0oddh8c")
+            assert e.process_check() == "Delivery_Boy?Message_08qtv9f"
+            assert e.get_nd_factor() is not None
+
+    def test_write_dot(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        for e in [ EngineOffChain.create(a, "nfa"), EngineOffChain.create(a, "dfa"), EngineOffChainInterleaving(interleaving.InterleavingNFA(c.to_rei())) ]:
+            e.set_debug(False)
+            e.process_input("Pizza_Place?pizza_order")
+            e.process_input("Delivery_Boy?Message_1mi4idx")
+
+            out = io.StringIO()
+            e.write_dot(out)
+            text = out.getvalue()
+            assert text.count(" -> ") == len(e.nfa.transitions)
+            assert text.count("fillcolor=red") == len(e.get_curr_states()), f"Received: {text}"
+
+            out = io.StringIO()
+            e.write_dot(out, 1)
+            text = out.getvalue()
+            assert text.count("fillcolor=red") == len(e.get_curr_states())
+            assert text.count('[label=""') == len(nfa.neighbourhood(e.nfa, e.get_curr_states(), 1))
+            assert text.count('[label=""') < len(e.nfa.states)
+
+            # the labels are written by the short names of the event dictionary
+            dictionary = e.nfa.event_dictionary
+            assert dictionary["A"] == "Pizza_Place?pizza_order", f"Received: {dictionary}"
+            assert "?" not in text, f"Received: {text}"
+
+    def test_minimal_dfa(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+        e = EngineOffChain.create(a, "nfa")
+
+        # the minimal DFA is only computed on request, and then kept with the engine
+        assert e.get_minimal_dfa() is None
+        d = e.get_minimal_dfa(compute=True)
+        assert d.fingerprint() == a.to_dfa().minimize().fingerprint()
+        assert e.get_minimal_dfa() is d
+
+        e = pickle.loads(pickle.dumps(e))
+        assert e.get_minimal_dfa().fingerprint() == d.fingerprint()
+
+    def test_enabled_labels(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        e = EngineOffChain(a)
+        e.set_debug(False)
+        labels = lambda: set(map(a.symbols.label, e._enabled_codes()))
+        assert labels() == { "Pizza_Place?pizza_order" }
+
+        # the engine keeps the current states as indexes of the compact automaton
+        assert all(isinstance(i, int) for i in e._curr_states)
+
+        e.process_input("Pizza_Place?pizza_order")
+        assert labels() == { "Pizza_Place?Message_0rkgt7n", "Delivery_Boy?Message_1mi4idx" }, f"Received: {labels()}"
+        assert e.condition_rule_receive_now("Delivery_Boy?Message_1mi4idx")
+        assert not e.condition_rule_receive_now("Customer?pizza")
+
+        # buffered messages are checked against the same set
+        e.process_input("Customer?pizza")
+        assert e.process_check() is None
+        e.process_input("Delivery_Boy?Message_1mi4idx")
+        assert e.process_check() == "Customer?pizza"
+        assert "Customer?pizza" not in labels()
+        assert e.get_curr_states() == pickle.loads(pickle.dumps(e)).get_curr_states()
+
+    def test_bitmask(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        e = EngineOffChain.create(a, "bitmask")
+        assert isinstance(e, EngineOffChainBitmask)
+        assert isinstance(e._curr_states, int)
+
+        initial = a.e_closure(a.initial)
+        for s in a.states:
+            assert e.is_state_current(s) == (s.id in initial), f"Received: {s}"
+        assert not e.is_state_current("foo")
+
+        self.run_events(e, "Delivery_Boy?Message_08qtv9f Pizza_Place?pizza_order")
+        assert e.get_curr_states() != initial
+
+        # the state numbering is rebuilt identically when the engine is unpickled
+        e_copy = pickle.loads(pickle.dumps(e))
+        assert e_copy.get_curr_states() == e.get_curr_states()
+        assert isinstance(e_copy._curr_states, int)
+
+        received = self.run_events(e_copy, "Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Customer?Message_1fakyw2")
+        assert e_copy.ended(), f"Received: {received}"
+
+        # reading an event steps the whole mask once, the states are only visited to be logged
+        compact = a.freeze()
+        masks = []
+        step_mask = compact.step_mask
+        compact.step_mask = lambda mask, code: masks.append(mask) or step_mask(mask, code)
+        e = EngineOffChain.create(a, "bitmask")
+        self.run_events(e, "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx")
+        assert len(masks) == 2, f"Received: {masks}"
+
+        e = EngineOffChain.create(a, "bitmask")
+        logged = []
+        e._debug_log = logged.append
+        e.process_input("Pizza_Place?pizza_order")
+        assert any("has been discarded" in line for line in logged), f"Received: {logged}"
+        del compact.step_mask
+
+    def test_stored_automaton(self):
+        from engine.models import RunningInstance
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+        events = "Delivery_Boy?Message_08qtv9f Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Customer?Message_1fakyw2"
+
+        with tempfile.TemporaryDirectory() as folder:
+            for mode in [ "nfa", "bitmask" ]:
+                e = EngineOffChain.create(a, mode)
+                expected = self.run_events(EngineOffChain.create(a, mode), events)
+                pickled = pickle.dumps(e)
+
+                e.store_automaton(folder)
+                assert len(pickle.dumps(e)) < len(pickled) // 4, f"Received: {len(pickle.dumps(e))}"
+
+                # the unpickled engine runs on the mapped file, without rebuilding the NFA
+                e_copy = pickle.loads(pickle.dumps(e))
+                assert e_copy._nfa is None and e_copy._compact is not None
+                assert e_copy.get_curr_states() == e.get_curr_states()
+                assert self.run_events(e_copy, events) == expected
+                assert e_copy._nfa is None
+
+                # the engines of the same automaton share the file and the mapped arrays
+                assert len(os.listdir(folder)) == 1
+                assert pickle.loads(pickle.dumps(e))._compact is e_copy._compact
+
+                # the minimal DFA is pickled without the NFA, which is set again on request
+                d = e.get_minimal_dfa(compute=True)
+                e_copy = pickle.loads(pickle.dumps(e))
+                assert e.get_minimal_dfa().nfa is a and e_copy._nfa is None
+                assert e_copy.get_minimal_dfa().fingerprint() == d.fingerprint()
+                assert e_copy.get_minimal_dfa().nfa is e_copy.nfa
+
+                # the NFA is rebuilt on request
+                assert e_copy.nfa.fingerprint() == a.fingerprint()
+                assert len(e_copy.get_all_states()) == len(a.states)
+
+            with self.assertRaises(ValueError):
+                EngineOffChain.create(a, "dfa").store_automaton(folder)
+
+            # the running instances keep the path of their automaton
+            with override_settings(ENGINE_AUTOMATA_DIR=folder):
+                i = RunningInstance(choreography=c)
+                i.save()
+
+            i = RunningInstance.objects.get(pk=i.pk)
+            assert i.enforcer.engine._automaton_path.startswith(folder)
+            assert i.enforcer.engine._nfa is None
+            assert i.enforcer.engine.get_curr_states() == EngineOffChain(a).get_curr_states()
+
+    def test_interleaving(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        r = c.to_rei()
+
+        events = "Delivery_Boy?Message_08qtv9f Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Customer?Message_1fakyw2 Pizza_Place!foo"
+
+        expected = self.run_events(EngineOffChain(nfa.ReiToNFA(r)), events)
+
+        a = interleaving.InterleavingNFA(r)
+        e = EngineOffChain.create(a, "interleaving")
+        assert isinstance(e, EngineOffChainInterleaving)
+        assert e.get_curr_states() == a.active_states(a.initial_configuration)
+
+        received = self.run_events(e, events)
+        assert [ (out, ended) for out, _, ended in received ] == [ (out, ended) for out, _, ended in expected ], f"Received: {received}"
+        assert e.ended()
+
+        for s in e.get_curr_states():
+            assert e.is_state_current(s)
+
+        # the enforcer runs on top of the engine as usual
+        e = Enforcer(EngineOffChainInterleaving(a))
+        e.set_debug(False)
+        e.engine.set_debug(False)
+        for event in events.split(" "):
+            e.process_input(event)
+            while e.process_check():
+                pass
+        assert e.ended()
+
+        e_copy = pickle.loads(pickle.dumps(e))
+        assert e_copy.engine.get_curr_states() == e.engine.get_curr_states()
+
+        with self.assertRaises(AssertionError) as context:
+            EngineOffChain.create(nfa.ReiToNFA(r), "interleaving")
+
+        # reading an event takes a single step of the automaton
+        a = interleaving.InterleavingNFA(r)
+        e = EngineOffChain.create(a, "interleaving")
+        steps = []
+        step = a.step
+        a.step = lambda *args: steps.append(args[1]) or step(*args)
+        self.run_events(e, "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx")
+        assert steps == [ "Pizza_Place?pizza_order", "Delivery_Boy?Message_1mi4idx" ], f"Received: {steps}"
+
 
 class TestChoToNFA(TestCase):
 
@@ -1206,6 +2678,80 @@ class TestChoToNFA(TestCase):
         assert not a.is_final(state)
         assert remaining == ""
 
+    def test_translators(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+
+        a = c.to_nfa("thompson")
+        g = c.to_nfa("glushkov")
+
+        assert not g.has_epsilons
+        assert len(g.states) < len(a.states), f"Received: {g} (glushkov), {a} (thompson)"
+
+        traces = [
+            "Pizza_Place?pizza_order Pizza_Place?Message_0rkgt7n",
+            "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Delivery_Boy?Message_08qtv9f Customer?Message_1fakyw2",
+            "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Customer?pizza Delivery_Boy?Message_0oddh8c Customer?Message_1fakyw2",
+            "Pizza_Place?pizza_order Delivery_Boy?Message_1mi4idx Pizza_Place?Message_0rkgt7n",
+        ]
+        assert g.check_traces(traces) == a.check_traces(traces), f"Received: {g.check_traces(traces)}"
+
+        # the translated automata have no useless states
+        assert c.to_nfa("thompson", trim=False).fingerprint() == a.fingerprint()
+        assert c.to_nfa("glushkov", trim=False).fingerprint() == g.fingerprint()
+
+        with self.assertRaises(ValueError) as context:
+            c.to_nfa("foo")
+
+    def test_translation_cache(self):
+        import bpmn_parser.models
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa("thompson", trim=False)
+
+        bpmn_parser.models._translation_cache = None
+        try:
+            with override_settings(NFA_CACHE_SIZE=256):
+                cache = bpmn_parser.models.translation_cache()
+
+                b = c.to_nfa("thompson", trim=False)
+                assert b.fingerprint() == a.fingerprint()
+                assert cache.hits == 0 and len(cache) > 0, f"Received: {cache}"
+
+                # translated again, the whole automaton is reused (and copied, since it is not trimmed)
+                b.add_state(nfa.State("foo"))
+                assert c.to_nfa("thompson", trim=False).fingerprint() == a.fingerprint()
+                assert cache.hits == 1, f"Received: {cache}"
+
+                assert c.to_nfa("thompson").fingerprint() == c.to_nfa("thompson", trim=False).trim()[0].fingerprint()
+        finally:
+            bpmn_parser.models._translation_cache = None
+
+    def test_translation_executor(self):
+        import bpmn_parser.models
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+
+        bpmn_parser.models._translation_executor = None
+        try:
+            with override_settings(NFA_WORKERS=2):
+                # the REI is too small to be translated in parallel: no process is started
+                assert c.to_nfa().fingerprint() == a.fingerprint()
+                assert bpmn_parser.models._translation_executor is None
+
+                # a single pool of spawned processes is shared by the translations
+                executor = bpmn_parser.models.translation_executor()
+                assert executor is bpmn_parser.models.translation_executor()
+                assert executor._mp_context.get_start_method() == "spawn"
+
+                r = rei.Union(*[ rei.Conc(*[ f"a{i}_{j}" for j in range(nfa.PARALLEL_MIN_SIZE) ]) for i in range(2) ])
+                assert nfa.ReiToNFA(r, executor=executor).fingerprint() == nfa.ReiToNFA(r).fingerprint()
+        finally:
+            if bpmn_parser.models._translation_executor is not None:
+                bpmn_parser.models._translation_executor.shutdown()
+            bpmn_parser.models._translation_executor = None
+
 
 class TestEnforcer(TestCase):
 
@@ -1425,6 +2971,51 @@ class TestContracts(TestCase):
             c.save()
 
 
+    def test_minimized_nfa_contract(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+        m = a.minimize()
+
+        assert len(m.states) < len(a.states), f"Received: {m} (minimal), {a} (original)"
+
+        contract = generator.NFAContractGenerator(a).createContract().compile()
+        contract_min = generator.NFAContractGenerator(m).createContract().compile()
+
+        assert len(contract_min) < len(contract)
+
+    def test_epsilon_free_nfa_contract(self):
+
+        c:Choreography = Choreography.objects.get(name="diagram_gateways_nested")
+        a = c.to_nfa()
+        b = a.remove_epsilons()
+
+        loop = "transitions[tmpStates[i]][epsilon]"
+
+        contract = generator.NFAContractGenerator(a).createContract().compile()
+        contract_free = generator.NFAContractGenerator(b).createContract().compile()
+
+        assert loop in contract
+        assert loop not in contract_free
+        assert "function e_closure" in contract_free
+
+    def test_enabled_labels_contract(self):
+
+        a = nfa.ReiToNFA(rei.Conc("foo", rei.Union("fie", "fez")))
+
+        nfa_contract = generator.NFAContractGenerator(a).createContract()
+        compiled = nfa_contract.compile()
+
+        assert "function updateEnabled" in compiled
+        assert "return enabled[symbol];" in compiled
+        assert "labels['0.i'] = ['foo'];" in compiled
+        # epsilon transitions do not enable labels
+        assert "labels['1.u']" not in compiled
+
+        enforcer_contract = generator.EnforcerContractGenerator(nfa_contract).createContract().compile()
+        assert "nfa.checkEnabledTransitions(message)" in enforcer_contract
+        assert "nfa.transitionFrom" not in enforcer_contract
+
     def test_variables(self):
 
         v = contracts.Variable("foo", "uint8")
@@ -0,0 +1,433 @@
+from collections import deque, OrderedDict
+from nfa import NFA, CompactNFA, State, canonical_hash
+
+
+"""
+Deterministic automaton obtained from an NFA by subset construction (see NFAToDFA).
+
+Each state of the DFA is identified by an integer index and stands for a set of states of the
+originating NFA, closed under epsilon transitions. Missing transitions lead to an implicit
+dead state, which is not materialized: step returns None.
+"""
+class DFA:
+
+    def __init__(self, automaton : NFA):
+        self._nfa = automaton
+        self._states = []           # index -> frozenset of NFA state ids
+        self._index = {}            # frozenset of NFA state ids -> index
+        self._transitions = []      # index -> { label : index }
+        self._final = set()
+        self._initial : int = None
+
+    def __str__(self):
+        return f"{self.num_states} states, {self.num_transitions} transitions, initial: {self._initial}, {len(self._final)} final states"
+
+    @property
+    def nfa(self) -> NFA:
+        return self._nfa
+
+    @property
+    def num_states(self) -> int:
+        return len(self._states)
+
+    @property
+    def num_transitions(self) -> int:
+        return sum(map(len, self._transitions))
+
+    @property
+    def states(self):
+        return range(len(self._states))
+
+    @property
+    def initial(self) -> int:
+        return self._initial
+
+    @property
+    def final(self) -> set:
+        return self._final
+
+    def set_initial(self, state : int):
+        self._initial = state
+
+    def add_state(self, nfa_states : frozenset, is_final : bool = False) -> int:
+        index = len(self._states)
+        self._states.append(nfa_states)
+        self._index.setdefault(nfa_states, index)
+        self._transitions.append({})
+
+        if is_final:
+            self._final.add(index)
+
+        return index
+
+    def add_transition(self, source : int, label : str, target : int):
+        prev = self._transitions[source].get(label)
+        if prev is not None and prev != target:
+            raise Exception(f"Non deterministic transition: {source} -[{label}]-> {prev}, {target}")
+
+        self._transitions[source][label] = target
+
+    """
+    Return the index of the DFA state standing for the passed set of NFA state ids, None if
+    no such state exists
+    """
+    def index(self, nfa_states) -> int:
+        return self._index.get(frozenset(nfa_states))
+
+    """
+    Return the (epsilon-closed) set of NFA state ids the passed DFA state stands for
+    """
+    def nfa_states(self, state : int) -> frozenset:
+        return self._states[state]
+
+    def is_final(self, state : int) -> bool:
+        return state in self._final
+
+    """
+    Return the state reached by reading the passed label, None if the label is not enabled
+    """
+    def step(self, state : int, label : str) -> int:
+        return self._transitions[state].get(label)
+
+    """
+    Return the labels enabled in the passed state
+    """
+    def labels(self, state : int):
+        return self._transitions[state].keys()
+
+    """
+    Return the transitions of the automaton, as (source, label, target) triples
+    """
+    @property
+    def transitions(self):
+        res = []
+        for source, transitions in enumerate(self._transitions):
+            for label, target in transitions.items():
+                res.append((source, label, target))
+
+        return res
+
+    """
+    Return the fingerprint of the automaton (see NFA.fingerprint). The states of the minimal DFA
+    are numbered canonically, so its fingerprint only depends on the recognized language.
+    """
+    def fingerprint(self) -> str:
+        return canonical_hash({
+            "states": self.num_states,
+            "initial": self._initial,
+            "final": sorted(self._final),
+            "transitions": sorted([ source, label, target ] for source, label, target in self.transitions),
+        })
+
+    """
+    Return the minimal DFA recognizing the same language (see MinimizeDFA)
+    """
+    def minimize(self):
+        return MinimizeDFA(self)
+
+    """
+    Return the automaton as an (epsilon-free, deterministic) NFA, whose states are named after
+    the passed prefix and the index of the DFA states
+    """
+    def to_nfa(self, prefix : str = "d") -> NFA:
+        res = NFA()
+
+        states = [ State(f"{prefix}{i}") for i in self.states ]
+        for i, s in enumerate(states):
+            res.add_state(s, is_final=self.is_final(i))
+
+        for source, label, target in self.transitions:
+            res.add_transition(states[source], states[target], label)
+
+        if self._initial is not None:
+            res.set_initial(states[self._initial])
+
+        return res
+
+    """
+    Return a pair:
+    - bool : whether the sequence of labels is accepted
+    - int  : the state reached after reading the labels, None if some label was not enabled
+    """
+    def read(self, labels):
+        curr = self._initial
+
+        for label in labels:
+            curr = self.step(curr, label)
+            if curr is None:
+                return False, None
+
+        return self.is_final(curr), curr
+
+
+"""
+Build the DFA recognizing the same language as the passed NFA, by subset construction over
+the epsilon-closed sets of states. States are discovered breadth-first and labels are
+visited in a fixed order, so translating the same NFA always yields the same numbering.
+"""
+def NFAToDFA(automaton : NFA) -> DFA:
+
+    if automaton.initial is None:
+        raise Exception("Cannot determinize an automaton without an initial state")
+
+    compact = automaton.freeze()
+    res = DFA(automaton)
+
+    def add_state(indexes : frozenset) -> int:
+        is_final = any(map(compact.is_final, indexes))
+        return res.add_state(frozenset(map(compact.id, indexes)), is_final)
+
+    start = compact.closure(compact.initial)
+    visited = { start: add_state(start) }
+    res.set_initial(visited[start])
+
+    to_visit = deque([ start ])
+    while to_visit:
+        curr = to_visit.popleft()
+
+        moves = {}
+        for s in curr:
+            for code, target in compact.edges(s):
+                if code != CompactNFA.EPSILON_CODE:
+                    moves.setdefault(code, set()).add(target)
+
+        for code in sorted(moves):
+            reached = frozenset(compact.e_closure(moves[code]))
+
+            if reached not in visited:
+                visited[reached] = add_state(reached)
+                to_visit.append(reached)
+
+            res.add_transition(visited[curr], compact.label(code), visited[reached])
+
+    return res
+
+
+"""
+Build the minimal DFA recognizing the same language as the passed one, with Hopcroft's
+partition refinement. The passed DFA is partial: it is completed with an implicit dead state,
+and the block of states equivalent to the dead state (those that cannot reach any final
+state) is dropped from the result. Every state of the result stands for the union of the
+NFA states of the DFA states it merges, so it can still be mapped back to the original NFA.
+"""
+def MinimizeDFA(automaton : DFA) -> DFA:
+
+    if automaton.initial is None:
+        raise Exception("Cannot minimize an automaton without an initial state")
+
+    n = automaton.num_states
+    dead = n
+
+    labels = sorted(set(map(lambda t: t[1], automaton.transitions)))
+
+    # label -> target -> sources (the dead state included)
+    inverse = {}
+    for label in labels:
+        inverse_label = [ [] for _ in range(n + 1) ]
+        for s in automaton.states:
+            t = automaton.step(s, label)
+            inverse_label[dead if t is None else t].append(s)
+        inverse_label[dead].append(dead)
+        inverse[label] = inverse_label
+
+    final = set(automaton.final)
+    non_final = set(range(n + 1)).difference(final)
+
+    blocks = [ b for b in [ final, non_final ] if b ]
+    block_of = [ 0 ] * (n + 1)
+    for b, block in enumerate(blocks):
+        for s in block:
+            block_of[s] = b
+
+    to_split = set([ 0 if len(blocks) == 1 or len(blocks[0]) <= len(blocks[1]) else 1 ])
+
+    while to_split:
+        splitter = list(blocks[to_split.pop()])
+
+        for label in labels:
+            touched = {}
+            for t in splitter:
+                for s in inverse[label][t]:
+                    touched.setdefault(block_of[s], set()).add(s)
+
+            for b, inside in touched.items():
+                if len(inside) == len(blocks[b]):
+                    continue
+
+                new_block = len(blocks)
+                blocks.append(inside)
+                blocks[b] = blocks[b].difference(inside)
+                for s in inside:
+                    block_of[s] = new_block
+
+                if b in to_split:
+                    to_split.add(new_block)
+                elif len(inside) <= len(blocks[b]):
+                    to_split.add(new_block)
+                else:
+                    to_split.add(b)
+
+    res = DFA(automaton.nfa)
+    dead_block = block_of[dead]
+    initial_block = block_of[automaton.initial]
+
+    def add_state(b : int) -> int:
+        members = blocks[b].difference([ dead ])
+        nfa_states = frozenset().union(*map(automaton.nfa_states, members))
+        return res.add_state(nfa_states, is_final=not blocks[b].isdisjoint(final))
+
+    # number the blocks breadth-first from the initial one
+    visited = { initial_block: add_state(initial_block) }
+    res.set_initial(visited[initial_block])
+
+    if initial_block == dead_block:
+        # empty language
+        return res
+
+    to_visit = deque([ initial_block ])
+    while to_visit:
+        b = to_visit.popleft()
+        representative = min(blocks[b])
+
+        for label in labels:
+            t = automaton.step(representative, label)
+            if t is None or block_of[t] == dead_block:
+                continue
+
+            if block_of[t] not in visited:
+                visited[block_of[t]] = add_state(block_of[t])
+                to_visit.append(block_of[t])
+
+            res.add_transition(visited[b], label, visited[block_of[t]])
+
+    return res
+
+
+"""
+Deterministic automaton built on the fly while reading (RE2-style), for automata whose full
+determinization would be too large (e.g. products of big parallel branches).
+
+Each reached set of NFA states is interned, as a frozenset of indexes of the compact NFA (see
+NFA.freeze), and the (state set, label) -> state set transitions are memoized. At most
+max_states state sets are cached: when the cap is hit the least recently used one is evicted,
+and its transitions are computed again by NFA simulation when needed. Hits, misses and
+evictions are counted (see stats), in order to size the cache for each choreography.
+"""
+class LazyDFA:
+
+    def __init__(self, automaton : NFA, max_states : int = 1024):
+        if automaton.initial is None:
+            raise Exception("Cannot determinize an automaton without an initial state")
+
+        if max_states < 1:
+            raise ValueError(f"The cache must hold at least one state set. Received: {max_states}")
+
+        self._nfa = automaton
+        self._max_states = max_states
+
+        # state set -> (interned state set, { label : state set })
+        self._cache = OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        compact = automaton.freeze()
+        self._initial = self._intern(frozenset(compact.closure(compact.initial)))
+
+    def __str__(self):
+        return f"{len(self._cache)}/{self._max_states} cached state sets, {self._hits} hits, {self._misses} misses, {self._evictions} evictions"
+
+    @property
+    def nfa(self) -> NFA:
+        return self._nfa
+
+    @property
+    def initial(self) -> frozenset:
+        return self._initial
+
+    @property
+    def max_states(self) -> int:
+        return self._max_states
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "states": len(self._cache),
+            "max_states": self._max_states,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+        }
+
+    def clear(self):
+        self._cache.clear()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _entry(self, states : frozenset):
+        entry = self._cache.get(states)
+
+        if entry is None:
+            entry = (states, {})
+            self._cache[states] = entry
+
+            if len(self._cache) > self._max_states:
+                self._cache.popitem(last=False)
+                self._evictions += 1
+        else:
+            self._cache.move_to_end(states)
+
+        return entry
+
+    def _intern(self, states : frozenset) -> frozenset:
+        if not states:
+            return states
+
+        return self._entry(states)[0]
+
+    """
+    Compute the state set reached by reading the passed label, by NFA simulation. The passed
+    state set is closed under epsilon transitions, so only its own outgoing edges are followed.
+    """
+    def _simulate(self, states : frozenset, label : str) -> frozenset:
+        compact = self._nfa.freeze()
+
+        code = compact.code(label)
+        if code is None:
+            return frozenset()
+
+        return frozenset(compact.step(states, code))
+
+    """
+    Return the state set reached by reading the passed label (empty if the label is not enabled)
+    """
+    def step(self, states : frozenset, label : str) -> frozenset:
+        entry = self._cache.get(states)
+
+        if entry is not None:
+            self._cache.move_to_end(states)
+
+            reached = entry[1].get(label)
+            if reached is not None:
+                self._hits += 1
+                return reached
+
+        self._misses += 1
+        reached = self._intern(self._simulate(states, label))
+
+        self._entry(states)[1][label] = reached
+
+        return reached
+
+    def is_final(self, states : frozenset) -> bool:
+        compact = self._nfa.freeze()
+        return any(map(compact.is_final, states))
+
+    """
+    Return the ids of the NFA states in the passed state set
+    """
+    def nfa_states(self, states : frozenset) -> set:
+        compact = self._nfa.freeze()
+        return set(map(compact.id, states))
@@ -16,6 +16,7 @@ import uuid
 from django.core.files import File
 from pathlib import Path
 import prompt_toolkit
+import graphviz
 from prompt_toolkit.history import FileHistory
 from prompt_toolkit.completion import NestedCompleter
 
@@ -90,11 +91,12 @@ class Enforcer:
 ##            self._debug_log(f"(* Non-determism factor: {nd_factor} *)")
 ##
 
-        num_states_pre = self._engine.get_num_states() #en(self._curr_states)
         out = self._engine.process_input(event)
-        nd_factor = (self._engine.get_num_states() - num_states_pre) / num_states_pre
-        
-        self._debug_log(f"(* Non-determism factor: {nd_factor} *)")
+
+        # computed by the engine while reading the event (None if the event was not read)
+        nd_factor = self._engine.get_nd_factor()
+        if nd_factor is not None:
+            self._debug_log(f"(* Non-determism factor: {nd_factor} *)")
         
         self._append_history(event, self._engine.get_curr_states(), list(map(lambda i: f"{i[0]}?{i[1]}" ,self._engine.get_buffer_items())))
         return out
@@ -121,6 +123,10 @@ class Enforcer:
         try:
             out = self._engine.process_check()
 
+            nd_factor = self._engine.get_nd_factor()
+            if nd_factor is not None:
+                self._debug_log(f"(* Non-determism factor: {nd_factor} *)")
+
             self._append_history(out, self._engine.get_curr_states(), list(map(lambda i: f"{i[0]}?{i[1]}" ,self._engine.get_buffer_items())))
         except Exception:
             pass
@@ -460,6 +466,8 @@ class CmdDump(UICommand):
             "rei": None,
             "nfa": None,
             "buffer": None,
+            "cache": None,
+            "dfa": None,
         }
 
         return d
@@ -470,7 +478,7 @@ class CmdDump(UICommand):
             return
 
         if len(args) == 0:
-            print("Please specify an argument: dump <curr_states|states|transitions|buffer|rei>")
+            print("Please specify an argument: dump <curr_states|states|transitions|buffer|rei|nfa|dfa|cache>")
         else:
             if args[0] == "curr_states":    
                 print("\nCurrent states: \n")
@@ -520,19 +528,50 @@ class CmdDump(UICommand):
                     msg = f"{actor}?{message}"
 
                     print(msg)
+
+            elif args[0] == "cache":
+                print("\nCache: \n")
+                stats = self.ui._enforcer.engine.get_cache_stats()
+                if stats is None:
+                    print("(* The engine does not use a cache *)")
+                else:
+                    for k,v in stats.items():
+                        print(f" {k} : {v}")
             
             elif args[0] == "rei":
                 print("\nREI: \n")
                 print(self.ui._rei)
 
             elif args[0] == "nfa":
+                # dump nfa [hops]: only the states at most hops transitions away from the current ones
+                if len(args) > 1 and not args[1].isdigit():
+                    print("The number of hops must be a non-negative integer")
+                    return
+
+                hops = int(args[1]) if len(args) > 1 else None
+                engine = self.ui._enforcer.engine
                 print("\nNFA: \n")
-                g = self.ui._nfa.to_dot()   
-                print(g)
+                engine.write_dot(sys.stdout, hops)
                 print("\nEvent dictionary: \n")
-                for k,v in self.ui._nfa.event_dictionary.items():
+                for k,v in engine.nfa.event_dictionary.items():
                     print(f" {k} : {v}")
 
+            elif args[0] == "dfa":
+                print("\nMinimal DFA (i=initial, f=final): \n")
+                d = self.ui._nfa.to_dfa().minimize()
+                print(d)
+                print("\nStates (mapped to the NFA states): \n")
+                for s in d.states:
+                    label = f"d{s} = {{ {', '.join(sorted(d.nfa_states(s)))} }}"
+                    if s == d.initial:
+                        label = f"{label} : i"
+                    if d.is_final(s):
+                        label = f"{label} : f"
+                    print(label)
+                print("\nTransitions: \n")
+                for source, label, target in d.transitions:
+                    print(f"d{source} -[{label}]-> d{target}")
+
 class CmdStats(UICommand):
 
     def execute(self, *args, **kwargs):
@@ -583,6 +622,8 @@ class CmdSave(UICommand):
                 print("Plase, provide the filename argument")
             elif n_args < 4:
                 print("Please, provide the format argument")
+            elif n_args > 4 and not args[4].isdigit():
+                print("The number of hops must be a non-negative integer")
         
             else:
     
@@ -590,9 +631,13 @@ class CmdSave(UICommand):
                 format = args[3]
                 filename = f"{args[2]}.gv"
                 outfile = f"{args[2]}.{format}"
+                # save nfa <outdir> <filename> <format> [hops]: only the states at most hops transitions away from the current ones
+                hops = int(args[4]) if n_args > 4 else None
 
-                g = self.ui._enforcer._engine._nfa.to_dot()
-                g.render(directory=outdir, filename=filename, outfile=outfile, format=format)
+                os.makedirs(outdir, exist_ok=True)
+                with open(os.path.join(outdir, filename), "w", encoding="utf-8") as f:
+                    self.ui._enforcer._engine.write_dot(f, hops)
+                graphviz.render("dot", format, os.path.join(outdir, filename), outfile=outfile)
                 print(f"NFA saved as {filename} and {outfile}")
 
         else:
@@ -812,10 +857,7 @@ class UI:
         assert self._running is not None
 
         try:
-            iscan = nfa.InputScanner(event_stream)
-    
-            while not iscan.eof:        
-                event = iscan.scan_input()
+            for event in nfa.tokenize_events(event_stream):
 
                 self.ri.append_input(event)
 
@@ -5,6 +5,7 @@ from django_object_actions import DjangoObjectActions, action
 # Register your models here.
 
 from engine.models import RunningInstance
+from interleaving import InterleavingNFA
 
 class RunningInstanceAdmin(DjangoObjectActions, admin.ModelAdmin):
 
@@ -12,11 +13,11 @@ class RunningInstanceAdmin(DjangoObjectActions, admin.ModelAdmin):
     list_filter = [ "engine_type", "running", ]
     search_fields = [ "id", "label", "choreography__name", "choreography__resource" ]
 
-    fields = [ "label", "engine_type", "choreography", "running", "execution_started", "execution_ended", "rei", "automaton", "input_events", "output_events", "enforcer_states", "enforcer_buffer", ]
+    fields = [ "label", "engine_type", "choreography", "running", "execution_started", "execution_ended", "rei", "automaton", "minimal_automaton", "input_events", "output_events", "enforcer_states", "enforcer_buffer", ]
 
-    readonly_fields = [ "execution_started", "execution_ended", "rei", "automaton", "enforcer_states",  "input_events", "output_events", "enforcer_buffer", ]
+    readonly_fields = [ "execution_started", "execution_ended", "rei", "automaton", "minimal_automaton", "enforcer_states",  "input_events", "output_events", "enforcer_buffer", ]
 
-    change_actions = [ "action_start", "action_stop", ]
+    change_actions = [ "action_start", "action_stop", "action_minimize", ]
     changelist_actions = [ "action_start_all", "action_stop_all", ]
 
 
@@ -42,6 +43,15 @@ class RunningInstanceAdmin(DjangoObjectActions, admin.ModelAdmin):
             self.action_stop(request, curr)
 
 
+    @action(label=_("Minimize"), description=_("Compute the minimal DFA of the automaton of the current instance"))
+    def action_minimize(self, request, obj):
+        if not obj.nfa or isinstance(obj.nfa, InterleavingNFA):
+            return
+
+        obj.enforcer.engine.get_minimal_dfa(compute=True)
+        obj.save()
+
+
     def rei(self, obj : RunningInstance):
         return format_html("<pre>{}</pre>", str(obj.rei))
 
@@ -61,6 +71,33 @@ class RunningInstanceAdmin(DjangoObjectActions, admin.ModelAdmin):
 
         return format_html("<pre>{}</pre>", str(obj.nfa) + "\n\nTransitions (*=enabled)" + "\n\n" + "\n".join(transitions))
 
+    def minimal_automaton(self, obj : RunningInstance):
+        if not obj.nfa:
+            return None
+
+        if isinstance(obj.nfa, InterleavingNFA):
+            # building the product automaton of the parallel branches is what this engine avoids
+            return "(* Not available for the interleaving engine *)"
+
+        # the minimal DFA is only computed on request (see action_minimize)
+        d = obj.enforcer.engine.get_minimal_dfa()
+        if d is None:
+            return "(* Not computed yet: use the Minimize action *)"
+
+        states = []
+        for s in d.states:
+            nfa_states = d.nfa_states(s)
+            s_repr = f"d{s} = {{ {', '.join(sorted(nfa_states))} }}"
+            if any(map(obj.enforcer.engine.is_state_current, nfa_states)):
+                s_repr = f" * {s_repr}"
+            else:
+                s_repr = f"   {s_repr}"
+            states.append(s_repr)
+
+        transitions = [ f"d{source} -[{label}]-> d{target}" for source, label, target in d.transitions ]
+
+        return format_html("<pre>{}</pre>", str(d) + "\n\nStates (*=current)" + "\n\n" + "\n".join(states) + "\n\nTransitions" + "\n\n" + "\n".join(transitions))
+
     def enforcer_states(self, obj : RunningInstance):
         print(obj.enforcer)
         return format_html("<pre>{}</pre>", ", ".join(obj.enforcer_states))
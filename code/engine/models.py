@@ -1,14 +1,23 @@
 from django.db import models
 from django.utils.translation import ugettext as _
 from django.utils import timezone
+from django.conf import settings
 from web3 import Web3
 import re
 from picklefield.fields import PickledObjectField
+import copy
+import hashlib
+import os
+import threading
+import weakref
 
 from bpmn_parser.models import Choreography
 
 import nfa
 import rei
+import dfa
+import interleaving
+import serialization
 
 
 class RunningInstance(models.Model):
@@ -100,8 +109,17 @@ class RunningInstance(models.Model):
 
             #rei = self.choreography.to_rei()
             #automaton = nfa.ReiToNFA(rei)
-            automaton = self.choreography.to_nfa()
-            engine = EngineOffChain(automaton)    
+            if settings.ENGINE_OFFCHAIN_MODE == "interleaving":
+                # the parallel branches are never flattened into a product automaton
+                automaton = interleaving.InterleavingNFA(self.choreography.to_rei())
+            else:
+                automaton = self.choreography.to_nfa()
+                if settings.ENGINE_REMOVE_EPSILONS:
+                    automaton = automaton.remove_epsilons()
+            engine = EngineOffChain.create(automaton, settings.ENGINE_OFFCHAIN_MODE)
+            if settings.ENGINE_AUTOMATA_DIR and engine.RUNS_ON_COMPACT:
+                # the pickled enforcer keeps the path of the automaton, mapped when it is loaded
+                engine.store_automaton(settings.ENGINE_AUTOMATA_DIR)
             self.enforcer = Enforcer(engine)
 
         #print(f"Saved enforcer: {self.enforcer}")
@@ -192,6 +210,46 @@ class Engine:
     def get_buffer_items(self):
         raise Exception("This is an abstract method, you should implement it")
 
+    def get_cache_stats(self):
+        return None
+
+    # see get_minimal_dfa; also the default for engines pickled before it was introduced
+    _minimal_dfa = None
+
+    """
+    Return the minimal DFA of the automaton of the engine, None if it was never computed. It is
+    only computed if compute is set, since the subset construction may take exponential time,
+    and it is then kept with the engine.
+    """
+    def get_minimal_dfa(self, compute : bool = False):
+        if self._minimal_dfa is None and compute:
+            self._minimal_dfa = self.nfa.to_dfa().minimize()
+        elif self._minimal_dfa is not None and self._minimal_dfa.nfa is None:
+            # unpickled without the automaton it was built from (see EngineOffChain.__getstate__)
+            self._minimal_dfa._nfa = self.nfa
+
+        return self._minimal_dfa
+
+    """
+    Write the automaton of the engine to out in DOT format (see nfa.write_dot), highlighting the
+    current states. If hops is passed, only the states at most hops transitions away from the
+    current ones are written, the other ones being collapsed.
+    """
+    def write_dot(self, out, hops : int = None):
+        automaton = self.nfa
+        curr_states = self.get_curr_states()
+        states = None if hops is None else nfa.neighbourhood(automaton, curr_states, hops)
+        cluster = getattr(automaton, "component_prefix", nfa.par_cluster)
+
+        nfa.write_dot(automaton, out, states, curr_states, cluster)
+
+    """
+    Return the non-determinism factor of the last event read by the automaton, i.e. the relative
+    change in the number of current states (None if the last processed event was not read)
+    """
+    def get_nd_factor(self):
+        return None
+
 
     # RULE CONDITIONS
     def condition_rule_send(self, event):
@@ -216,26 +274,128 @@ class Engine:
         raise Exception("This is an abstract method, you should implement it")
 
 
+# compact automata mapped from their files (see EngineOffChain.store_automaton), shared by the
+# engines of the process as long as one of them uses them
+_mapped_automata = weakref.WeakValueDictionary()
+_mapped_automata_lock = threading.Lock()
+
+def _map_automaton(path : str) -> nfa.CompactNFA:
+    with _mapped_automata_lock:
+        res = _mapped_automata.get(path)
+        if res is None:
+            res = serialization.load(path)
+            _mapped_automata[path] = res
+
+    return res
+
+
 class EngineOffChain(Engine):
 
+    # whether the engine runs on the compact automaton alone, which can then be stored in a file
+    # (see store_automaton)
+    RUNS_ON_COMPACT = True
+
+    # see get_nd_factor; also the default for engines pickled before it was introduced
+    _nd_factor = None
+    # codes of the labels enabled in the current states, see _enabled_codes
+    _enabled = None
+    # the last event read from the current states and the states it reaches, see _step_once
+    _last_step = None
+    # see store_automaton; also the default for engines pickled before it was introduced
+    _automaton_path = None
+    # the compact automaton mapped from _automaton_path
+    _compact = None
+
     def __init__(self, nfa : nfa.NFA):
         super().__init__(nfa)
 #        self._nfa : nfa.NFA = nfa
         self._buffer = {}
-        self._curr_states = self._nfa.e_closure(set([ self._nfa.initial.id ]))
+        # the engine representation of the current states, a frozenset of indexes of the compact
+        # automaton (see nfa.CompactNFA): subclasses may use their own (see _initial_states,
+        # _next_states and get_curr_states)
+        self._curr_states = self._initial_states()
         self._debug : bool = True
         self._stats = [] 
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._automaton_path is not None:
+            # mapped again from the file when the engine is unpickled
+            state["_nfa"] = None
+            state["_compact"] = None
+            if self._minimal_dfa is not None:
+                # it would pickle the automaton through its back-reference
+                state["_minimal_dfa"] = copy.copy(self._minimal_dfa)
+                state["_minimal_dfa"]._nfa = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # derived from the current states, and kept as labels by older engines
+        self._enabled = None
+        self._last_step = None
+
+        if self._automaton_path is not None:
+            self._compact = _map_automaton(self._automaton_path)
+
+        if type(self) is EngineOffChain and any(isinstance(s, str) for s in self._curr_states):
+            # pickled when the current states were kept as state ids
+            compact = self._frozen()
+            self._curr_states = frozenset(compact.index(s) for s in self._curr_states)
  
 
     @property
     def stats(self) -> str:
         return self._stats
 
+    """
+    Store the compact automaton of the engine in a file of the passed directory, in the binary
+    format of the serialization module. The file is named after its contents, so that the
+    engines of the same automaton share it. The pickled engine then keeps the path of the file
+    instead of the automaton, and maps the file when it is unpickled: loading it costs almost
+    nothing, and the processes running the same automaton share its pages.
+    """
+    def store_automaton(self, directory : str):
+        if not self.RUNS_ON_COMPACT:
+            raise ValueError(f"{type(self).__name__} cannot run on a stored automaton")
+
+        data = serialization.dumps(self.nfa)
+        path = os.path.join(directory, f"{hashlib.sha256(data).hexdigest()}.nfa")
+
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            # written aside and then renamed, so that a process never maps a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        self._automaton_path = path
+
+    """
+    Build the off-chain engine implementing the passed mode (see settings.ENGINE_OFFCHAIN_MODE)
+    """
+    @staticmethod
+    def create(nfa : nfa.NFA, mode : str = "nfa"):
+        modes = {
+            "nfa": EngineOffChain,
+            "bitmask": EngineOffChainBitmask,
+            "dfa": EngineOffChainDFA,
+            "lazy_dfa": EngineOffChainLazyDFA,
+            "interleaving": EngineOffChainInterleaving,
+        }
+
+        if mode not in modes:
+            raise ValueError(f"Off-chain engine mode not supported: {mode}. Available modes: {', '.join(modes.keys())}")
+
+        return modes[mode](nfa)
+
      
 
     def process_input(self, event):
 
         out = None
+        self._nd_factor = None
         #if self._engine.condition_rule_send(event):
         #    out = self._engine.rule_send(event)
         if self.condition_rule_send(event):
@@ -260,6 +420,7 @@ class EngineOffChain(Engine):
 
     def process_check(self):
         out = None
+        self._nd_factor = None
         try:
             #actor, message = self._engine._buffer_find_usable_message()
             actor, message = self._buffer_find_usable_message()
@@ -277,10 +438,74 @@ class EngineOffChain(Engine):
 
     @property
     def curr_states(self) -> str:
-        return self._curr_states
+        return self.get_curr_states()
 
     # UTILS
 
+    """
+    Return the compact automaton the engine runs on (see nfa.CompactNFA)
+    """
+    def _frozen(self) -> nfa.CompactNFA:
+        if self._nfa is None:
+            return self._compact
+
+        return self._nfa.freeze()
+
+    def _initial_states(self):
+        compact = self._frozen()
+        return compact.closure(compact.initial)
+
+    """
+    Return whether the passed event can be read from the current states
+    """
+    def _is_enabled(self, event):
+        code = self._frozen().code(event)
+        return bool(code) and code in self._enabled_codes()
+
+    """
+    Return the set of the codes of the labels enabled in the current states (see
+    nfa.CompactNFA.enabled_codes), computed once per step
+    """
+    def _enabled_codes(self):
+        if self._enabled is None:
+            self._enabled = self._frozen().enabled_codes(self._curr_states)
+
+        return self._enabled
+
+    """
+    Return the states reached from the current ones by reading the passed event
+    (empty if the event is not enabled)
+    """
+    def _next_states(self, event):
+        compact = self._frozen()
+        reached, died, _ = compact.step_states(self._curr_states, compact.code(event))
+
+        for i in died:
+            self._debug_log(f"(* State {compact.id(i)} was not compatible with event {event} and has been discarded... *)")
+
+        return reached
+
+    """
+    Return step(current states, event), computing it once per event and current states: checking
+    that the event is enabled and then reading it (see _is_enabled and _next_states) take a single
+    step, for the subclasses whose step is not cached
+    """
+    def _step_once(self, step, event):
+        if self._last_step is None or self._last_step[0] != event:
+            self._last_step = (event, step(self._curr_states, event))
+
+        return self._last_step[1]
+
+    """
+    Move to the states reached by reading the passed event, recording the non-determinism factor
+    """
+    def _advance(self, event):
+        num_states_pre = len(self.get_curr_states())
+        self._curr_states = self._next_states(event)
+        self._enabled = None
+        self._last_step = None
+        self._nd_factor = (len(self.get_curr_states()) - num_states_pre) / num_states_pre
+
     def _buffer_add(self, actor : str, message : str):
 
         actor_buffer = self._buffer.get(actor, {})
@@ -312,41 +537,57 @@ class EngineOffChain(Engine):
 #                print(f"Message: {message} - Counter: {counter}")
                 if counter > 0:
                     event = f"{actor}?{message}"
-                    for s in self._curr_states:
-                        if self._nfa.transitions_from(s, event):
-                            found = (actor, message)
-                            return found
+                    if self._is_enabled(event):
+                        found = (actor, message)
+                        return found
         
         raise Enforcer.NoMessageFound("No usable message found")
 
     
     # INTERFACE methods
 
+    """
+    Return the automaton of the engine. An engine unpickled from an automaton stored in a file
+    (see store_automaton) runs on the compact arrays mapped from it, and only rebuilds the NFA
+    the first time it is asked for (e.g. to show it or to determinize it)
+    """
+    @property
+    def nfa(self):
+        if self._nfa is None:
+            self._nfa = self._compact.to_nfa()
+
+        return self._nfa
+
     def ended(self):
-        return self._nfa.is_final(self._curr_states)
+        compact = self._frozen()
+        return any(compact.is_final(i) for i in self._curr_states)
 
     def get_all_states(self):
-        return self._nfa.states
+        return self.nfa.states
 
     def get_curr_states(self):
-        return self._curr_states
+        compact = self._frozen()
+        return set(map(compact.id, self._curr_states))
 
     def get_transitions(self):
-        return self._nfa.transitions
+        return self.nfa.transitions
 
     def is_state_final(self, s):
-        return self._nfa.is_final(s)
+        return self.nfa.is_final(s)
 
     def is_state_initial(self, s):  
-        return self._nfa.is_initial(s)
+        return self.nfa.is_initial(s)
 
     def is_state_current(self, s):
         if isinstance(s, nfa.State):
             s = s.id
         
-        res = (s in self._curr_states)
+        res = (s in self.get_curr_states())
         return res
 
+    def get_nd_factor(self):
+        return self._nd_factor
+
     def get_buffer_items(self):
         items = []
 
@@ -373,13 +614,7 @@ class EngineOffChain(Engine):
         if m is None:
             return False
 
-        for curr in self._curr_states:
-            enabled_transitions = self._nfa.transitions_from(curr, event)
-
-            if len(enabled_transitions) > 0:
-                return True
-
-        return False
+        return self._is_enabled(event)
 
     def condition_rule_receive_delayed(self, event):    
 
@@ -394,18 +629,7 @@ class EngineOffChain(Engine):
 
     def rule_receive_now(self, event):
 
-        reached = set()
-        for s in self._curr_states:
-
-            s_reached = self._nfa.read_symbol(event, s)
-
-            if len(s_reached) == 0:
-                self._debug_log(f"(* State {s} was not compatible with event {event} and has been discarded... *)")
-            else:
-                reached = reached.union(s_reached)
-            
-
-        self._curr_states = reached
+        self._advance(event)
         return event
 
 #    def rule_receive_delayed(self, actor, message):
@@ -424,25 +648,163 @@ class EngineOffChain(Engine):
 
         event = f"{actor}?{message}"
 
-        reached = set()
-        for s in self._curr_states:
-            s_reached = self._nfa.read_symbol(event, s)
-
-            if len(s_reached) == 0:
-                self._debug_log(f"(* State {s} was not compatible with event {event} and has been discarded... *)")
-            else:
-                reached = reached.union(s_reached)
-        
+        self._advance(event)
         self._buffer_remove(actor, message)
 
-        nd_factor = (len(reached) - len(self._curr_states)) / len(self._curr_states)
-        self._debug_log(f"(* Non-determism factor: {nd_factor} *)")
-        self._curr_states = reached
-
 
         return event
 
 
+class EngineOffChainBitmask(EngineOffChain):
+    """
+    Off-chain engine tracking the current NFA states as an int bitmask over the numbering of the
+    compact representation of the automaton (see nfa.CompactNFA): bit i is set iff the state with
+    index i is current. Reading an event and checking finality are bitwise operations, and the
+    pickled engine stores a single int instead of a set of state ids.
+    """
+
+    def _initial_states(self):
+        compact = self._frozen()
+        return compact.closure_mask(compact.initial)
+
+    def _step_mask(self, mask : int, event) -> int:
+        compact = self._frozen()
+        code = compact.code(event)
+
+        return compact.step_mask(mask, code) if code else 0
+
+    def _is_enabled(self, event):
+        return self._step_once(self._step_mask, event) != 0
+
+    def _next_states(self, event):
+        reached = self._step_once(self._step_mask, event)
+
+        if self._debug:
+            # the discarded states are only worked out to be logged
+            compact = self._frozen()
+            for i in compact.from_mask(self._curr_states):
+                if self._step_mask(1 << i, event) == 0:
+                    self._debug_log(f"(* State {compact.id(i)} was not compatible with event {event} and has been discarded... *)")
+
+        return reached
+
+    def ended(self):
+        return self._curr_states & self._frozen().final_mask != 0
+
+    def get_curr_states(self):
+        compact = self._frozen()
+        return set(map(compact.id, compact.from_mask(self._curr_states)))
+
+    def is_state_current(self, s):
+        index = self._frozen().index(s)
+        return index is not None and (self._curr_states >> index) & 1 == 1
+
+
+class EngineOffChainDFA(EngineOffChain):
+    """
+    Off-chain engine enforcing against the DFA obtained from the NFA by subset construction:
+    reading an event is a single table step, instead of the union of read_symbol over every
+    current NFA state. The current states are still reported as NFA state ids, by mapping the
+    current DFA state back to the set of NFA states it stands for.
+    """
+
+    RUNS_ON_COMPACT = False
+
+    def __init__(self, nfa : nfa.NFA):
+        self._dfa = nfa.to_dfa()
+        super().__init__(nfa)
+
+    @property
+    def dfa(self):
+        return self._dfa
+
+    def _initial_states(self):
+        return self._dfa.initial
+
+    def _is_enabled(self, event):
+        return self._dfa.step(self._curr_states, event) is not None
+
+    def _next_states(self, event):
+        reached = self._dfa.step(self._curr_states, event)
+        assert reached is not None, f"Event {event} is not enabled in the current states"
+
+        return reached
+
+    def ended(self):
+        return self._dfa.is_final(self._curr_states)
+
+    def get_curr_states(self):
+        return set(self._dfa.nfa_states(self._curr_states))
+
+
+class EngineOffChainLazyDFA(EngineOffChain):
+    """
+    Off-chain engine enforcing against a DFA built on the fly (see dfa.LazyDFA): only the
+    reached sets of NFA states are determinized, and at most max_states of them are cached.
+    """
+
+    RUNS_ON_COMPACT = False
+
+    def __init__(self, nfa : nfa.NFA, max_states : int = None):
+        if max_states is None:
+            max_states = settings.ENGINE_LAZY_DFA_MAX_STATES
+
+        self._dfa = dfa.LazyDFA(nfa, max_states)
+        super().__init__(nfa)
+
+    @property
+    def dfa(self):
+        return self._dfa
+
+    def _initial_states(self):
+        return self._dfa.initial
+
+    def _is_enabled(self, event):
+        return len(self._step_once(self._dfa.step, event)) > 0
+
+    def _next_states(self, event):
+        return self._step_once(self._dfa.step, event)
+
+    def ended(self):
+        return self._dfa.is_final(self._curr_states)
+
+    def get_curr_states(self):
+        return self._dfa.nfa_states(self._curr_states)
+
+    def get_cache_stats(self):
+        return self._dfa.stats
+
+
+class EngineOffChainInterleaving(EngineOffChain):
+    """
+    Off-chain engine enforcing against an interleaving.InterleavingNFA: the Par nodes of the REI
+    are not flattened into a product automaton, and the current configuration keeps the states
+    of each parallel branch apart. The current states are reported as the ids of the active
+    states of the skeleton and of all the branches.
+    """
+
+    RUNS_ON_COMPACT = False
+
+    def __init__(self, automaton : interleaving.InterleavingNFA):
+        assert isinstance(automaton, interleaving.InterleavingNFA), f"Expected an interleaving automaton, received: {automaton}"
+        super().__init__(automaton)
+
+    def _initial_states(self):
+        return self._nfa.initial_configuration
+
+    def _is_enabled(self, event):
+        return len(self._step_once(self._nfa.step, event)) > 0
+
+    def _next_states(self, event):
+        return self._step_once(self._nfa.step, event)
+
+    def ended(self):
+        return self._nfa.is_accepting(self._curr_states)
+
+    def get_curr_states(self):
+        return self._nfa.active_states(self._curr_states)
+
+
 class EngineOnChain(Engine):
 
     def __init__(self, nfa : nfa.NFA, chain_url : str, chain_id : str, wallet_address : str, private_key : str, debug_compile : bool = False):
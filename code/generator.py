@@ -27,23 +27,35 @@ class NFAContractGenerator(Generator):
         contract.add_attribute(Variable("start","bool"))
         contract.add_attribute(Variable("end","bool"))
         contract.add_attribute(Variable("transitions", "mapping(string => mapping(string => string[]))"))
+        # labels of the transitions departing from each state, and the labels enabled in the current states
+        contract.add_attribute(Variable("labels", "mapping(string => string[])"))
+        contract.add_attribute(Variable("enabled", "mapping(string => bool)"))
+        contract.add_attribute(Variable("enabledLabels", "string[]"))
     
     def __create_constructor(self, contract : Contract):
         constructorBody = ""
+        symbols = self.nfa.symbols
+
+        # targets grouped by source state and label code (epsilon is the empty label)
         transitionsDict = {}
         for t in self.nfa.transitions:
-            if f"{t.source.id}.{t.label}" not in transitionsDict.keys():
-                transitionsDict[f"{t.source.id}.{t.label}"] = [t.target.id]
-            else:
-                transitionsDict[f"{t.source.id}.{t.label}"].append(str(t.target.id))
+            transitionsDict.setdefault((t.source.id, symbols.code(t.label)), []).append(str(t.target.id))
         
-        for key in transitionsDict:
-            key = key.split(".")
-            constructorBody += f"transitions['{key[0]}']['{key[1]}'] = {transitionsDict[key[0]+'.'+key[1]]};\n"  
+        for (source, code), targets in transitionsDict.items():
+            constructorBody += f"transitions['{source}']['{symbols.label(code)}'] = {targets};\n"  
+
+        labelsDict = {}
+        for source, code in sorted(transitionsDict.keys()):
+            if code != symbols.EPSILON_CODE:
+                labelsDict.setdefault(source, []).append(symbols.label(code))
+
+        for source, labels in labelsDict.items():
+            constructorBody += f"labels['{source}'] = {labels};\n"
         constructorBody += """
 delete tmpStates;
 tmpStates.push(initialState);
-currentStates = e_closure(tmpStates);"""
+currentStates = e_closure(tmpStates);
+updateEnabled();"""
 
         contract.add_constructor(Constructor([], constructorBody))
 
@@ -94,9 +106,18 @@ return tmpStates;""",
                         "private",
                         "string[] memory"))
 
-        contract.add_function(Function("e_closure",
-                        [Variable("states","string[]","memory")],
-                        """delete tmpStates;
+        if not self.nfa.has_epsilons:
+            # epsilon-free automaton (see nfa.NFA.remove_epsilons): the closure is the identity
+            contract.add_function(Function("e_closure",
+                            [Variable("states","string[]","memory")],
+                            """checkInitialAndFinalStates(states);
+return states;""",
+                            "private",
+                            "string[] memory"))
+        else:
+            contract.add_function(Function("e_closure",
+                            [Variable("states","string[]","memory")],
+                            """delete tmpStates;
 tmpStates = states;
 bool found = (tmpStates.length > 0);
 while (found) {
@@ -112,8 +133,8 @@ while (found) {
 }
 checkInitialAndFinalStates(tmpStates);
 return tmpStates;""",
-                        "private",
-                        "string[] memory"))
+                            "private",
+                            "string[] memory"))
 
         contract.add_function(Function("getStates",
                                 [],
@@ -166,18 +187,39 @@ for (uint i = 0; i < currentStates.length; i++) {
 }
 require(tmpStates.length != 0);
 message.push(label);
-currentStates = e_closure(tmpStates);""",
+currentStates = e_closure(tmpStates);
+updateEnabled();""",
                                 "public"))
-        
+
+        # the current states are closed under epsilon transitions: the enabled labels are the
+        # ones departing from them, collected once per transition
+        contract.add_function(Function("updateEnabled",
+                        [],
+                        """for (uint i = 0; i < enabledLabels.length; i++) {
+    enabled[enabledLabels[i]] = false;
+}
+delete enabledLabels;
+for (uint i = 0; i < currentStates.length; i++) {
+    for (uint j = 0; j < labels[currentStates[i]].length; j++) {
+        string memory label = labels[currentStates[i]][j];
+        if (!enabled[label]) {
+            enabled[label] = true;
+            enabledLabels.push(label);
+        }
+    }
+}""",
+                        "private"))
+
+        contract.add_function(Function("getEnabledLabels",
+                                [],
+                                "return enabledLabels;",
+                                "public view",
+                                "string[] memory"))
+
         contract.add_function(Function("checkEnabledTransitions",
                         [Variable("symbol","string","memory")],
-                        """for (uint i = 0; i < currentStates.length; i++) {
-    string[] memory s_reached = transitionFrom(currentStates[i], symbol);
-    if (s_reached.length > 0) return true;
-    //reached = union(reached, s_reached); 
-}
-return false;""",
-                        "public",
+                        "return enabled[symbol];",
+                        "public view",
                         "bool"))
     
     def createContract(self):
@@ -315,17 +357,12 @@ buffer[actor][message] = counter;""",
 
         contract.add_function(Function("condition_rule_receive_buffered",
                                 [],
-                                """delete tmpStates;
-for (uint i = 0; i < actors.length; i++) {
+                                """for (uint i = 0; i < actors.length; i++) {
     for (uint j = 0; j < messages.length; j++) {
         if (buffer[actors[i]][messages[j]] > 0) {
             string memory message = string(abi.encodePacked(actors[i],"?",messages[j]));
-            string[] memory currentStates = nfa.getCurrentStates();
-            for (uint s = 0; s < currentStates.length; s++) {
-                tmpStates = nfa.transitionFrom(currentStates[s], message);
-                if (tmpStates.length > 0) {
-                    return message;
-                }
+            if (nfa.checkEnabledTransitions(message)) {
+                return message;
             }
         }
     }
@@ -0,0 +1,274 @@
+from rei import REI, Par
+from nfa import NFA, State, ReiToNFA, canonical_hash
+from symbols import SymbolTable
+
+
+"""
+Automaton recognizing the language of a REI without ever building the product automaton of its
+Par nodes. The REI is translated by ReiToNFA into a skeleton automaton, where every Par node is
+replaced by a box: an entry and an exit state, with no transition in between. The items of the
+Par are translated (recursively) into one component automaton each, and they run side by side.
+
+A configuration of the automaton is a frozenset of:
+- skeleton state ids
+- box configurations (entry state id, (c_1, ..., c_k)), where c_i is the configuration of the
+  i-th component
+
+An event is only dispatched to the component whose alphabet contains its label: since the
+alphabets of the components are disjoint, the states reachable in a box are exactly the product
+of the states reachable in its components, so memory and per-event cost are additive (rather than
+multiplicative) in the number of parallel branches. A box is left, through its exit state, when
+every component is in a final configuration. A Par whose components share some label is translated
+into the product automaton, as ReiToNFA does.
+
+The automaton exposes the same read-only interface of NFA used to display it (states, transitions,
+is_final, ...), where the states are the ones of the skeleton and of all the components; to_nfa
+builds the equivalent product automaton.
+"""
+class InterleavingNFA:
+
+    # see symbols and component_prefix; also the defaults for automata pickled before they were introduced
+    _symbols = None
+    _components = None
+
+    def __init__(self, rei : REI, prefix : str = ""):
+        self._rei = rei
+        self._prefix = prefix
+        # entry state id -> (exit state id, components, label -> index of the component)
+        self._boxes = {}
+        self._skeleton : NFA = ReiToNFA(rei, self._translate_par, prefix)
+
+        self._alphabet = set(t.label for t in self._skeleton.transitions if t.label)
+        for _, components, dispatch in self._boxes.values():
+            self._alphabet.update(dispatch.keys())
+
+        self._initial_configuration = self._closure([ self._skeleton.initial.id ])
+        self._components = self._component_prefixes()
+
+    def __str__(self):
+        return f"{len(self.states)} states, {len(self.transitions)} transitions, initial: {self._skeleton.initial.id}, {len(self.final)} final states, {len(self._boxes)} parallel boxes"
+
+    """
+    The states of the box are named after the prefix of the Par node (as the states built by ReiToNFA),
+    and the ones of the i-th component take the prefix of the i-th item of the Par node
+    """
+    def _translate_par(self, rei : Par, prefix : str) -> NFA:
+        components = [ InterleavingNFA(curr, f"{prefix}{pos}.") for pos, curr in enumerate(rei.items) ]
+
+        dispatch = {}
+        for pos, component in enumerate(components):
+            for label in component.alphabet:
+                if label in dispatch:
+                    # the components are not independent: build their product
+                    return ReiToNFA(rei, prefix=prefix)
+
+                dispatch[label] = pos
+
+        entry = State(f"{prefix}b")
+        exit = State(f"{prefix}x")
+
+        a = NFA()
+        a.add_state(entry)
+        a.add_state(exit, is_final=True)
+        a.set_initial(entry)
+
+        self._boxes[entry.id] = (exit.id, components, dispatch)
+
+        return a
+
+    @property
+    def rei(self) -> REI:
+        return self._rei
+
+    @property
+    def skeleton(self) -> NFA:
+        return self._skeleton
+
+    @property
+    def alphabet(self) -> set:
+        return self._alphabet
+
+    """
+    Return the (exit state id, components) pairs of the boxes, indexed by their entry state id
+    """
+    @property
+    def boxes(self) -> dict:
+        return { entry: (exit, components) for entry, (exit, components, _) in self._boxes.items() }
+
+    """
+    Return the prefix of the outermost component containing the passed state, None if the state
+    belongs to the skeleton (used to cluster the states by component, see nfa.write_dot)
+    """
+    def component_prefix(self, state_id : str):
+        if self._components is None:
+            self._components = self._component_prefixes()
+
+        return self._components.get(state_id)
+
+    """
+    Return the prefix of the outermost component of every state of the components
+    """
+    def _component_prefixes(self) -> dict:
+        res = {}
+
+        for _, components, _ in self._boxes.values():
+            for component in components:
+                for a in component._automata():
+                    res.update((s, component._prefix) for s in a._states)
+
+        return res
+
+    def _automata(self):
+        yield self._skeleton
+
+        for _, components, _ in self._boxes.values():
+            for component in components:
+                yield from component._automata()
+
+    """
+    Close the passed configuration under epsilon transitions, entering the boxes whose entry state
+    is reached and leaving the boxes whose components are all in a final configuration
+    """
+    def _closure(self, configuration) -> frozenset:
+        res = set()
+        todo = list(configuration)
+
+        while todo:
+            curr = todo.pop()
+            if curr in res:
+                continue
+
+            res.add(curr)
+
+            if isinstance(curr, str):
+                todo.extend(self._skeleton.e_closure(curr))
+
+                box = self._boxes.get(curr)
+                if box is not None:
+                    _, components, _ = box
+                    todo.append((curr, tuple(c.initial_configuration for c in components)))
+            else:
+                entry, parts = curr
+                exit, components, _ = self._boxes[entry]
+
+                if all(c.is_accepting(p) for c, p in zip(components, parts)):
+                    todo.append(exit)
+
+        return frozenset(res)
+
+    @property
+    def initial_configuration(self) -> frozenset:
+        return self._initial_configuration
+
+    """
+    Return the configuration reached by reading the passed label (empty if the label is not enabled)
+    """
+    def step(self, configuration : frozenset, label : str) -> frozenset:
+        reached = set()
+
+        for curr in configuration:
+            if isinstance(curr, str):
+                reached.update(self._skeleton.read_symbol(label, curr))
+            else:
+                entry, parts = curr
+                _, components, dispatch = self._boxes[entry]
+
+                pos = dispatch.get(label)
+                if pos is None:
+                    continue
+
+                part = components[pos].step(parts[pos], label)
+                if part:
+                    reached.add((entry, parts[:pos] + (part, ) + parts[pos + 1:]))
+
+        return self._closure(reached) if reached else frozenset()
+
+    def is_accepting(self, configuration : frozenset) -> bool:
+        return any(isinstance(curr, str) and self._skeleton.is_final(curr) for curr in configuration)
+
+    """
+    Return the ids of the states (of the skeleton and of the components) that are active in the
+    passed configuration
+    """
+    def active_states(self, configuration : frozenset) -> set:
+        res = set()
+
+        for curr in configuration:
+            if isinstance(curr, str):
+                res.add(curr)
+            else:
+                entry, parts = curr
+                _, components, _ = self._boxes[entry]
+
+                for c, p in zip(components, parts):
+                    res.update(c.active_states(p))
+
+        return res
+
+    """
+    Return the fingerprint of the automaton, combining the ones of the skeleton and of the
+    components of every box (see NFA.fingerprint)
+    """
+    def fingerprint(self) -> str:
+        return canonical_hash({
+            "skeleton": self._skeleton.fingerprint(),
+            "boxes": sorted([ entry, exit, [ c.fingerprint() for c in components ] ] for entry, (exit, components, _) in self._boxes.items()),
+        })
+
+    """
+    Build the equivalent automaton, where the Par nodes are translated into product automata
+    """
+    def to_nfa(self) -> NFA:
+        return ReiToNFA(self._rei, prefix=self._prefix)
+
+    def to_dfa(self):
+        return self.to_nfa().to_dfa()
+
+    def to_dot(self):
+        return self.to_nfa().to_dot()
+
+    """
+    Return the table interning the labels of the skeleton and of all the components, in this order
+    """
+    @property
+    def symbols(self) -> SymbolTable:
+        if self._symbols is None:
+            self._symbols = SymbolTable(label for a in self._automata() for _, label in a.symbols)
+
+        return self._symbols
+
+    """
+    Return the mapping from the short names of the labels (see symbols) to the labels
+    """
+    @property
+    def event_dictionary(self):
+        return { SymbolTable.short_name(code): label for code, label in self.symbols }
+
+    # read-only NFA interface, over the states of the skeleton and of all the components
+
+    @property
+    def states(self):
+        return [ s for a in self._automata() for s in a.states ]
+
+    @property
+    def transitions(self):
+        return [ t for a in self._automata() for t in a.transitions ]
+
+    @property
+    def final(self):
+        return [ s for a in self._automata() for s in a.final ]
+
+    @property
+    def initial(self) -> State:
+        return self._skeleton.initial
+
+    def is_final(self, states) -> bool:
+        if isinstance(states, State):
+            states = states.id
+        if isinstance(states, str):
+            states = set([ states ])
+
+        return any(a.is_final(states.intersection(a._states.keys())) for a in self._automata())
+
+    def is_initial(self, state) -> bool:
+        return self._skeleton.is_initial(state)
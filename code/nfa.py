@@ -1,12 +1,19 @@
 from lib2to3.pygram import Symbols
-from rei import REI, Start, End, Symbol, Star, Conc, Par, Union
+from rei import REI, Start, End, Epsilon, Symbol, Star, Conc, Par, Union
+import os
 import random
 import string
-import itertools
+import hashlib
+import json
+import codecs
+from collections import deque, OrderedDict
+from threading import Lock
+from array import array
+from bisect import bisect_left, bisect_right
 from deprecation import deprecated
 from graphviz import Digraph
+from symbols import EPSILON, SymbolTable
 
-EPSILON = ""
 
 def random_string(length:int = 8):
     # choose from all lowercase letter
@@ -16,6 +23,15 @@ def random_string(length:int = 8):
     return result_str
 
 
+"""
+Return a hex digest of the passed canonical (JSON-serializable) description of an automaton:
+equal descriptions give equal digests, across processes and restarts
+"""
+def canonical_hash(data) -> str:
+    text = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
 class State:
 
     def __init__(self, id:str = None):
@@ -31,14 +47,14 @@ class State:
         return f"State({self.__id})"
 
     def __hash__(self):
-        return hash(hash(str(self)))
+        return hash(self.__id)
 
     @property
     def id(self):
         return self.__id
 
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and hash(self) == hash(other)
+        return self.__class__ == other.__class__ and self.__id == other.id
 
 class Transition:
 
@@ -52,10 +68,13 @@ class Transition:
         return f"{self.__source} -[{self.__label}]-> {self.__target}"
 
     def __hash__(self):
-        return hash(hash(str(self)))
+        return hash((self.__source.id, self.__target.id, self.__label))
 
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and hash(self) == hash(other)
+        return self.__class__ == other.__class__ and \
+            self.__label == other.label and \
+            self.__source == other.source and \
+            self.__target == other.target
 
     @property
     def source(self):
@@ -71,15 +90,22 @@ class Transition:
 
 class InputScanner:
 
+    # number of readings that can be undone (see undo_reading): the positions before them are
+    # discarded, so that the memory of the scanner does not grow with the number of tokens read
+    UNDO_DEPTH = 1024
+
     def __init__(self, text : str, pos : int = 0):
         self._text = text
         self._input_len = len(text)
         self._positions = []
+        # number of positions discarded from the bottom of the stack
+        self._discarded = 0
 
         if pos > self._input_len:
             raise Exception(f"Position not allowed: {pos}. Input length: {self._input_len}")
 
         self._positions.append(pos)
+        # (number of positions, position) at each freeze
         self._frozen = []
 
 
@@ -92,16 +118,21 @@ class InputScanner:
         self.unfreeze()
 
     def freeze(self):
-        curr_len = len(self._positions)
-        self._frozen.append(curr_len)
+        curr_len = self._discarded + len(self._positions)
+        self._frozen.append((curr_len, self.pos))
         return curr_len
 
     def unfreeze(self):
         if len(self._frozen) == 0:
             raise Exception("Too many unfrozen actions happend on this scanner")
 
-        curr_len = self._frozen.pop()
-        del self._positions[curr_len:]
+        curr_len, pos = self._frozen.pop()
+        if curr_len > self._discarded:
+            del self._positions[curr_len - self._discarded:]
+        else:
+            # the positions up to the frozen one were discarded
+            self._positions = [ pos ]
+            self._discarded = curr_len - 1
 
     @property
     def eof(self) -> bool:
@@ -136,14 +167,11 @@ class InputScanner:
             delimiter = self._text[pos_start]
             pos_start = pos_start + 1
             
-        pos_end = pos_start
-        token = ""
-        while pos_end < self._input_len and self._text[pos_end] != delimiter:
-            token = token + self._text[pos_end]
-            pos_end = pos_end + 1
-
-        if delimiter != " " and self._text[pos_end] != delimiter:
-            raise Exception(f"End reached without finding expected delimiter ({delimiter})")
+        pos_end = self._text.find(delimiter, pos_start)
+        if pos_end < 0:
+            if delimiter != " ":
+                raise Exception(f"End reached without finding expected delimiter ({delimiter})")
+            pos_end = self._input_len
 
         token = self._text[pos_start:pos_end]
         pos_end = pos_end + 1
@@ -154,11 +182,26 @@ class InputScanner:
 
         self._positions.append(pos_end)
 
+        if len(self._positions) > 2 * self.UNDO_DEPTH:
+            # discarded in batches, so that reading a token costs constant time
+            excess = len(self._positions) - self.UNDO_DEPTH - 1
+            del self._positions[:excess]
+            self._discarded += excess
+
         return token
 
+    """
+    Return the list of all the tokens of the input (see tokenize_events)
+    """
+    @staticmethod
+    def tokenize(text : str) -> list:
+        return list(tokenize_events(text))
+
     def undo_reading(self) -> int:
         if len(self._positions) == 0:
             raise Exception("Cannot undo reading anymore. Reading stack empty")
+        if len(self._positions) == 1 and self._discarded > 0:
+            raise Exception(f"Cannot undo reading anymore. Only the last {self.UNDO_DEPTH} readings can be undone")
         if len(self._positions) == 1:
             raise Exception(f"Cannot undo reading anymore. Reached the initial position: {self._positions[0]}")
 
@@ -166,6 +209,500 @@ class InputScanner:
         return pos_prev
     
 
+"""
+Yield the events of the passed source one at a time, with the quoting rules of InputScanner:
+events are separated by spaces, and an event enclosed in single quotes may contain spaces.
+Leading spaces are skipped, rather than read as an empty event.
+
+The source may be a string, a file object (text or binary) or any iterable of string or bytes
+chunks; bytes are decoded as UTF-8. The source is read chunk_size characters at a time and only
+the chunks of the current event are kept, so memory is bounded by the longest event rather than
+by the whole input. Raises an exception if the source ends within a quoted event.
+"""
+def tokenize_events(source, chunk_size : int = 65536):
+    if isinstance(source, (str, bytes)):
+        chunks = (source[pos:pos + chunk_size] for pos in range(0, len(source), chunk_size))
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
+    else:
+        chunks = iter(source)
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pieces = []         # chunks of the current event
+    in_event = False
+    quoted = False
+
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+
+        pos = 0
+        end = len(chunk)
+
+        while pos < end:
+            if not in_event:
+                while pos < end and chunk[pos] == " ":
+                    pos = pos + 1
+                if pos == end:
+                    break
+
+                in_event = True
+                quoted = chunk[pos] == "'"
+                if quoted:
+                    pos = pos + 1
+
+            delimiter = chunk.find("'" if quoted else " ", pos)
+            if delimiter < 0:
+                pieces.append(chunk[pos:])
+                break
+
+            pieces.append(chunk[pos:delimiter])
+            yield "".join(pieces)
+
+            pieces.clear()
+            in_event = False
+            pos = delimiter + 1
+
+    # fails if the bytes end within a character
+    decoder.decode(b"", final=True)
+
+    if quoted and in_event:
+        raise Exception(f"End reached without finding expected delimiter (')")
+
+    if in_event:
+        yield "".join(pieces)
+
+
+"""
+Read-only, integer-indexed representation of an NFA, built by NFA.freeze().
+
+- states are numbered densely (0 .. num_states-1), following their insertion order
+- labels are interned into integer codes; code 0 is reserved for epsilon
+- the outgoing edges of state i are stored CSR-style in the slice offsets[i] .. offsets[i+1]
+  of the arrays edge_labels and edge_targets, sorted by label code
+
+State and Transition objects returned by this class are views over the states of the
+originating automaton: no copy is made.
+"""
+class CompactNFA:
+
+    EPSILON_CODE = SymbolTable.EPSILON_CODE
+
+    # maximum number of results kept by the caches of step_states and enabled_codes
+    STEP_CACHE_SIZE = 4096
+
+    def __init__(self, automaton):
+        self._states = list(automaton.states)
+        self._ids = [ s.id for s in self._states ]
+        self._index = { sid: i for i, sid in enumerate(self._ids) }
+
+        # label codes are the ones of the symbol table of the automaton
+        self._symbols : SymbolTable = automaton.symbols
+
+        rows = [ [] for _ in self._ids ]
+        for source, transitions_set in automaton._transitions.items():
+            row = rows[self._index[source]]
+            for label, transitions in transitions_set.items():
+                code = self._symbols.intern(label)
+                for t in transitions:
+                    row.append((code, self._index[t.target.id]))
+
+        self._offsets = array("l", [ 0 ])
+        self._edge_labels = array("l")
+        self._edge_targets = array("l")
+
+        for row in rows:
+            row.sort()
+            for code, target in row:
+                self._edge_labels.append(code)
+                self._edge_targets.append(target)
+            self._offsets.append(len(self._edge_targets))
+
+        self._initial = self._index.get(automaton._initial, -1)
+        self._final = bytearray(len(self._ids))
+        for sid in automaton._final:
+            self._final[self._index[sid]] = 1
+
+        self._init_caches()
+
+    """
+    Build the compact automaton straight from its arrays (e.g. views over a mapped file, see
+    serialization.load): the arrays are used as they are, no copy is made. The State objects
+    are new ones, named after the passed ids.
+    """
+    @classmethod
+    def from_arrays(cls, ids, symbols : SymbolTable, offsets, edge_labels, edge_targets, final, initial : int):
+        res = cls.__new__(cls)
+
+        res._ids = list(ids)
+        res._states = [ State(sid) for sid in res._ids ]
+        res._index = { sid: i for i, sid in enumerate(res._ids) }
+        res._symbols = symbols
+        res._offsets = offsets
+        res._edge_labels = edge_labels
+        res._edge_targets = edge_targets
+        res._final = final
+        res._initial = initial
+
+        res._init_caches()
+
+        return res
+
+    def _init_caches(self):
+        # epsilon-closures, computed on demand
+        self._closures : list = None
+        self._id_closures = {}
+
+        # bitmask views of the closures and of the successors, computed on demand
+        self._closure_masks = {}
+        self._successor_masks = {}
+        self._final_mask = 0
+        for i, is_final in enumerate(self._final):
+            if is_final:
+                self._final_mask |= 1 << i
+
+        # (frozenset of indexes, label code) -> result of step_states
+        self._steps = {}
+        # frozenset of indexes -> result of enabled_codes
+        self._enabled_codes = {}
+
+    def __str__(self):
+        return f"{self.num_states} states, {self.num_transitions} transitions, {self.num_labels} labels (compact)"
+
+    """
+    Build an NFA with the same states, transitions and symbol table: the compact automaton
+    becomes its frozen representation, so it is not rebuilt by NFA.freeze()
+    """
+    def to_nfa(self):
+        res = NFA()
+        res._symbols = self._symbols
+
+        for i, s in enumerate(self._states):
+            res.add_state(s, is_final=self.is_final(i))
+
+        states = self._states
+        labels = [ self._symbols.label(code) for code in range(self.num_labels) ]
+        for i, s in enumerate(states):
+            transitions_set = {}
+            for code, target in self.edges(i):
+                t = Transition(s, states[target], labels[code])
+                transitions_set.setdefault(t.label, set()).add(t)
+
+            for label, transitions in transitions_set.items():
+                res._add_transitions(s.id, label, transitions)
+
+        if self._initial >= 0:
+            res.set_initial(self._states[self._initial])
+
+        res._compact = self
+
+        return res
+
+    @property
+    def num_states(self) -> int:
+        return len(self._ids)
+
+    @property
+    def num_transitions(self) -> int:
+        return len(self._edge_targets)
+
+    # epsilon included
+    @property
+    def num_labels(self) -> int:
+        return len(self._symbols) + 1
+
+    @property
+    def symbols(self) -> SymbolTable:
+        return self._symbols
+
+    @property
+    def initial(self) -> int:
+        return self._initial
+
+    """
+    Return the integer index of the passed state (or state id), None if the state is unknown
+    """
+    def index(self, state) -> int:
+        if isinstance(state, State):
+            state = state.id
+
+        return self._index.get(state)
+
+    def id(self, index : int) -> str:
+        return self._ids[index]
+
+    def state(self, index : int) -> State:
+        return self._states[index]
+
+    """
+    Return the integer code of the passed label, None if the label never occurs in the automaton
+    """
+    def code(self, label) -> int:
+        return self._symbols.code(label)
+
+    def label(self, code : int) -> str:
+        return self._symbols.label(code)
+
+    def is_final(self, index : int) -> bool:
+        return self._final[index] == 1
+
+    """
+    Return the indexes of the states reached from the passed state through the edges
+    with the passed label code. Rows are sorted by label code, so a binary search is used.
+    """
+    def targets(self, index : int, code : int):
+        lo = bisect_left(self._edge_labels, code, self._offsets[index], self._offsets[index + 1])
+        hi = bisect_right(self._edge_labels, code, lo, self._offsets[index + 1])
+
+        return self._edge_targets[lo:hi]
+
+    """
+    Return the (label code, target index) pairs of the edges departing from the passed state
+    """
+    def edges(self, index : int):
+        lo = self._offsets[index]
+        hi = self._offsets[index + 1]
+
+        return zip(self._edge_labels[lo:hi], self._edge_targets[lo:hi])
+
+    def transitions_from(self, index : int, code : int = None):
+        source = self._states[index]
+
+        for pos in range(self._offsets[index], self._offsets[index + 1]):
+            if code is None or self._edge_labels[pos] == code:
+                yield Transition(source, self._states[self._edge_targets[pos]], self._symbols.label(self._edge_labels[pos]))
+
+    """
+    Return the epsilon-closure of the state with the passed index, as a frozenset of indexes.
+    The closures of all the states are computed at the first call (see _compute_closures) and
+    then simply looked up.
+    """
+    def closure(self, index : int) -> frozenset:
+        if self._closures is None:
+            self._closures = self._compute_closures()
+
+        return self._closures[index]
+
+    """
+    Same as closure, but returning the frozenset of state ids
+    """
+    def id_closure(self, index : int) -> frozenset:
+        res = self._id_closures.get(index)
+
+        if res is None:
+            res = frozenset(map(self.id, self.closure(index)))
+            self._id_closures[index] = res
+
+        return res
+
+    def e_closure(self, indexes) -> set:
+        res = set()
+
+        for curr in indexes:
+            res.update(self.closure(curr))
+
+        return res
+
+    """
+    Sets of states can also be represented as int bitmasks, where bit i is set iff the state
+    with index i belongs to the set. Unions and finality checks then become bitwise operations.
+    """
+    @property
+    def final_mask(self) -> int:
+        return self._final_mask
+
+    def to_mask(self, indexes) -> int:
+        mask = 0
+
+        for i in indexes:
+            mask |= 1 << i
+
+        return mask
+
+    def from_mask(self, mask : int):
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def closure_mask(self, index : int) -> int:
+        res = self._closure_masks.get(index)
+
+        if res is None:
+            res = self.to_mask(self.closure(index))
+            self._closure_masks[index] = res
+
+        return res
+
+    """
+    Bitmask version of step: the passed mask must be closed under epsilon transitions. The
+    epsilon-closed successors of every (state, label code) pair are cached as a single mask.
+    """
+    def step_mask(self, mask : int, code : int) -> int:
+        reached = 0
+
+        for i in self.from_mask(mask):
+            successors = self._successor_masks.get((i, code))
+
+            if successors is None:
+                successors = 0
+                for target in self.targets(i, code):
+                    successors |= self.closure_mask(target)
+                self._successor_masks[(i, code)] = successors
+
+            reached |= successors
+
+        return reached
+
+    """
+    Compute the epsilon-closure of every state with Tarjan's algorithm over the epsilon edges.
+    All the states in the same strongly connected component share the same closure, and the
+    components are completed in reverse topological order: the closure of a component is the
+    union of its members and of the (already computed) closures of its successor components.
+    The visit is iterative, so long epsilon chains do not hit the recursion limit.
+    """
+    def _compute_closures(self) -> list:
+        n = self.num_states
+        order = [ -1 ] * n
+        low = [ 0 ] * n
+        component = [ -1 ] * n
+        on_stack = bytearray(n)
+        stack = []
+        closures = []
+        counter = 0
+
+        for root in range(n):
+            if order[root] >= 0:
+                continue
+
+            order[root] = low[root] = counter
+            counter = counter + 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [ (root, iter(self.targets(root, self.EPSILON_CODE))) ]
+
+            while work:
+                v, successors = work[-1]
+
+                descended = False
+                for w in successors:
+                    if order[w] < 0:
+                        order[w] = low[w] = counter
+                        counter = counter + 1
+                        stack.append(w)
+                        on_stack[w] = 1
+                        work.append((w, iter(self.targets(w, self.EPSILON_CODE))))
+                        descended = True
+                        break
+                    elif on_stack[w]:
+                        low[v] = min(low[v], order[w])
+
+                if descended:
+                    continue
+
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+
+                if low[v] == order[v]:
+                    # v is the root of a strongly connected component
+                    curr_component = len(closures)
+                    members = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = 0
+                        component[w] = curr_component
+                        members.append(w)
+                        if w == v:
+                            break
+
+                    closure = set(members)
+                    for m in members:
+                        for w in self.targets(m, self.EPSILON_CODE):
+                            if component[w] != curr_component:
+                                closure.update(closures[component[w]])
+
+                    closures.append(frozenset(closure))
+
+        return [ closures[component[i]] for i in range(n) ]
+
+    """
+    Return the epsilon-closed set of states reached by reading the passed label code from a set
+    of states which is already closed under epsilon transitions
+    """
+    def step(self, indexes, code : int) -> set:
+        reached = set()
+
+        for curr in indexes:
+            reached.update(self.targets(curr, code))
+
+        return self.e_closure(reached)
+
+    """
+    Same as NFA.read_symbol, but working on integer indexes and label codes
+    """
+    def read_symbol(self, code : int, index : int) -> set:
+        reached = set()
+
+        for curr in self.closure(index):
+            reached.update(self.targets(curr, code))
+
+        return self.e_closure(reached)
+
+    """
+    Same as NFA.step, but working on a frozenset of indexes and a label code (None for a label
+    that is not in the table), and returning frozensets of indexes. Results are cached per
+    (frozenset of indexes, code), and the cache is cleared when it holds STEP_CACHE_SIZE results.
+    """
+    def step_states(self, indexes : frozenset, code : int):
+        key = (indexes, code)
+
+        res = self._steps.get(key)
+        if res is None:
+            reached = set()
+            died = []
+            for i in indexes:
+                i_reached = self.read_symbol(code, i) if code else None
+
+                if i_reached:
+                    reached.update(i_reached)
+                else:
+                    died.append(i)
+
+            reached = frozenset(reached)
+            res = (reached, frozenset(died), reached - indexes)
+
+            if len(self._steps) >= self.STEP_CACHE_SIZE:
+                self._steps.clear()
+            self._steps[key] = res
+
+        return res
+
+    """
+    Same as NFA.enabled_labels, but working on a frozenset of indexes and returning the frozenset
+    of the enabled label codes. Results are cached as the ones of step_states.
+    """
+    def enabled_codes(self, indexes : frozenset) -> frozenset:
+        res = self._enabled_codes.get(indexes)
+        if res is None:
+            codes = set()
+            for i in self.e_closure(indexes):
+                codes.update(code for code, _ in self.edges(i))
+            codes.discard(self.EPSILON_CODE)
+
+            res = frozenset(codes)
+
+            if len(self._enabled_codes) >= self.STEP_CACHE_SIZE:
+                self._enabled_codes.clear()
+            self._enabled_codes[indexes] = res
+
+        return res
+
+
+_freeze_lock = Lock()
+
+
 class NFA:
 
     def __init__(self):
@@ -174,8 +711,45 @@ class NFA:
         self._initial:str = None
         self._final = set([])
         self._iscan : InputScanner = None
-        self._event_dictionary = {}
-        self._event_dictionary_lookup = {}
+        self._symbols = SymbolTable()
+        self._compact : CompactNFA = None
+        # reverse indexes, kept up to date by add_transition and _merge (and rebuilt on first use
+        # when unpickled, see _reverse_indexes): target -> label -> transitions, label -> transitions
+        self._transitions_to = {}
+        self._transitions_labeled = {}
+        # list of all the transitions, see transitions
+        self._transitions_list = None
+
+    def __getstate__(self):
+        # derived structures are not pickled: they are rebuilt on demand
+        state = self.__dict__.copy()
+        state["_compact"] = None
+        state["_transitions_to"] = None
+        state["_transitions_labeled"] = None
+        state["_transitions_list"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compact = None
+        self._transitions_list = None
+        # caches of step and enabled_labels, now kept by the compact representation
+        self.__dict__.pop("_steps", None)
+        self.__dict__.pop("_enabled_labels", None)
+
+        if "_symbols" not in state:
+            # pickled before the symbol table was introduced
+            self._symbols = SymbolTable()
+            for source, transitions_set in self._transitions.items():
+                for label in transitions_set.keys():
+                    self._symbols.intern(label)
+            self.__dict__.pop("_event_dictionary", None)
+            self.__dict__.pop("_event_dictionary_lookup", None)
+
+        if "_transitions_to" not in state:
+            # pickled before the reverse indexes were introduced
+            self._transitions_to = None
+            self._transitions_labeled = None
 
     def __str__(self):
         return f"{len(self.states)} states, {len(self.transitions)} transitions, initial: {self._initial}, {len(self.final)} final states"
@@ -193,7 +767,7 @@ class NFA:
         g.attr("edge", arrowsize="0.5")
         for source,tr_dict in self._transitions.items():
             for label, tr_set in tr_dict.items():
-                label = self._event_dictionary[label] if label else "<&#949;>"
+                label = SymbolTable.short_name(self._symbols.code(label)) if label else "<&#949;>"
                 for tr in tr_set:
 #                    print(f"Add transition: {tr.source} -> {tr.target} ...")
                     #label = tr.label if tr.label else "<&#949;>"
@@ -203,9 +777,179 @@ class NFA:
 #        print(g)
         return g
      
+    """
+    Return the compact (integer-indexed) representation of the automaton. It is built once and
+    cached: any later change to states, transitions, initial or final states discards it, and
+    it is rebuilt on the next call.
+    """
+    def freeze(self) -> CompactNFA:
+        compact = self._compact
+
+        if compact is None:
+            # threads reading the automaton at once build it only once
+            with _freeze_lock:
+                if self._compact is None:
+                    self._compact = CompactNFA(self)
+                compact = self._compact
+
+        return compact
+
+    @property
+    def frozen(self) -> bool:
+        return self._compact is not None
+
+    def _invalidate(self):
+        self._compact = None
+
+    """
+    Return the deterministic automaton recognizing the same language, built by subset
+    construction over the epsilon-closed sets of states (see dfa.NFAToDFA)
+    """
+    def to_dfa(self):
+        from dfa import NFAToDFA
+        return NFAToDFA(self)
+
+    """
+    Return the minimal deterministic automaton recognizing the same language, as an NFA
+    (see dfa.MinimizeDFA). Use to_dfa().minimize() to keep the mapping from its states back
+    to the states of this automaton.
+    """
+    def minimize(self):
+        return self.to_dfa().minimize().to_nfa()
+
+    """
+    Return an equivalent automaton without epsilon transitions. Every state q gets the labeled
+    transitions departing from the states of its epsilon-closure, and it is final iff its
+    epsilon-closure contains a final state. Only the states reachable from the initial one
+    through the new transitions are kept; they keep their ids.
+    """
+    def remove_epsilons(self):
+        compact = self.freeze()
+
+        a = NFA()
+        if compact.initial < 0:
+            return a
+
+        def visit(index : int):
+            is_final = any(compact.is_final(i) for i in compact.closure(index))
+            a.add_state(compact.state(index), is_final=is_final)
+            visited.add(index)
+            queue.append(index)
+
+        visited = set()
+        queue = deque()
+        visit(compact.initial)
+
+        while queue:
+            curr = queue.popleft()
+            source = compact.state(curr)
+
+            edges = set()
+            for i in compact.closure(curr):
+                for code, target in compact.edges(i):
+                    if code != CompactNFA.EPSILON_CODE:
+                        edges.add((code, target))
+
+            for code, target in sorted(edges):
+                if target not in visited:
+                    visit(target)
+
+                a.add_transition(source, compact.state(target), compact.label(code))
+
+        a.set_initial(compact.id(compact.initial))
+
+        return a
+
+    """
+    Remove the useless states: the ones that cannot be reached from the initial state (not
+    accessible) and the ones from which no final state can be reached (not co-accessible),
+    together with their transitions. The initial state is always kept. Return a tuple:
+    - NFA : the trimmed automaton, whose states keep their ids
+    - int : the number of removed states
+    - int : the number of removed transitions
+    """
+    def trim(self):
+        compact = self.freeze()
+
+        a = NFA()
+        if compact.initial < 0:
+            return a, compact.num_states, compact.num_transitions
+
+        predecessors = [ [] for _ in range(compact.num_states) ]
+        for i in range(compact.num_states):
+            for _, target in compact.edges(i):
+                predecessors[target].append(i)
+
+        def reach(start, successors) -> set:
+            visited = set(start)
+            queue = deque(visited)
+
+            while queue:
+                curr = queue.popleft()
+                for target in successors(curr):
+                    if target not in visited:
+                        visited.add(target)
+                        queue.append(target)
+
+            return visited
+
+        accessible = reach([ compact.initial ], lambda i: (target for _, target in compact.edges(i)))
+        co_accessible = reach([ i for i in range(compact.num_states) if compact.is_final(i) ], predecessors.__getitem__)
+
+        kept = accessible & co_accessible
+        kept.add(compact.initial)
+
+        num_transitions = 0
+        for i in sorted(kept):
+            a.add_state(compact.state(i), is_final=compact.is_final(i))
+
+        for i in sorted(kept):
+            for code, target in compact.edges(i):
+                if target in kept:
+                    a.add_transition(compact.state(i), compact.state(target), compact.label(code))
+                    num_transitions = num_transitions + 1
+
+        a.set_initial(compact.id(compact.initial))
+
+        return a, compact.num_states - len(kept), compact.num_transitions - num_transitions
+
+    """
+    Return whether the automaton has at least one epsilon transition
+    """
+    @property
+    def has_epsilons(self) -> bool:
+        self._reverse_indexes()
+
+        return any(self._transitions_labeled.get(label) for label in [ EPSILON, None ])
+
+    """
+    Return the fingerprint of the automaton: a hash of its states, initial and final states and
+    transitions, in canonical (sorted) order. ReiToNFA derives the state ids from the REI, so the
+    same REI always yields the same fingerprint, which can key caches of automata and contracts.
+    Automata recognizing the same language have the same minimal DFA: to compare languages, use
+    to_dfa().minimize().fingerprint()
+    """
+    def fingerprint(self) -> str:
+        return canonical_hash({
+            "states": sorted(self._states.keys()),
+            "initial": self._initial,
+            "final": sorted(self._final),
+            "transitions": sorted([ t.source.id, t.label or EPSILON, t.target.id ] for t in self.transitions),
+        })
+
+    """
+    Return the table interning the labels of the transitions into integer codes
+    """
+    @property
+    def symbols(self) -> SymbolTable:
+        return self._symbols
+
+    """
+    Return the mapping from the short names of the labels (used by to_dot) to the labels
+    """
     @property
     def event_dictionary(self):
-        return self._event_dictionary_lookup
+        return { SymbolTable.short_name(code): label for code, label in self._symbols }
    
 
     @property
@@ -227,20 +971,27 @@ class NFA:
         return self.get_state(id)
 
     def add_state(self, new_state:State, is_final:bool=False):
+        self._invalidate()
         self._states[new_state.id] = new_state
 
         if is_final:
             self._final.add(new_state.id)
 
+    """
+    Return the list of all the transitions. It is built once and then kept up to date by
+    add_transition and _merge, so it must not be changed by the caller.
+    """
     @property
     def transitions(self):
-        res = []
-        for source, transitions_set in self._transitions.items():
-            for symbol, targets in transitions_set.items():
-                res.extend(targets)
+        if self._transitions_list is None:
+            res = []
+            for source, transitions_set in self._transitions.items():
+                for symbol, targets in transitions_set.items():
+                    res.extend(targets)
 
+            self._transitions_list = res
 
-        return res
+        return self._transitions_list
 
     """
     Return the set of all transitions departing from the passed source state. If a label is 
@@ -269,7 +1020,8 @@ class NFA:
 
     """
     Return the set of all transitions reaching the passed target state. If a label is specified,
-    only thos transitions that share that label are returned.
+    only thos transitions that share that label are returned. The lookup uses the incoming-edge
+    index, so it only visits the transitions reaching the target.
     """
     def transitions_to(self, target, label=None, source=None):
         if isinstance(target, State):
@@ -282,22 +1034,29 @@ class NFA:
 
         assert source is None or isinstance(source, str)
 
-        res = []
-        for s, dict_transitions in self._transitions.items():
-            if source and source != s:
-                continue
+        self._reverse_indexes()
 
-            for symbol, transitions in dict_transitions.items():
-                if label is None or label == symbol:
-                    for curr in transitions:
-                        assert isinstance(curr, Transition)
-                        if curr.target.id == target:
-                            res.append(curr)
+        dict_transitions = self._transitions_to.get(target, {})
+        if label is None:
+            candidates = dict_transitions.values()
+        else:
+            candidates = [ dict_transitions.get(label, ()) ]
 
-        return set(res)
+        res = set()
+        for transitions in candidates:
+            for curr in transitions:
+                if not source or curr.source.id == source:
+                    res.add(curr)
+
+        return res
 
+    """
+    Return the set of all transitions sharing the passed label (use EPSILON for the epsilon transitions)
+    """
     def transitions_labeled(self, label:str):
-        return filter(lambda curr: curr.label == label, self.transitions)
+        self._reverse_indexes()
+
+        return set(self._transitions_labeled.get(label, ()))
 
     """
     This is just an alias
@@ -312,6 +1071,7 @@ class NFA:
     one will be returned later on.
     """
     def add_transition(self, source, target, label=EPSILON):
+        self._invalidate()
 
         if isinstance(source, State):
             source_state = source
@@ -331,21 +1091,93 @@ class NFA:
         assert isinstance(target, str)
         assert isinstance(target_state, State)
 
+        self._reverse_indexes()
+
         transition_set = self._transitions.get(source, {})
         labeled_transition_set = transition_set.get(label, set([]))
-        labeled_transition_set.add(Transition(source_state, target_state, label))
+        new_transition = Transition(source_state, target_state, label)
+        if new_transition not in labeled_transition_set:
+            labeled_transition_set.add(new_transition)
+            self._index_transition(new_transition)
 
         transition_set[label] = labeled_transition_set
         self._transitions[source] = transition_set
 
-        if label and label not in self._event_dictionary:
-            new_code = self._generate_label_code()
-            self._event_dictionary[label] = new_code
-            self._event_dictionary_lookup[new_code] = label
+        self._symbols.intern(label)
+
+    """
+    Add the states and transitions of the passed automaton (not its initial and final states),
+    sharing its immutable State and Transition objects: whole sets of transitions are merged
+    at once, rather than added one by one.
+    """
+    def _merge(self, other):
+        self._invalidate()
+        self._reverse_indexes()
+        other._reverse_indexes()
 
-    def _generate_label_code(self):
-        # TODO note that this works only for limited sets of symbols
-        return chr(ord('A') + len(self._event_dictionary.items())) 
+        self._states.update(other._states)
+
+        for source, transitions_set in other._transitions.items():
+            merged = self._transitions.setdefault(source, {})
+            for label, transitions in transitions_set.items():
+                merged.setdefault(label, set()).update(transitions)
+
+        # the indexes are merged in the same way
+        for target, transitions_set in other._transitions_to.items():
+            merged = self._transitions_to.setdefault(target, {})
+            for label, transitions in transitions_set.items():
+                merged.setdefault(label, set()).update(transitions)
+
+        for label, transitions in other._transitions_labeled.items():
+            self._transitions_labeled.setdefault(label, set()).update(transitions)
+
+        self._transitions_list = None
+
+        for _, label in other._symbols:
+            self._symbols.intern(label)
+
+    """
+    Return a copy of the automaton, sharing its immutable State and Transition objects (see _merge)
+    """
+    def copy(self):
+        res = NFA()
+        res._merge(self)
+        res._initial = self._initial
+        res._final = set(self._final)
+        return res
+
+    """
+    Add the passed set of transitions from source with the passed label, whose label is already
+    in the symbol table, keeping the indexes up to date
+    """
+    def _add_transitions(self, source : str, label, transitions : set):
+        self._invalidate()
+        self._reverse_indexes()
+
+        self._transitions.setdefault(source, {}).setdefault(label, set()).update(transitions)
+
+        for t in transitions:
+            self._transitions_to.setdefault(t.target.id, {}).setdefault(label, set()).add(t)
+        self._transitions_labeled.setdefault(label, set()).update(transitions)
+
+        self._transitions_list = None
+
+    def _reverse_indexes(self):
+        if self._transitions_to is None:
+            self._transitions_to = {}
+            self._transitions_labeled = {}
+            for t in self.transitions:
+                self._transitions_to.setdefault(t.target.id, {}).setdefault(t.label, set()).add(t)
+                self._transitions_labeled.setdefault(t.label, set()).add(t)
+
+    def _index_transition(self, t : Transition):
+        to_target = self._transitions_to.setdefault(t.target.id, {})
+        to_target.setdefault(t.label, set()).add(t)
+
+        self._transitions_labeled.setdefault(t.label, set()).add(t)
+
+        if self._transitions_list is not None:
+            self._transitions_list.append(t)
 
     """
     Return the states that are actually final states
@@ -392,7 +1224,8 @@ class NFA:
     Add one or more states to the set of final states
     """
     def add_final(self, *states):
-        
+        self._invalidate()
+
         for state in states:
             if isinstance(state, State):
                 state = state.id
@@ -416,6 +1249,7 @@ class NFA:
         except Exception as e:
             # in case of errors, restore previous final states
             self._final = prev_final
+            self._invalidate()
             raise e
 
     @property
@@ -431,6 +1265,7 @@ class NFA:
 
 
     def set_initial(self, state):
+        self._invalidate()
         if isinstance(state, State):
             state = state.id
 
@@ -455,21 +1290,24 @@ class NFA:
     - bool  : whether the string was recognized
     - State : the final state reached consuming all possible characters from the input string
     - str   : remaining part of input that was not consumed
+
+    The scanner is local to the call: the automaton can be read by many threads at once.
     """
     def read_string(self, input_string : str, curr_state = None):
 
-        res = None
-        try:
-            self._iscan = InputScanner(input_string)
+        return self.do_read(curr_state, InputScanner(input_string))
 
-            res = self.do_read(curr_state)
-        finally:
-            self._iscan = None
-
-        return res
 
+    """
+    Read the input by simulating the automaton on sets of states (Thompson's construction),
+    without backtracking: at each step the whole epsilon-closed set of current states is advanced
+    by one symbol, so each symbol is processed once per state. Reading stops at the first symbol
+    that cannot be consumed by any state, so the returned states are the ones reached by the
+    longest prefix of the input accepted by the automaton.
 
-    def do_read(self, initial_state = None):
+    The input is read from the passed scanner or, if none is passed, from the one set by scan_input.
+    """
+    def do_read(self, initial_state = None, scanner : InputScanner = None):
 
         if not self._initial:
             raise Exception(f"Cannot read string without an initial state")
@@ -483,100 +1321,182 @@ class NFA:
             curr_state = curr_state.id
 
         assert isinstance(curr_state, str), f"Expected string, received: {curr_state}"
-        
-        reached = set()
 
+        if scanner is None:
+            scanner = self._iscan
 
-        with self._iscan:
+        return self.read_from(scanner, [ curr_state ])
 
-            while not self._iscan.eof:
+    """
+    Reentrant reading: the scanner and the current states (the cursor) are passed explicitly,
+    and nothing is stored in the automaton, so that one automaton can serve many threads at
+    once. curr_states is a collection of state ids, e.g. the states returned by a previous call
+    to resume reading from there; it is closed under epsilon transitions before reading.
+    The scanner is left at its position (see InputScanner.freeze). Returns the same tuple of
+    read_string.
+    """
+    def read_from(self, scanner : InputScanner, curr_states = None):
 
-                symbol : str = self._iscan.scan_input()
+        compact = self.freeze()
 
-                reached = self.read_symbol(symbol, curr_state)
-                num_reached = len(reached)
+        if curr_states is None:
+            if compact.initial < 0:
+                raise Exception(f"Cannot read string without an initial state")
+            curr_states = [ compact.id(compact.initial) ]
 
-                if num_reached == 0:
-                    self._iscan.undo_reading()
-                    new_state, _ = self.e_extension(curr_state)
-                    return False, set([new_state]), self._iscan.remaining    
-                elif num_reached == 1:
-                    # deterministic transition -> continue
-                    curr_state = reached.pop()
-                else:
-                    # non deterministic transition -> explore the tree, looking for one recognizing path
-                    remaining_shortest = None
-                    remaining_reachable = set()
-                    accepting_reachable = set()
+        indexes = []
+        for curr_state in curr_states:
+            index = compact.index(curr_state)
+            if index is None:
+                raise Exception(f"State {curr_state} does not exist")
+            indexes.append(index)
 
-                    for s in reached:
-                        assert isinstance(s, str)
+        curr_states = compact.e_closure(indexes)
 
-                        accepted, s_next, remaining = self.do_read(s) 
+        with scanner:
 
+            while not scanner.eof:
 
-                        if accepted:
-                            assert remaining == ""
-                            accepting_reachable = accepting_reachable.union(s_next)
-                        else:
-                            if remaining_shortest is None or len(remaining) < len(remaining_shortest):
-                                remaining_shortest = remaining
-                                remaining_reachable = s_next
-                            elif remaining_shortest == remaining:
-                                remaining_reachable = remaining_reachable.union(s_next)
+                symbol : str = scanner.scan_input()
+
+                code = compact.code(symbol)
+                reached = compact.step(curr_states, code) if code is not None else None
+
+                if not reached:
+                    scanner.undo_reading()
+                    break
+
+                curr_states = reached
+
+            states = set(map(compact.id, curr_states))
+            remaining = scanner.remaining
+            is_accepted = scanner.eof and self.is_final(states)
+
+            return is_accepted, states, remaining
+
+
+
+    """
+    Check a batch of traces against the automaton. Each trace is either a list of labels or a
+    string in the same format accepted by read_string. Returns a list with a pair per trace:
+    - bool : whether the trace is accepted
+    - int  : None if the trace is accepted, otherwise the position of the first event that
+             could not be consumed (the length of the trace if all the events were consumed
+             without reaching a final state)
+
+    The traces are advanced in lockstep, one event per round, on bitmask state sets. The step
+    from a state set through a label is memoized across the whole batch, so traces sharing a
+    prefix (or reaching the same state set) share the work.
+    """
+    def check_traces(self, traces, curr_state = None) -> list:
+
+        if not self._initial:
+            raise Exception(f"Cannot read string without an initial state")
+
+        if curr_state is None:
+            curr_state = self._initial
+        elif isinstance(curr_state, State):
+            curr_state = curr_state.id
+
+        compact = self.freeze()
+
+        index = compact.index(curr_state)
+        if index is None:
+            raise Exception(f"State {curr_state} does not exist")
+
+        traces = [ InputScanner.tokenize(t) if isinstance(t, str) else list(t) for t in traces ]
+
+        steps = {}
+        masks = [ compact.closure_mask(index) ] * len(traces)
+        results = [ None ] * len(traces)
 
-                    if accepting_reachable:
-                        return True, accepting_reachable, ""
-                    else:
-                        return False, remaining_reachable, remaining_shortest
+        pos = 0
+        active = range(len(traces))
+        while active:
+            still_active = []
 
-            e_closure = self.e_closure(curr_state)
-            remaining = self._iscan.remaining
-            is_accepted = self.is_final(e_closure)
+            for t in active:
+                events = traces[t]
 
-            return is_accepted, e_closure, remaining 
+                if pos == len(events):
+                    accepted = masks[t] & compact.final_mask != 0
+                    results[t] = (accepted, None if accepted else pos)
+                    continue
 
+                code = compact.code(events[pos])
+                key = (masks[t], code)
 
+                reached = steps.get(key)
+                if reached is None:
+                    reached = compact.step_mask(masks[t], code) if code is not None else 0
+                    steps[key] = reached
 
+                if reached == 0:
+                    results[t] = (False, pos)
+                else:
+                    masks[t] = reached
+                    still_active.append(t)
+
+            active = still_active
+            pos = pos + 1
+
+        return results
+
+    """
+    Return the set of state ids reached from the passed state by reading one symbol. Epsilon
+    transitions are followed both before and after the symbol is read. The lookup runs on the
+    compact representation of the automaton (see freeze), using integer indexes and label codes.
+    """
     def read_symbol(self, symbol : str, curr_state : str):
 
-            reached = set([])
+        compact = self.freeze()
 
-            if curr_state not in self._transitions:
-                return set()
-            
-            transitions = self.transitions_from(curr_state, symbol)
-            e_closure = self.e_closure(curr_state)
+        code = compact.code(symbol)
+        index = compact.index(curr_state)
 
-            # add to the transition set also the transitions departing from the states in the
-            # epsilon-closure starting from current state
-            for curr in e_closure:
-                if curr != curr_state:
-                    transitions = transitions.union(self.transitions_from(curr, symbol))
+        if code is None or index is None:
+            return set()
 
-            if len(transitions) == 0:
-                return set()
+        return set(map(compact.id, compact.read_symbol(code, index)))
 
-            elif len(transitions) == 1:
-                # deterministic transition -> continue
-                curr_state = list(transitions)[0].target
-                reached.add(curr_state.id)
+    """
+    Read one label from a set of states (e.g. the current states of an engine). Return a tuple
+    of frozensets of state ids:
+    - reached : the states reached, following epsilon transitions before and after the label
+    - died    : the passed states from which the label cannot be read
+    - added   : the reached states that were not among the passed ones
+
+    The passed ids that are not states of the automaton are among the died ones. The results are
+    computed and cached on the compact representation (see CompactNFA.step_states), so that
+    checking whether a label is enabled and then reading it costs a single computation.
+    """
+    def step(self, states, label : str):
+        compact = self.freeze()
 
-            else:
-                # non deterministic transition -> explore the tree, looking for one recognizing path
+        states = frozenset(states)
+        indexes = frozenset(i for i in map(compact.index, states) if i is not None)
+        unknown = frozenset(s for s in states if compact.index(s) is None)
 
-                for t_out in transitions:
-                    assert isinstance(t_out, Transition)
+        reached, died, added = compact.step_states(indexes, compact.code(label))
 
-                    reached.add(t_out.target.id)
+        return (frozenset(map(compact.id, reached)), frozenset(map(compact.id, died)) | unknown, frozenset(map(compact.id, added)))
+
+    """
+    Return the frozenset of the labels that can be read from the passed set of states, i.e. the
+    labels of the transitions departing from their epsilon-closure: a label is enabled iff it
+    belongs to the set (see CompactNFA.enabled_codes).
+    """
+    def enabled_labels(self, states) -> frozenset:
+        compact = self.freeze()
 
-            for curr in reached:
-                reached = reached.union(self.e_closure(curr))
+        indexes = frozenset(i for i in map(compact.index, states) if i is not None)
 
-            return reached
+        return frozenset(map(compact.label, compact.enabled_codes(indexes)))
 
     """
-    Returns a set of state reachable starting at the passed state by using only epsilon transitions
+    Returns a set of state reachable starting at the passed state by using only epsilon transitions.
+    The closures are looked up in the table precomputed by the compact representation of the
+    automaton (see freeze), which is discarded and recomputed whenever the automaton changes.
     """
     def e_closure(self, states) -> set:
 
@@ -587,22 +1507,13 @@ class NFA:
             
         assert isinstance(states, set), f"A single state or a set of states was expected. Received: {states}"
 
-        res = states
+        compact = self.freeze()
 
-
-        e_transitions = []
+        res = set(states)
         for s in states:
-            for t in self.transitions_from(s):
-                if t.label is None or t.label == "":
-                    e_transitions.append(t)
-
-
-        for curr in e_transitions:
-            assert isinstance(curr, Transition)
-
-            if curr.target.id not in res:
-                ec = self.e_closure(curr.target.id)
-                res = res.union(ec)
+            index = compact.index(s)
+            if index is not None:
+                res.update(compact.id_closure(index))
 
         return res
 
@@ -638,10 +1549,337 @@ class NFA:
         return result
 
 
-def ReiToNFA(rei : REI) -> NFA:
+"""
+Return the prefix of the outermost Par node whose product automaton (see ReiToNFA) contains the
+passed state, None if the state is not a product state or the Par node is the root. The id of a product state joins the ids of
+the states of the items, which start with the prefix of the Par node followed by their position.
+"""
+def par_cluster(state_id : str):
+    if "__" not in state_id:
+        return None
+
+    common = os.path.commonprefix(state_id.split("__"))
+    # the Par node at the root has an empty prefix: its states are not clustered
+    return common[:common.rfind(".") + 1] or None
+
+
+"""
+Return the ids of the states at most hops transitions away (in either direction) from the passed
+states of the automaton (an NFA or any automaton exposing its transitions, e.g. an
+interleaving.InterleavingNFA)
+"""
+def neighbourhood(automaton, states, hops : int) -> set:
+    adjacent = {}
+    for t in automaton.transitions:
+        adjacent.setdefault(t.source.id, set()).add(t.target.id)
+        adjacent.setdefault(t.target.id, set()).add(t.source.id)
+
+    res = set(s.id if isinstance(s, State) else s for s in states)
+    frontier = res
+    for _ in range(hops):
+        frontier = set(n for curr in frontier for n in adjacent.get(curr, ())) - res
+        if not frontier:
+            break
+        res.update(frontier)
+
+    return res
+
+
+def _dot_id(text : str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+"""
+Write the passed automaton (an NFA or any automaton exposing its states and transitions, e.g. an
+interleaving.InterleavingNFA) to out in DOT format, line by line, without building the graph in
+memory as to_dot does. The labels are written by their short names, if the automaton has a symbol
+table (see NFA.event_dictionary).
+
+If states is passed, only those states (e.g. a neighbourhood, see neighbourhood) are written: the
+other ones are collapsed into one node per cluster, standing for all the transitions between them
+and the written states. The states are grouped into clusters by the cluster function (a state id ->
+a cluster name, None for no cluster), by default the product automata of the Par nodes
+(see par_cluster). The current states are highlighted.
+"""
+def write_dot(automaton, out, states = None, current = (), cluster = par_cluster):
+    symbols = getattr(automaton, "symbols", None)
+    current = set(s.id if isinstance(s, State) else s for s in current)
+    cluster = cluster or (lambda state_id: None)
+
+    def label_of(label):
+        if not label:
+            return "<&#949;>"
+        elif symbols is not None:
+            return _dot_id(SymbolTable.short_name(symbols.code(label)))
+        else:
+            return _dot_id(label)
+
+    # cluster -> ids of the written states, cluster -> number of collapsed states
+    shown = {}
+    collapsed = {}
+    for s in automaton.states:
+        group = cluster(s.id)
+        if states is None or s.id in states:
+            shown.setdefault(group, []).append(s.id)
+        else:
+            collapsed[group] = collapsed.get(group, 0) + 1
+
+    def collapsed_id(group):
+        return _dot_id(f"...{group}" if group is not None else "...")
+
+    out.write("digraph curr_graph {\n")
+    out.write("\tgraph [rankdir=LR]\n")
+    out.write("\tnode [shape=point]\n")
+
+    for group, ids in shown.items():
+        indent = "\t"
+        if group is not None:
+            out.write(f"\tsubgraph {_dot_id(f'cluster_{group}')} {{\n")
+            out.write(f"\t\tlabel={_dot_id(f'par {group}')} style=dashed\n")
+            indent = "\t\t"
+
+        for state_id in ids:
+            attributes = 'label=""'
+            if state_id in current:
+                attributes += " shape=circle style=filled fillcolor=red width=0.15"
+            elif automaton.is_initial(state_id):
+                attributes += " shape=circle width=0.1"
+            out.write(f"{indent}{_dot_id(state_id)} [{attributes}]\n")
+
+        if group in collapsed:
+            out.write(f"{indent}{collapsed_id(group)} [label={_dot_id(f'{collapsed[group]} states')} shape=box style=dashed]\n")
+
+        if group is not None:
+            out.write("\t}\n")
+
+    for group, count in collapsed.items():
+        if group not in shown:
+            out.write(f"\t{collapsed_id(group)} [label={_dot_id(f'{count} states')} shape=box style=dashed]\n")
+
+    out.write("\tedge [arrowsize=0.5]\n")
+
+    written = set()
+    for t in automaton.transitions:
+        source, target = t.source.id, t.target.id
+
+        if states is not None:
+            if source not in states and target not in states:
+                continue
+
+            source = _dot_id(source) if source in states else collapsed_id(cluster(source))
+            target = _dot_id(target) if target in states else collapsed_id(cluster(target))
+
+            # the transitions from or to the collapsed states are written once
+            if (source, target, t.label) in written:
+                continue
+            written.add((source, target, t.label))
+        else:
+            source, target = _dot_id(source), _dot_id(target)
+
+        out.write(f"\t{source} -> {target} [label={label_of(t.label)}]\n")
+
+    out.write("}\n")
+
+
+# minimum number of symbols of the items translated in an executor by ReiToNFA
+PARALLEL_MIN_SIZE = 64
+
+
+"""
+Return the number of symbols (Epsilon, Start and End included) occurring in the passed REI
+"""
+def rei_size(rei : REI) -> int:
+    if isinstance(rei, Symbol):
+        return 1
+    elif isinstance(rei, Star):
+        return rei_size(rei.rei)
+    else:
+        return sum(rei_size(curr) for curr in rei.items)
+
+
+def _translate_to_bytes(rei : REI, prefix : str) -> bytes:
+    import serialization
+
+    return serialization.dumps(ReiToNFA(rei, prefix=prefix))
+
+
+"""
+Cache of the automata built by ReiToNFA, indexed by the translated REI node alone. REI nodes are
+hash-consed (see rei.REI): two nodes with the same structure (e.g. the same branch of a choreography,
+translated before and after an edit elsewhere in the diagram) are the same node, and are translated
+into the same automaton, up to the prefix of its states.
+
+The automaton of a node is cached together with the prefix it was built for. If the node is looked
+up at another position (e.g. a branch shifted by an element inserted before it), its states are
+renamed to the new prefix (see _rename_states), which costs a single visit of the automaton and
+no translation. So when the REI of an edited choreography is translated again, only the nodes on
+the path from the changed ones to the root are rebuilt. The least recently used automata are
+discarded once max_size automata are cached. The cached automata are shared: they must not be
+changed.
+"""
+class TranslationCache:
+
+    def __init__(self, max_size : int = 1024):
+        assert max_size > 0
+        self._max_size = max_size
+        # REI node -> (prefix, NFA), in order of use
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f"{len(self._entries)} automata, {self.hits} hits, {self.misses} misses"
+
+    def __len__(self):
+        return len(self._entries)
+
+    """
+    Return the cached automaton of the passed REI node, with its states renamed to the passed
+    prefix if it was built for another one; None if the node is not cached
+    """
+    def get(self, rei : REI, prefix : str) -> NFA:
+        with self._lock:
+            entry = self._entries.get(rei)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(rei)
+
+        cached_prefix, res = entry
+        if cached_prefix != prefix:
+            res = _rename_states(res, cached_prefix, prefix)
+
+        return res
+
+    def put(self, rei : REI, prefix : str, automaton : NFA):
+        with self._lock:
+            self._entries[rei] = (prefix, automaton)
+            self._entries.move_to_end(rei)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+"""
+Return a copy of the passed automaton built by ReiToNFA with the passed old prefix, where the states
+are named after the new prefix: the id of every state (of every part of the id of a product state)
+starts with the old prefix, which is replaced.
+"""
+def _rename_states(automaton : NFA, old_prefix : str, new_prefix : str) -> NFA:
+    def rename(sid : str) -> str:
+        parts = sid.split("__")
+        assert all(part.startswith(old_prefix) for part in parts), f"State {sid} was not built with prefix {old_prefix}"
+
+        return "__".join(new_prefix + part[len(old_prefix):] for part in parts)
+
+    res = NFA()
+    for _, label in automaton._symbols:
+        res._symbols.intern(label)
+
+    states = { sid: State(rename(sid)) for sid in automaton._states }
+    res._states = { s.id: s for s in states.values() }
+    res._final = set(states[sid].id for sid in automaton._final)
+    if automaton._initial is not None:
+        res._initial = states[automaton._initial].id
+
+    for source, transitions_set in automaton._transitions.items():
+        s = states[source]
+        for label, transitions in transitions_set.items():
+            res._add_transitions(s.id, label, set(Transition(s, states[t.target.id], label) for t in transitions))
+
+    return res
+
+
+"""
+Translate the items of the passed Union or Par node, the large ones in the executor (see ReiToNFA)
+"""
+def _translate_items(rei : REI, translate_par, prefix : str, executor, min_size : int, cache : TranslationCache) -> list:
+    res = [ None ] * len(rei.items)
+
+    futures = {}
+    for pos, curr in enumerate(rei.items):
+        assert isinstance(curr, REI)
+
+        if cache is not None:
+            res[pos] = cache.get(curr, f"{prefix}{pos}.")
+
+        if res[pos] is None and executor is not None and rei_size(curr) >= min_size:
+            futures[pos] = executor.submit(_translate_to_bytes, curr, f"{prefix}{pos}.")
+
+    for pos, curr in enumerate(rei.items):
+        if pos in futures:
+            import serialization
+            res[pos] = serialization.loads(futures[pos].result()).to_nfa()
+            if cache is not None:
+                cache.put(curr, f"{prefix}{pos}.", res[pos])
+        elif res[pos] is None:
+            res[pos] = _translate(curr, translate_par, f"{prefix}{pos}.", executor, min_size, cache)
+
+    return res
+
+
+"""
+Translate a REI into an NFA (Thompson-like construction). The Par nodes are translated into the
+product of the automata of their items, unless translate_par is passed: in that case, it is called
+on each Par node (and the prefix of its states) and must return the automaton standing for it
+(see interleaving.InterleavingNFA).
+
+The ids of the states are derived from the position of the nodes in the REI: the items of a node
+with prefix p have prefix p0., p1., ... and the states of the node are named after its prefix
+(e.g. 0.1.i and 0.1.f for the initial and final states of the 2nd item of the 1st item of the
+root). Translating the same REI always yields the same automaton.
+
+If an executor is passed (e.g. a concurrent.futures.ProcessPoolExecutor), the items of the Union
+and Par nodes with at least min_size symbols are translated in the executor, in parallel, and sent
+back in the binary format of the serialization module; the smaller items are not worth the transfer
+and are translated in place. The result is the same as the one of the sequential translation.
+translate_par cannot be used together with an executor.
+
+If a cache is passed, the automata of the nodes found in it are reused (renaming their states if
+they were translated at another position), and the ones of the other nodes are added to it (see
+TranslationCache): the returned automaton may then be shared with the cache, and must be copied (see NFA.copy) before being changed. translate_par cannot be used together with
+a cache, since it may keep track of the Par nodes it translates.
+"""
+def ReiToNFA(rei : REI, translate_par = None, prefix : str = "", executor = None, min_size : int = PARALLEL_MIN_SIZE, cache : TranslationCache = None) -> NFA:
+
+    assert executor is None or translate_par is None, f"Cannot translate the Par nodes in an executor"
+    assert cache is None or translate_par is None, f"Cannot cache the translation of the Par nodes"
+
+    if cache is not None:
+        res = cache.get(rei, prefix)
+        if res is not None:
+            return res
+
+    return _translate(rei, translate_par, prefix, executor, min_size, cache)
+
+
+"""
+Translate the passed REI node (see ReiToNFA) and add its automaton to the cache, if any. The items
+of the node are translated through ReiToNFA, so that their cached automata are reused: those must
+not be changed.
+"""
+def _translate(rei : REI, translate_par, prefix : str, executor, min_size : int, cache : TranslationCache) -> NFA:
+    res = _translate_node(rei, translate_par, prefix, executor, min_size, cache)
+
+    if cache is not None:
+        cache.put(rei, prefix, res)
+
+    return res
+
+
+def _translate_node(rei : REI, translate_par, prefix : str, executor, min_size : int, cache : TranslationCache) -> NFA:
 
     if isinstance(rei, Start) or isinstance(rei, End):
-        s = State()
+        s = State(f"{prefix}e")
         a = NFA()
 
         a.add_state(s, is_final=True)
@@ -650,8 +1888,8 @@ def ReiToNFA(rei : REI) -> NFA:
 
     elif isinstance(rei, Symbol):
 
-        i = State()
-        f = State()
+        i = State(f"{prefix}i")
+        f = State(f"{prefix}f")
 
         a = NFA()
         a.add_state(i)
@@ -665,7 +1903,7 @@ def ReiToNFA(rei : REI) -> NFA:
 
     elif isinstance(rei, Star):
         
-        a : NFA = ReiToNFA(rei.rei)
+        a : NFA = ReiToNFA(rei.rei, translate_par, f"{prefix}0.", executor, min_size, cache).copy()
 
         for f in a.final:
             a.add_transition(f, a.initial)
@@ -681,19 +1919,13 @@ def ReiToNFA(rei : REI) -> NFA:
 
         prev = None
 
-        for curr in rei.items:
+        for pos, curr in enumerate(rei.items):
 
-            b = ReiToNFA(curr)
+            b = ReiToNFA(curr, translate_par, f"{prefix}{pos}.", executor, min_size, cache)
             if prev is None:
                 a.set_initial(b.initial)
 
-            for s in b.states:
-                a.add_state(s)
-
-            for t in b.transitions:
-                assert isinstance(t, Transition)
-
-                a.add_transition(t.source, t.target, t.label)
+            a._merge(b)
 
             if prev is not None:
                 for f in prev.final:
@@ -709,93 +1941,197 @@ def ReiToNFA(rei : REI) -> NFA:
     elif isinstance(rei, Par):
         assert len(rei.items) > 0
 
+        if translate_par is not None:
+            return translate_par(rei, prefix)
+
         a = NFA()
 
-        nfa_children = []
-        state_ids = []
-        state_ids_initial = []
+        nfa_children = _translate_items(rei, translate_par, prefix, executor, min_size, cache)
 
-        # the i-th element is a mapping from the states in the i-th automaton 
-        # to the composite (product) states induced by it
-        # state_ids_map = []
+        # the product is built forward from the tuple of the initial states, so only the
+        # reachable product states are created: each product state moves along the outgoing
+        # transitions of one component at a time (interleaving), the others staying still
+        def add_product_state(sid_parts : tuple) -> str:
+            sid_composite = visited.get(sid_parts)
 
-        for curr in rei.items:
-            assert isinstance(curr, REI)
+            if sid_composite is None:
+                sid_composite = "__".join(sid_parts)
+                visited[sid_parts] = sid_composite
 
-            b = ReiToNFA(curr)
-            nfa_children.append(b)
+                is_final = all(b.is_final(sid) for b, sid in zip(nfa_children, sid_parts))
+                a.add_state(State(sid_composite), is_final=is_final)
+                queue.append(sid_parts)
 
-            automata_state_ids = map(lambda s: s.id, b.states)
-            state_ids.append(automata_state_ids)
-            state_ids_initial.append(b.initial.id)
+            return sid_composite
 
-        for sid_parts in itertools.product(*state_ids):
-            sid_composite = "__".join(sid_parts)
+        visited = {}
+        queue = deque()
+        a.set_initial(add_product_state(tuple(b.initial.id for b in nfa_children)))
 
-            is_final = True
-            for nfa,sid in zip(nfa_children, sid_parts):
-                assert isinstance(nfa, NFA)
-                assert isinstance(sid, str)
+        while queue:
+            sid_parts = queue.popleft()
+            source = visited[sid_parts]
 
-                is_final = nfa.is_final(sid)
-                if not is_final:
-                    break
-                
-            a.add_state(State(sid_composite), is_final=is_final)
-
-        for s in a.states:
-            s_parts = s.id.split("__")
-            
-            for t in a.states:
-                t_parts = t.id.split("__")
-
-                # -1 : not found
-                # -2 : too many differences
-                # >= 0 : exactly one difference at the stored position
-                pos_diff = -1
-                for pos, (s_sid, t_sid) in enumerate(zip(s_parts, t_parts)):
-                    # TODO the condition below does not allow to capture/translate loops
-                    if s_sid != t_sid:
-                        if pos_diff >= 0:
-                            pos_diff = -2
-                            break
-                        else:
-                            pos_diff = pos
-
-                if pos_diff >= 0:
-                    source = s_parts[pos_diff]
-                    target = t_parts[pos_diff]
-                    transitions = nfa_children[pos_diff].transitions_from_to(source, target)    
+            for pos, b in enumerate(nfa_children):
+                for label, transitions in b._transitions.get(sid_parts[pos], {}).items():
                     for tran in transitions:
                         assert isinstance(tran, Transition)
-                        a.add_transition(s, t, tran.label)
 
+                        target_parts = sid_parts[:pos] + (tran.target.id, ) + sid_parts[pos + 1:]
+                        a.add_transition(source, add_product_state(target_parts), label)
 
-        a.set_initial("__".join(state_ids_initial))
-    
         return a
 
     elif isinstance(rei, Union):
         assert len(rei.items) > 0
         
-        i = State()
+        i = State(f"{prefix}u")
         
         a = NFA()
         a.add_state(i)
 
         a.set_initial(i)
 
-        for curr in rei.items:
-            b = ReiToNFA(curr)
+        for b in _translate_items(rei, translate_par, prefix, executor, min_size, cache):
 
-            for s in b.states:
-                a.add_state(s)
-
-            for t in b.transitions:
-                assert isinstance(t, Transition)
-                a.add_transition(t.source, t.target, t.label)
+            a._merge(b)
 
             a.add_transition(i, b.initial)
             a.add_final(*b.final)
 
         return a              
+
+
+"""
+Translate a REI into its Glushkov (position) automaton: there is one state for the initial
+position plus one state per occurrence of a symbol in the REI, and no epsilon transitions.
+The states are named g0 (initial), g1, g2, ... following the order of the occurrences.
+
+The construction computes, bottom-up in a single visit of the REI, whether each node is nullable,
+the transitions entering its first positions and its last positions; the follow transitions are
+added while combining the nodes (from the last positions of a node to the first ones of the next).
+Epsilon, Start and End are nullable nodes without positions. Par is not a regular operator on
+positions: the automata of its items are built apart and their product, restricted to the reachable
+tuples of positions, is embedded in the automaton (one state per reachable tuple).
+"""
+def ReiToGlushkovNFA(rei : REI) -> NFA:
+
+    # transitions of the automaton under construction: source -> set of (label, target)
+    edges = { 0: set() }
+
+    def new_state(space : dict) -> int:
+        state = len(space)
+        space[state] = set()
+        return state
+
+    # return a triple (nullable, first, last): first is a set of (label, target) pairs,
+    # last is a set of states
+    def visit(rei : REI, space : dict):
+
+        if isinstance(rei, (Start, End, Epsilon)) or (isinstance(rei, Symbol) and not rei.symbol):
+            return True, set(), set()
+
+        elif isinstance(rei, Symbol):
+            p = new_state(space)
+            return False, set([ (rei.symbol, p) ]), set([ p ])
+
+        elif isinstance(rei, Star):
+            nullable, first, last = visit(rei.rei, space)
+
+            for p in last:
+                space[p].update(first)
+
+            return True, first, last
+
+        elif isinstance(rei, Conc):
+            assert len(rei.items) > 0
+
+            nullable, first, last = True, set(), set()
+
+            for curr in rei.items:
+                c_nullable, c_first, c_last = visit(curr, space)
+
+                for p in last:
+                    space[p].update(c_first)
+
+                if nullable:
+                    first = first.union(c_first)
+                last = last.union(c_last) if c_nullable else c_last
+                nullable = nullable and c_nullable
+
+            return nullable, first, last
+
+        elif isinstance(rei, Union):
+            assert len(rei.items) > 0
+
+            nullable, first, last = False, set(), set()
+
+            for curr in rei.items:
+                c_nullable, c_first, c_last = visit(curr, space)
+
+                nullable = nullable or c_nullable
+                first.update(c_first)
+                last.update(c_last)
+
+            return nullable, first, last
+
+        elif isinstance(rei, Par):
+            assert len(rei.items) > 0
+
+            # each item is built in its own space of positions, where the state 0 is the initial one
+            items = []
+            for curr in rei.items:
+                c_space = { 0: set() }
+                c_nullable, c_first, c_last = visit(curr, c_space)
+                c_space[0] = c_first
+                items.append((c_space, c_last.union([ 0 ]) if c_nullable else c_last))
+
+            initial = tuple(0 for _ in items)
+            states = { initial: None }
+            queue = deque([ initial ])
+            first = set()
+
+            while queue:
+                tpl = queue.popleft()
+                source = states[tpl]
+
+                for pos, (c_space, _) in enumerate(items):
+                    for label, target in c_space[tpl[pos]]:
+                        tpl_target = tpl[:pos] + (target, ) + tpl[pos + 1:]
+
+                        if tpl_target not in states:
+                            states[tpl_target] = new_state(space)
+                            queue.append(tpl_target)
+
+                        if source is None:
+                            first.add((label, states[tpl_target]))
+                        else:
+                            space[source].add((label, states[tpl_target]))
+
+            last = set()
+            for tpl, state in states.items():
+                if state is not None and all(p in c_last for p, (_, c_last) in zip(tpl, items)):
+                    last.add(state)
+
+            nullable = all(0 in c_last for _, c_last in items)
+
+            return nullable, first, last
+
+        else:
+            raise Exception(f"Unexpected REI node: {rei}")
+
+    nullable, first, last = visit(rei, edges)
+    edges[0] = first
+
+    a = NFA()
+
+    for state in edges.keys():
+        a.add_state(State(f"g{state}"), is_final=(state in last or (state == 0 and nullable)))
+
+    a.set_initial("g0")
+
+    for source, transitions in edges.items():
+        for label, target in sorted(transitions):
+            a.add_transition(f"g{source}", f"g{target}", label)
+
+    return a
@@ -1,6 +1,14 @@
-from bpmn_parser.models import Choreography, ElementType
+from __future__ import annotations
+from typing import TYPE_CHECKING
+from threading import Lock
+from weakref import WeakValueDictionary
 # import re
 
+# the choreography models are only needed to type-check: importing them requires Django to be set up,
+# which is not the case in the worker processes translating REIs (see nfa.ReiToNFA)
+if TYPE_CHECKING:
+    from bpmn_parser.models import Choreography, ElementType
+
 def expect_node_type(cho:Choreography, node:ElementType, ntypes):
 
     if isinstance(ntypes, str):
@@ -10,27 +18,99 @@ def expect_node_type(cho:Choreography, node:ElementType, ntypes):
     assert real_ntype in ntypes, f"Expected node of type '{ntypes}'. Found: Node: {node} - Type: {real_ntype}"
 
 
+"""
+Node of a regular expression with interleaving. The nodes are immutable and hash-consed: building a
+node equal to an existing one (same type, same symbol or same items) returns the existing node, so
+that identical subtrees are shared, equality is identity and the structural hash is computed once,
+when the node is built. Nodes can thus be used as keys (see nfa.TranslationCache). The text and
+LaTeX forms of a node are computed on first use and then cached.
+"""
 class REI:
 
+    # (type, fields) -> node, for the nodes in use
+    _interned = WeakValueDictionary()
+    _interned_lock = Lock()
+
+    # names of the attributes holding the fields of the node (see _fields)
+    _field_names = ()
+
+    def __new__(cls, *args):
+        key = (cls, cls._fields(*args))
+
+        with REI._interned_lock:
+            node = REI._interned.get(key)
+
+            if node is None:
+                node = super().__new__(cls)
+                for name, value in zip(cls._field_names, key[1]):
+                    object.__setattr__(node, name, value)
+                object.__setattr__(node, "_key", key)
+                object.__setattr__(node, "_hash", hash(key))
+                object.__setattr__(node, "_str", None)
+                object.__setattr__(node, "_latex", None)
+
+                REI._interned[key] = node
+
+        return node
+
+    """
+    Return the tuple of the fields of the node built from the passed arguments
+    """
+    @classmethod
+    def _fields(cls, *args) -> tuple:
+        return args
+
+    def _args(self) -> tuple:
+        return self._key[1]
+
+    def __reduce__(self):
+        return (type(self), self._args())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"REI nodes are immutable: cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"REI nodes are immutable: cannot delete {name}")
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, REI) and self._hash == other._hash and self._key == other._key)
+
     def __str__(self):
-        return ""
+        if self._str is None:
+            object.__setattr__(self, "_str", self._render())
 
+        return self._str
 
     def __bytes__(self):
         return str(self).encode('utf-8')
 
     @property
     def latex(self):
+        if self._latex is None:
+            object.__setattr__(self, "_latex", self._render_latex())
+
+        return self._latex
+
+    def _render(self) -> str:
+        return ""
+
+    def _render_latex(self) -> str:
         return ""
 
 
 
 class Symbol(REI):
 
-    def __init__(self, symbol:str):
-        self.symbol = symbol
+    _field_names = ("symbol", )
 
-    def __str__(self):
+    @classmethod
+    def _fields(cls, symbol:str):
+        return (symbol, )
+
+    def _render(self):
         res = self.symbol
 
         if " " in res or not res:
@@ -38,51 +118,61 @@ class Symbol(REI):
     
         return res
 
-    @property
-    def latex(self):
+    def _render_latex(self):
         return f"\\textit{{{self.symbol}}}"
 
 class Epsilon(Symbol):
 
-    def __init__(self):
-        self.symbol = ""
+    @classmethod
+    def _fields(cls):
+        return ("", )
 
-    @property
-    def latex(self):
+    def _args(self):
+        return ()
+
+    def _render_latex(self):
         return f"\\epsilon"
 
 
 class Start(Symbol):
 
-    def __init__(self):
-        self.symbol = "^"
+    @classmethod
+    def _fields(cls):
+        return ("^", )
 
-    @property
-    def latex(self):
+    def _args(self):
+        return ()
+
+    def _render_latex(self):
         return "\\hat{}"
 
 class End(Symbol):
 
-    def __init__(self):
-        self.symbol = "$"
+    @classmethod
+    def _fields(cls):
+        return ("$", )
 
-    @property
-    def latex(self):
+    def _args(self):
+        return ()
+
+    def _render_latex(self):
         return f"\\$"        
 
 class Star(REI):
 
-    def __init__(self, rei:REI):
-        self.rei = rei
+    _field_names = ("rei", )
+
+    @classmethod
+    def _fields(cls, rei:REI):
+        return (rei, )
     
-    def __str__(self):
+    def _render(self):
         if isinstance(self.rei, Symbol):
             return f"{self.rei}*"
         else:
             return f"({self.rei})*"
 
-    @property
-    def latex(self):
+    def _render_latex(self):
         if isinstance(self.rei, Symbol):
             return f"{{{self.rei.latex}}}^\star"
         else:
@@ -91,66 +181,79 @@ class Star(REI):
 
 class Conc(REI):
 
-    def __init__(self, *children):
+    _field_names = ("items", )
+
+    @classmethod
+    def _fields(cls, *children):
         if len(children) == 0:
             raise Exception("Empty lists are not accepted here")
 
-        self.items = []
+        items = []
 
         for curr in children:
             if isinstance(curr, Conc):
-                self.items.extend(curr.items)
+                items.extend(curr.items)
             else:
                 if isinstance(curr, str):
                     curr = Symbol(curr)
 
-                self.items.append(curr)
+                items.append(curr)
 
-        # self.items = list(items)
+        return (tuple(items), )
 
-    def __str__(self):
-        text = ""
+    def _args(self):
+        return self.items
+
+    def _render(self):
+        parts = []
         eat_space = False
         for curr in self.items:
-            if eat_space or isinstance(curr, End):
-                text = f"{text}{curr}"
-            else:
-                text = f"{text} {curr}"
+            if not (eat_space or isinstance(curr, End)):
+                parts.append(" ")
+            parts.append(str(curr))
 
             # remember to eat one space next round
             eat_space = isinstance(curr, Start) or isinstance(curr, End)
-                
         
-        return text.strip()
+        return "".join(parts).strip()
 
-    @property
-    def latex(self):
+    def _render_latex(self):
         return " \\cdot ".join(map(lambda curr: str(curr.latex) if curr else "", self.items))
 
 
 class Par(REI):
 
-    def __init__(self, *items):
-        self.items = list(map(lambda curr: Symbol(curr) if isinstance(curr, str) else curr, items))
+    _field_names = ("items", )
 
-    def __str__(self):
+    @classmethod
+    def _fields(cls, *items):
+        return (tuple(map(lambda curr: Symbol(curr) if isinstance(curr, str) else curr, items)), )
+
+    def _args(self):
+        return self.items
+
+    def _render(self):
         return "(" + " & ".join(map(lambda curr: str(curr), self.items)) + ")"
 
-    @property
-    def latex(self):
+    def _render_latex(self):
         return "(" + " \& ".join(map(lambda curr: curr.latex if curr else "", self.items)) + ")"
 
 
 class Union(REI):
 
-    def __init__(self, *items):
-        self.items = list(map(lambda curr: Symbol(curr) if isinstance(curr, str) else curr, items))
+    _field_names = ("items", )
 
-    def __str__(self):
+    @classmethod
+    def _fields(cls, *items):
+        return (tuple(map(lambda curr: Symbol(curr) if isinstance(curr, str) else curr, items)), )
+
+    def _args(self):
+        return self.items
+
+    def _render(self):
         return "(" + " | ".join(map(lambda curr: str(curr), self.items)) + ")"
 
-    @property
-    def latex(self):
+    def _render_latex(self):
         return "(" + " \\vert ".join(map(lambda curr: curr.latex if curr else "", self.items)) + ")"
 
 
@@ -0,0 +1,174 @@
+import mmap
+import struct
+import sys
+from array import array
+
+from nfa import NFA, CompactNFA
+from dfa import DFA
+from symbols import SymbolTable
+
+
+"""
+Versioned binary format of the compact representation of an automaton (see nfa.CompactNFA):
+flat arrays of little-endian 64-bit ints plus a string table, so that a file can be mapped in
+memory and its arrays used in place, with no parsing nor copying. Worker processes mapping the
+same file share its pages.
+
+Layout (every section starts at a multiple of 8 bytes):
+- header: magic, version, flags (bit 0: deterministic automaton)
+- counts: number of states, of transitions, of labels (epsilon excluded), index of the initial
+  state (-1 if none), size in bytes of the string table
+- string offsets: number of states + number of labels + 1 ints, delimiting the UTF-8 encoded
+  state ids (in index order) and labels (in code order) within the string table
+- string table
+- offsets (number of states + 1 ints), edge labels and edge targets (number of transitions ints
+  each): the CSR arrays of CompactNFA
+- final: one byte per state, 1 if the state is final
+"""
+
+MAGIC = b"CHNF"
+VERSION = 1
+
+FLAG_DETERMINISTIC = 1
+
+_HEADER = struct.Struct("<4sHH")
+_COUNTS = struct.Struct("<5q")
+_INT_SIZE = 8
+
+
+def _padding(size : int) -> int:
+    return -size % _INT_SIZE
+
+
+def _int_bytes(values) -> bytes:
+    res = array("q", values)
+    if sys.byteorder != "little":
+        res.byteswap()
+
+    return res.tobytes()
+
+
+"""
+Return a view of count ints starting at the passed offset of the buffer. On little-endian
+machines the view shares the memory of the buffer; otherwise the ints are copied and swapped.
+"""
+def _int_view(buffer : memoryview, offset : int, count : int):
+    data = buffer[offset:offset + count * _INT_SIZE]
+
+    if sys.byteorder == "little":
+        return data.cast("q")
+
+    res = array("q", data)
+    res.byteswap()
+    return res
+
+
+"""
+Return the binary representation of the passed automaton. A DFA is stored through its
+NFA form (see dfa.DFA.to_nfa), flagged as deterministic.
+"""
+def dumps(automaton) -> bytes:
+    flags = 0
+    if isinstance(automaton, DFA):
+        automaton = automaton.to_nfa()
+        flags |= FLAG_DETERMINISTIC
+
+    if not isinstance(automaton, NFA):
+        raise ValueError(f"Cannot serialize {type(automaton).__name__}: expected an NFA or a DFA")
+
+    compact = automaton.freeze()
+
+    strings = [ compact.id(i).encode("utf-8") for i in range(compact.num_states) ]
+    strings.extend(label.encode("utf-8") for _, label in compact.symbols)
+
+    string_offsets = [ 0 ]
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    string_table = b"".join(strings)
+
+    parts = [
+        _HEADER.pack(MAGIC, VERSION, flags),
+        _COUNTS.pack(compact.num_states, compact.num_transitions, len(compact.symbols), compact.initial, len(string_table)),
+        _int_bytes(string_offsets),
+        string_table,
+        bytes(_padding(len(string_table))),
+        _int_bytes(compact._offsets),
+        _int_bytes(compact._edge_labels),
+        _int_bytes(compact._edge_targets),
+        bytes(compact._final),
+    ]
+
+    return b"".join(parts)
+
+
+"""
+Build the compact automaton stored in the passed buffer (bytes, mmap, ...). Its arrays are
+views over the buffer, which must not change while the automaton is in use.
+"""
+def loads(buffer) -> CompactNFA:
+    buffer = memoryview(buffer)
+
+    if len(buffer) < _HEADER.size + _COUNTS.size:
+        raise ValueError("Truncated automaton: missing header")
+
+    magic, version, _ = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError(f"Not a serialized automaton: bad magic {magic!r}")
+    if version != VERSION:
+        raise ValueError(f"Unsupported automaton format version {version} (expected {VERSION})")
+
+    num_states, num_transitions, num_labels, initial, strings_size = _COUNTS.unpack_from(buffer, _HEADER.size)
+
+    pos = _HEADER.size + _COUNTS.size
+    num_strings = num_states + num_labels
+    expected = pos + (num_strings + 1) * _INT_SIZE + strings_size + _padding(strings_size) \
+        + (num_states + 1 + 2 * num_transitions) * _INT_SIZE + num_states
+    if len(buffer) != expected:
+        raise ValueError(f"Corrupted automaton: expected {expected} bytes, found {len(buffer)}")
+
+    string_offsets = _int_view(buffer, pos, num_strings + 1)
+    pos += (num_strings + 1) * _INT_SIZE
+
+    string_table = buffer[pos:pos + strings_size]
+    strings = [ str(string_table[string_offsets[i]:string_offsets[i + 1]], "utf-8") for i in range(num_strings) ]
+    pos += strings_size + _padding(strings_size)
+
+    offsets = _int_view(buffer, pos, num_states + 1)
+    pos += (num_states + 1) * _INT_SIZE
+
+    edge_labels = _int_view(buffer, pos, num_transitions)
+    pos += num_transitions * _INT_SIZE
+
+    edge_targets = _int_view(buffer, pos, num_transitions)
+    pos += num_transitions * _INT_SIZE
+
+    final = buffer[pos:pos + num_states]
+
+    return CompactNFA.from_arrays(strings[:num_states], SymbolTable(strings[num_states:]), offsets, edge_labels, edge_targets, final, initial)
+
+
+"""
+Return whether the automaton stored in the passed buffer was serialized from a DFA
+"""
+def is_deterministic(buffer) -> bool:
+    magic, _, flags = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError(f"Not a serialized automaton: bad magic {magic!r}")
+
+    return bool(flags & FLAG_DETERMINISTIC)
+
+
+def dump(automaton, path : str):
+    with open(path, "wb") as f:
+        f.write(dumps(automaton))
+
+
+"""
+Map the passed file in memory (read-only) and return the compact automaton stored in it.
+The file stays mapped as long as the automaton is referenced.
+"""
+def load(path : str) -> CompactNFA:
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return loads(buffer)
@@ -0,0 +1,72 @@
+EPSILON = ""
+
+
+"""
+Table interning the labels of an automaton (e.g. actor?message events) into dense integer codes,
+with reverse lookup. Code 0 is reserved for epsilon (both "" and None), the other labels get the
+codes 1, 2, ... in order of first occurrence. Once a label has been interned, its code never changes:
+the table is shared by the automaton, its compact representation (see nfa.CompactNFA), the engines
+and the contract generator, so that they all compare integers rather than strings.
+"""
+class SymbolTable:
+
+    EPSILON_CODE = 0
+
+    def __init__(self, labels = ()):
+        self._labels = [ EPSILON ]
+        self._codes = { EPSILON: self.EPSILON_CODE, None: self.EPSILON_CODE }
+
+        for label in labels:
+            self.intern(label)
+
+    def __str__(self):
+        return f"{len(self)} labels"
+
+    def __len__(self):
+        return len(self._labels) - 1
+
+    def __contains__(self, label):
+        return label in self._codes
+
+    """
+    Iterate over the (code, label) pairs of the interned labels, epsilon excluded
+    """
+    def __iter__(self):
+        return iter(enumerate(self._labels[1:], start=1))
+
+    """
+    Return the code of the passed label, interning it if it was not in the table yet
+    """
+    def intern(self, label) -> int:
+        code = self._codes.get(label)
+
+        if code is None:
+            code = len(self._labels)
+            self._labels.append(label)
+            self._codes[label] = code
+
+        return code
+
+    """
+    Return the code of the passed label, None if the label is not in the table
+    """
+    def code(self, label) -> int:
+        return self._codes.get(label)
+
+    def label(self, code : int) -> str:
+        return self._labels[code]
+
+    """
+    Return a short name for the passed code, to display labels compactly (e.g. in DOT graphs):
+    A, B, ..., Z, AA, AB, ... (bijective base 26)
+    """
+    @staticmethod
+    def short_name(code : int) -> str:
+        assert code > 0, f"Epsilon has no short name"
+
+        res = ""
+        while code > 0:
+            code, rest = divmod(code - 1, 26)
+            res = chr(ord('A') + rest) + res
+
+        return res